@@ -169,8 +169,9 @@ if __name__ == "__main__":
         app.include_router(lollms_skills_library_router)   
         
         app.include_router(lollms_webui_infos_router)
-        app.include_router(lollms_discussion_router)
+        # Before the core discussion router: /delete_discussion also drops the webui caches of the discussion
         app.include_router(lollms_message_router)
+        app.include_router(lollms_discussion_router)
         app.include_router(lollms_user_router)
         app.include_router(lollms_advanced_router)
         app.include_router(chat_bar_router)
@@ -194,6 +195,8 @@ if __name__ == "__main__":
     @sio.event
     async def disconnect(sid):
         ASCIIColors.yellow(f"Disconnected: {sid}")
+        lollmsElfServer.generation_queue.cancel(sid)
+        lollmsElfServer.disconnect_stream(sid)
 
     @sio.event
     async def message(sid, data):
@@ -214,6 +217,9 @@ if __name__ == "__main__":
         lollms_chatbox_events_add(sio)
         lollms_interactive_events_add(sio)
 
+    # Stalls of the event loop are reported with the name of the handler blocking it
+    lollmsElfServer.loop_monitor.register_socketio_handlers(sio.handlers)
+
 
     app.mount("/extensions", StaticFiles(directory=Path(__file__).parent/"web"/"dist", html=True), name="extensions")
     app.mount("/playground", StaticFiles(directory=Path(__file__).parent/"web"/"dist", html=True), name="playground")
@@ -59,7 +59,7 @@ async def execute_personality_command(request: CmdExecutionRequest):
     client_id = request.client_id
     client = lollmsElfServer.session.get_client(client_id)
 
-    lollmsElfServer.cancel_gen = False
+    lollmsElfServer.new_generation_context(client_id)
     client.generated_text=""
     client.cancel_generation=False
     client.continuing=False
@@ -92,7 +92,7 @@ async def execute_personality_command(request: CmdExecutionRequest):
         parameters =  request.parameters
         lollmsElfServer.prepare_reception(client_id)
         if lollmsElfServer.personality.processor is not None:
-            lollmsElfServer.start_time = datetime.now()
+            lollmsElfServer.get_generation_context(client_id).reset_counters()
             lollmsElfServer.personality.processor.callback = partial(lollmsElfServer.process_chunk, client_id=client_id)
             lollmsElfServer.personality.processor.execute_command(command, parameters)
         else:
@@ -103,6 +103,7 @@ async def execute_personality_command(request: CmdExecutionRequest):
         #tpe = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message_id, client_id))
         #tpe.start()
     else:
+        lollmsElfServer.generation_metrics.busy_rejections.inc(lollmsElfServer.generation_labels())
         lollmsElfServer.error("I am busy. Come back later.", client_id=client_id)
         return {'status':False,"error":"I am busy. Come back later."}
 
@@ -143,6 +144,12 @@ async def add_webpage(request: AddWebPageRequest):
             lollmsElfServer.HideBlockingMessage()
             raise HTTPException(status_code=400, detail=f"Exception : {e}")
         
+        if not lollmsElfServer.worker_lanes.submit("ingestion", do_ingestion, file_path):
+            lollmsElfServer.HideBlockingMessage()
+            lollmsElfServer.error("Too many files are being added. Come back later.", client_id=request.client_id)
+
+    def do_ingestion(file_path):
+        client = lollmsElfServer.session.get_client(request.client_id)
         try:
             if not lollmsElfServer.personality.processor is None:
                 lollmsElfServer.personality.processor.add_file(file_path, client, partial(lollmsElfServer.process_chunk, client_id = request.client_id))
@@ -157,7 +164,8 @@ async def add_webpage(request: AddWebPageRequest):
             lollmsElfServer.HideBlockingMessage()
             lollmsElfServer.refresh_files()
             return {'status':False,"error":str(e)}
-    client.generation_thread = threading.Thread(target=do_scraping)
-    client.generation_thread.start()
+
+    if not lollmsElfServer.worker_lanes.submit("scraping", do_scraping):
+        return {'status':False,"error":"Too many web pages are being scraped. Come back later."}
         
     return {'status':True}
@@ -15,7 +15,7 @@ from starlette.responses import StreamingResponse
 from lollms.types import MSG_TYPE
 from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_exception
 from ascii_colors import ASCIIColors
-from lollms.databases.discussions_database import DiscussionsDB
+from lollms.databases.discussions_database import DiscussionsDB, Discussion
 from lollms.security import forbid_remote_access
 from safe_store.text_vectorizer import TextVectorizer, VectorizationMethod, VisualizationMethod
 import tqdm
@@ -42,7 +42,11 @@ async def edit_message(edit_params: EditMessageParameters):
     new_message = edit_params.message
     metadata = json.dumps(edit_params.metadata,indent=4)
     try:
-        lollmsElfServer.session.get_client(client_id).discussion.edit_message(message_id, new_message, new_metadata=metadata)
+        discussion = lollmsElfServer.session.get_client(client_id).discussion
+        discussion.edit_message(message_id, new_message, new_metadata=metadata)
+        lollmsElfServer.invalidate_message_tokens(message_id)
+        lollmsElfServer.invalidate_discussion_summary(discussion, message_id)
+        lollmsElfServer.invalidate_discussion_context(discussion)
         return {"status": True}
     except Exception as ex:
         trace_exception(ex)  # Assuming 'trace_exception' function logs the error
@@ -94,6 +98,9 @@ async def delete_message(delete_params: MessageDeleteParameters):
     else:
         try:
             new_rank = lollmsElfServer.session.get_client(client_id).discussion.delete_message(message_id)
+            lollmsElfServer.invalidate_message_tokens(message_id)
+            lollmsElfServer.invalidate_discussion_summary(lollmsElfServer.session.get_client(client_id).discussion, message_id)
+            lollmsElfServer.invalidate_discussion_context(lollmsElfServer.session.get_client(client_id).discussion)
             ASCIIColors.yellow("Message deleted")
             return {"status":True,"new_rank": new_rank}
         except Exception as ex:
@@ -101,3 +108,25 @@ async def delete_message(delete_params: MessageDeleteParameters):
             return {"status": False, "error": "There was an error deleting the message"}
 
 
+class DiscussionDeleteParameters(BaseModel):
+    client_id: str = Field(..., min_length=1)
+    id: int = Field(...)
+
+@router.post("/delete_discussion")
+async def delete_discussion(delete_params: DiscussionDeleteParameters):
+    """
+    Deletes a discussion and what the server keeps about it (saved model states, summary).
+    This router is included before the core discussion router, so this route replaces the core one.
+    """
+    forbid_remote_access(lollmsElfServer)
+    client = lollmsElfServer.session.get_client(delete_params.client_id)
+    try:
+        discussion = Discussion(delete_params.id, lollmsElfServer.db)
+        lollmsElfServer.forget_discussion(discussion)
+        discussion.delete_discussion()
+        if client is not None:
+            client.discussion = None
+        return {"status":True}
+    except Exception as ex:
+        trace_exception(ex)
+        return {"status": False, "error": "There was an error deleting the discussion"}
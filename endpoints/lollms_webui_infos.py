@@ -10,6 +10,7 @@ description:
 """
 
 from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse, FileResponse
 from pydantic import BaseModel
 import pkg_resources
 from lollms_webui import LOLLMSWebUI
@@ -17,7 +18,7 @@ from ascii_colors import ASCIIColors
 from lollms.utilities import load_config, run_async, show_yes_no_dialog
 from lollms.security import sanitize_path, forbid_remote_access, check_access
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 import sys
 import socketio
 import time
@@ -40,6 +41,143 @@ async def get_lollms_webui_version():
    # Return the version string
    return lollmsElfServer.version
 
+@router.get("/get_streaming_stats")
+async def get_streaming_stats():
+   """Get the streaming statistics (emit rate, flush latency, saved database writes, emit queue and tokenization, model state and search keywords caches counters)."""
+   forbid_remote_access(lollmsElfServer)
+   stats = lollmsElfServer.streaming_stats.to_dict()
+   stats.update(lollmsElfServer.write_behind_stats.to_dict())
+   stats.update(lollmsElfServer.emit_bridge.stats.to_dict())
+   stats["emit_queue_depth"] = lollmsElfServer.emit_bridge.depth
+   stats.update(lollmsElfServer.tokenization_cache.to_dict())
+   stats.update(lollmsElfServer.kv_state_cache.stats.to_dict())
+   stats.update(lollmsElfServer.keywords_cache.to_dict())
+   return stats
+
+@router.get("/get_worker_lanes_stats")
+async def get_worker_lanes_stats():
+   """Get the occupancy, queue and wait time counters of the background worker lanes and the housekeeping jobs."""
+   forbid_remote_access(lollmsElfServer)
+   stats = lollmsElfServer.worker_lanes.to_dict()
+   stats["background"].update(lollmsElfServer.background_jobs.to_dict())
+   stats["background"].update(lollmsElfServer.housekeeping.to_dict())
+   return stats
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+   """Get the generation latency and throughput metrics in the Prometheus text format."""
+   forbid_remote_access(lollmsElfServer)
+   return PlainTextResponse(lollmsElfServer.generation_metrics.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/get_traces")
+async def get_traces(n:int=20):
+   """Get the n last generation traces (spans of each stage of the requests), the most recent first."""
+   forbid_remote_access(lollmsElfServer)
+   exporter = lollmsElfServer.tracer.exporter
+   return {"status":True, "enabled":lollmsElfServer.tracer.enabled, "traces":exporter.last(n) if exporter is not None else []}
+
+class ProfilingParameters(BaseModel):
+   count: int = 1
+   client_id: Optional[str] = None
+   interval_ms: float = 5
+
+@router.post("/start_profiling")
+async def start_profiling(params: ProfilingParameters):
+   """Profile the next generations (of one client only if client_id is set) with the sampling profiler."""
+   forbid_remote_access(lollmsElfServer)
+   lollmsElfServer.profiling.arm(params.count, params.client_id, params.interval_ms)
+   return {"status":True, **lollmsElfServer.profiling.to_dict()}
+
+@router.post("/stop_profiling")
+async def stop_profiling():
+   """Cancel the profiling of the next generations."""
+   forbid_remote_access(lollmsElfServer)
+   lollmsElfServer.profiling.disarm()
+   return {"status":True, **lollmsElfServer.profiling.to_dict()}
+
+@router.get("/list_profiles")
+async def list_profiles(client_id: str):
+   """List the generation profiles saved in the folder of the current discussion of a client."""
+   forbid_remote_access(lollmsElfServer)
+   client = check_access(lollmsElfServer, client_id)
+   if client.discussion is None:
+      return {"status":False, "error":"No discussion is selected"}
+   folder = client.discussion.discussion_folder/"profiles"
+   profiles = sorted(folder.glob("*.folded"), key=lambda path: path.stat().st_mtime, reverse=True) if folder.exists() else []
+   return {"status":True, "profiles":[{"name":path.name, "size":path.stat().st_size} for path in profiles]}
+
+@router.get("/get_profile")
+async def get_profile(client_id: str, name: str):
+   """Download a generation profile (collapsed stacks, to open with speedscope or flamegraph.pl)."""
+   forbid_remote_access(lollmsElfServer)
+   client = check_access(lollmsElfServer, client_id)
+   if client.discussion is None:
+      return {"status":False, "error":"No discussion is selected"}
+   path = client.discussion.discussion_folder/"profiles"/Path(name).name
+   if Path(name).name!=name or path.suffix!=".folded" or not path.exists():
+      return {"status":False, "error":"Profile not found"}
+   return FileResponse(path, media_type="text/plain", filename=name)
+
+@router.get("/get_loop_stalls")
+async def get_loop_stalls(n:int=20):
+   """Get the n last stalls of the server event loop (duration, blocking socket.io handler and stack), the most recent first."""
+   forbid_remote_access(lollmsElfServer)
+   return {"status":True, **lollmsElfServer.loop_monitor.to_dict(), "stalls":lollmsElfServer.loop_monitor.last(n)}
+
+@router.get("/get_memory_report")
+def get_memory_report():
+   """Get the approximate memory retained per client session, mounted personality and vector database, and the sessions scheduled for deletion but never removed."""
+   forbid_remote_access(lollmsElfServer)
+   return {"status":True, **lollmsElfServer.memory_report()}
+
+@router.post("/remove_stale_sessions")
+def remove_stale_sessions():
+   """Remove the sessions scheduled for deletion that are not generating anymore."""
+   forbid_remote_access(lollmsElfServer)
+   return {"status":True, "removed":lollmsElfServer.remove_stale_sessions()}
+
+@router.post("/take_memory_snapshot")
+def take_memory_snapshot():
+   """Take a tracemalloc snapshot (tracing starts with the first snapshot and slows down allocations until stopped)."""
+   forbid_remote_access(lollmsElfServer)
+   snapshot_id = lollmsElfServer.memory_snapshots.take()
+   return {"status":True, "id":snapshot_id, "snapshots":lollmsElfServer.memory_snapshots.list()}
+
+@router.get("/get_memory_snapshot_diff")
+def get_memory_snapshot_diff(first: int, second: int, limit: int = 20, key_type: str = "lineno"):
+   """Get the allocations that grew the most between two tracemalloc snapshots."""
+   forbid_remote_access(lollmsElfServer)
+   if key_type not in ("lineno", "filename", "traceback"):
+      return {"status":False, "error":"key_type must be lineno, filename or traceback"}
+   try:
+      return {"status":True, "diff":lollmsElfServer.memory_snapshots.diff(first, second, limit, key_type)}
+   except KeyError as ex:
+      return {"status":False, "error":str(ex)}
+
+@router.get("/get_memory_snapshot_top")
+def get_memory_snapshot_top(id: int, limit: int = 20, key_type: str = "lineno"):
+   """Get the biggest allocations of a tracemalloc snapshot."""
+   forbid_remote_access(lollmsElfServer)
+   if key_type not in ("lineno", "filename", "traceback"):
+      return {"status":False, "error":"key_type must be lineno, filename or traceback"}
+   try:
+      return {"status":True, "top":lollmsElfServer.memory_snapshots.top(id, limit, key_type)}
+   except KeyError as ex:
+      return {"status":False, "error":str(ex)}
+
+@router.post("/stop_memory_tracing")
+def stop_memory_tracing():
+   """Stop tracemalloc and drop the snapshots."""
+   forbid_remote_access(lollmsElfServer)
+   lollmsElfServer.memory_snapshots.stop()
+   return {"status":True}
+
+@router.get("/get_cancellation_stats")
+async def get_cancellation_stats():
+   """Get the delays between the stop requests and the generations actually stopping."""
+   forbid_remote_access(lollmsElfServer)
+   return lollmsElfServer.cancellation_stats.to_dict()
+
 class Identification(BaseModel):
     client_id:str
 
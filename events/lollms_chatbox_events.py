@@ -70,30 +70,46 @@ def add_events(sio:socketio):
 
     @sio.on('add_webpage')
     def add_webpage(sid, data):
+        if not lollmsElfServer.worker_lanes.submit("scraping", do_scraping, sid, data['url']):
+            lollmsElfServer.error("Too many web pages are being scraped. Come back later.", client_id=sid)
+            lollmsElfServer.emit_bridge.emit('web_page_added', {'status':False})
+
+    def do_scraping(sid, url):
         lollmsElfServer.ShowBlockingMessage("Scraping web page\nPlease wait...")
         ASCIIColors.yellow("Scaping web page")
-        client = lollmsElfServer.session.get_client(sid)
-        url = data['url']
         index =  find_first_available_file_index(lollmsElfServer.lollms_paths.personal_uploads_path,"web_",".txt")
         file_path=lollmsElfServer.lollms_paths.personal_uploads_path/f"web_{index}.txt"
         scrape_and_save(url=url, file_path=file_path)
+        if not lollmsElfServer.worker_lanes.submit("ingestion", do_ingestion, sid, file_path):
+            lollmsElfServer.HideBlockingMessage()
+            lollmsElfServer.error("Too many files are being added. Come back later.", client_id=sid)
+            lollmsElfServer.emit_bridge.emit('web_page_added', {'status':False})
+
+    def do_ingestion(sid, file_path):
+        client = lollmsElfServer.session.get_client(sid)
         try:
             if not lollmsElfServer.personality.processor is None:
                 lollmsElfServer.personality.processor.add_file(file_path, client, partial(lollmsElfServer.process_chunk, client_id = sid))
                 # File saved successfully
-                run_async(partial(sio.emit,'web_page_added', {'status':True,}))
+                lollmsElfServer.emit_bridge.emit('web_page_added', {'status':True})
             else:
                 lollmsElfServer.personality.add_file(file_path, client, partial(lollmsElfServer.process_chunk, client_id = sid))
                 # File saved successfully
-                run_async(partial(sio.emit,'web_page_added', {'status':True}))
+                lollmsElfServer.emit_bridge.emit('web_page_added', {'status':True})
             lollmsElfServer.HideBlockingMessage()
         except Exception as e:
             # Error occurred while saving the file
-            run_async(partial(sio.emit,'web_page_added', {'status':False}))
+            lollmsElfServer.emit_bridge.emit('web_page_added', {'status':False})
             lollmsElfServer.HideBlockingMessage()
 
     @sio.on('take_picture')
     def take_picture(sid):
+        # The camera warm up and the ingestion of the shot take seconds, they run off the event loop
+        if not lollmsElfServer.worker_lanes.submit("ingestion", do_take_picture, sid):
+            lollmsElfServer.error("Too many files are being added. Come back later.", client_id=sid)
+            lollmsElfServer.emit_bridge.emit('picture_taken', {'status':False, 'error': "Too many files are being added"})
+
+    def do_take_picture(sid):
         try:
             client = lollmsElfServer.session.get_client(sid)
             if client is None:
@@ -122,18 +138,18 @@ def add_events(sio:socketio):
                     lollmsElfServer.info("Sending file to scripted persona")
                     lollmsElfServer.personality.processor.add_file(save_path, client, partial(lollmsElfServer.process_chunk, client_id = sid))
                     # File saved successfully
-                    run_async(partial(sio.emit,'picture_taken', {'status':True, 'progress': 100}))
+                    lollmsElfServer.emit_bridge.emit('picture_taken', {'status':True, 'progress': 100})
                     lollmsElfServer.info("File sent to scripted persona")
                 else:
                     lollmsElfServer.info("Sending file to persona")
                     lollmsElfServer.personality.add_file(save_path, client, partial(lollmsElfServer.process_chunk, client_id = sid))
                     # File saved successfully
-                    run_async(partial(sio.emit,'picture_taken', {'status':True, 'progress': 100}))
+                    lollmsElfServer.emit_bridge.emit('picture_taken', {'status':True, 'progress': 100})
                     lollmsElfServer.info("File sent to persona")
             except Exception as e:
                 trace_exception(e)
                 # Error occurred while saving the file
-                run_async(partial(sio.emit,'picture_taken', {'status':False, 'error': str(e)}))
+                lollmsElfServer.emit_bridge.emit('picture_taken', {'status':False, 'error': str(e)})
                 
 
         except Exception as ex:
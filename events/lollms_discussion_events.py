@@ -42,8 +42,14 @@ def add_events(sio:socketio):
             lollmsElfServer.error("Please select a personality first")
             return
         ASCIIColors.yellow("New descussion requested")
-        client_id = sid
-        title = data["title"]
+        # The database, the translations of the personality and the welcome audio stay off the event loop
+        discussion_id = await lollmsElfServer.run_blocking(create_discussion, sid, data["title"])
+        await lollmsElfServer.sio.emit('discussion_created',
+                    {'id':discussion_id},
+                    to=sid
+        )
+
+    def create_discussion(client_id, title):
         lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.create_discussion(title)
         # Get the current timestamp
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -73,8 +79,8 @@ def add_events(sio:socketio):
                 if not language_path.exists():
                     lollmsElfServer.ShowBlockingMessage(f"This is the first time this personality speaks {current_language}\nLollms is reconditionning the persona in that language.\nThis will be done just once. Next time, the personality will speak {current_language} out of the box")
                     language_path.parent.mkdir(exist_ok=True, parents=True)
-                    conditionning = "!@>system: "+lollmsElfServer.personality.fast_gen(f"!@>instruction: Translate the following text to {current_language}:\n{lollmsElfServer.personality.personality_conditioning.replace('!@>system:','')}\n!@>translation:\n", callback=lollmsElfServer.personality.sink)
-                    welcome_message = lollmsElfServer.personality.fast_gen(f"!@>instruction: Translate the following text to {current_language}:\n{lollmsElfServer.personality.welcome_message}\n!@>translation:\n", callback=lollmsElfServer.personality.sink)
+                    conditionning = "!@>system: "+lollmsElfServer.housekeeping_fast_gen(f"!@>instruction: Translate the following text to {current_language}:\n{lollmsElfServer.personality.personality_conditioning.replace('!@>system:','')}\n!@>translation:\n")
+                    welcome_message = lollmsElfServer.housekeeping_fast_gen(f"!@>instruction: Translate the following text to {current_language}:\n{lollmsElfServer.personality.welcome_message}\n!@>translation:\n")
                     with open(language_path,"w",encoding="utf-8", errors="ignore") as f:
                         yaml.safe_dump({"conditionning":conditionning,"welcome_message":welcome_message}, f)
                     lollmsElfServer.HideBlockingMessage()
@@ -86,7 +92,7 @@ def add_events(sio:socketio):
                 welcome_message = lollmsElfServer.personality.welcome_message
 
             try:
-                nb_tokens = len(lollmsElfServer.model.tokenize(welcome_message))
+                nb_tokens = len(lollmsElfServer.tokenize_cached(welcome_message))
             except:
                 nb_tokens = None
             message = lollmsElfServer.session.get_client(client_id).discussion.add_message(
@@ -106,20 +112,21 @@ def add_events(sio:socketio):
                 nb_tokens     = nb_tokens
             )
 
-            await lollmsElfServer.sio.emit('discussion_created',
-                        {'id':lollmsElfServer.session.get_client(client_id).discussion.discussion_id},
-                        to=client_id
-            )                        
+            return lollmsElfServer.session.get_client(client_id).discussion.discussion_id
         else:
-            await lollmsElfServer.sio.emit('discussion_created',
-                        {'id':0},
-                        to=client_id
-            )                        
+            return 0
 
     @sio.on('load_discussion')
     async def load_discussion(sid, data):   
-        client_id = sid
-        ASCIIColors.yellow(f"Loading discussion for client {client_id} ... ", end="")
+        ASCIIColors.yellow(f"Loading discussion for client {sid} ... ", end="")
+        jsons = await lollmsElfServer.run_blocking(load_discussion_messages, sid, data)
+        await lollmsElfServer.sio.emit('discussion',
+                    jsons,
+                    to=sid
+        )
+        ASCIIColors.green(f"ok")
+
+    def load_discussion_messages(client_id, data):
         if "id" in data:
             discussion_id = data["id"]
             lollmsElfServer.session.get_client(client_id).discussion = Discussion(discussion_id, lollmsElfServer.db)
@@ -130,9 +137,4 @@ def add_events(sio:socketio):
             else:
                 lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.create_discussion()
         messages = lollmsElfServer.session.get_client(client_id).discussion.get_messages()
-        jsons = [m.to_json() for m in messages]
-        await lollmsElfServer.sio.emit('discussion',
-                    jsons,
-                    to=client_id
-        )
-        ASCIIColors.green(f"ok")
\ No newline at end of file
+        return [m.to_json() for m in messages]
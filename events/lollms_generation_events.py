@@ -36,125 +36,45 @@ lollmsElfServer = LOLLMSWebUI.get_instance()
 def add_events(sio:socketio):
     forbid_remote_access(lollmsElfServer)
     @sio.on('generate_msg')
-    def handle_generate_msg(sid, data):        
-        client_id = sid
-        lollmsElfServer.cancel_gen = False
-        client = lollmsElfServer.session.get_client(client_id)
-
-        client.generated_text=""
-        client.cancel_generation=False
-        client.continuing=False
-        client.first_chunk=True
-        
+    async def handle_generate_msg(sid, data):
+        # Opening the discussion hits the database, it is done off the event loop
+        await lollmsElfServer.run_blocking(queue_prompt_generation, sid, data)
 
-        
-        if not lollmsElfServer.model:
-            ASCIIColors.error("Model not selected. Please select a model")
-            lollmsElfServer.error("Model not selected. Please select a model", client_id=client_id)
-            return
-
-        if not lollmsElfServer.busy:
-            if lollmsElfServer.session.get_client(client_id).discussion is None:
-                if lollmsElfServer.db.does_last_discussion_have_messages():
-                    lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.create_discussion()
-                else:
-                    lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.load_last_discussion()
-
-            prompt = data["prompt"]
-            try:
-                nb_tokens = len(lollmsElfServer.model.tokenize(prompt))
-            except:
-                nb_tokens = None
-            created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
-            message = lollmsElfServer.session.get_client(client_id).discussion.add_message(
-                message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
-                sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
-                sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
-                content=prompt,
-                metadata=None,
-                parent_message_id=lollmsElfServer.message_id,
-                created_at=created_at,
-                nb_tokens=nb_tokens
-            )
-
-            ASCIIColors.green("Starting message generation by "+lollmsElfServer.personality.name)
-            client.generation_thread = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id))
-            client.generation_thread.start()
-            
-            # lollmsElfServer.sio.sleep(0.01)
-            ASCIIColors.info("Started generation task")
-            lollmsElfServer.busy=True
-            #tpe = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message_id, client_id))
-            #tpe.start()
-        else:
-            lollmsElfServer.error("I am busy. Come back later.", client_id=client_id)
     @sio.on('generate_msg_with_internet')
-    def generate_msg_with_internet(sid, data):        
+    async def generate_msg_with_internet(sid, data):
+        await lollmsElfServer.run_blocking(queue_prompt_generation, sid, data, True)
+
+    def queue_prompt_generation(sid, data, internet_search:bool=False):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         client = lollmsElfServer.session.get_client(client_id)
 
-        client.generated_text=""
-        client.cancel_generation=False
-        client.continuing=False
-        client.first_chunk=True
-        
-
-        
         if not lollmsElfServer.model:
             ASCIIColors.error("Model not selected. Please select a model")
             lollmsElfServer.error("Model not selected. Please select a model", client_id=client_id)
             return
 
-        if not lollmsElfServer.busy:
-            if lollmsElfServer.session.get_client(client_id).discussion is None:
-                if lollmsElfServer.db.does_last_discussion_have_messages():
-                    lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.create_discussion()
-                else:
-                    lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.load_last_discussion()
-
-            prompt = data["prompt"]
-            try:
-                nb_tokens = len(lollmsElfServer.model.tokenize(prompt))
-            except:
-                nb_tokens = None
-            created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
-            message = lollmsElfServer.session.get_client(client_id).discussion.add_message(
-                message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
-                sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
-                sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
-                content=prompt,
-                metadata=None,
-                parent_message_id=lollmsElfServer.message_id,
-                created_at=created_at,
-                nb_tokens=nb_tokens
-            )
-
-            ASCIIColors.green("Starting message generation by "+lollmsElfServer.personality.name)
-            
-            client.generation_thread = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id, False, None, True))
-            client.generation_thread.start()
-            
-            # lollmsElfServer.sio.sleep(0.01)
-            ASCIIColors.info("Started generation task")
-            lollmsElfServer.busy=True
-            #tpe = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message_id, client_id))
-            #tpe.start()
-        else:
-            lollmsElfServer.error("I am busy. Come back later.", client_id=client_id)
-
+        if lollmsElfServer.session.get_client(client_id).discussion is None:
+            if lollmsElfServer.db.does_last_discussion_have_messages():
+                lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.create_discussion()
+            else:
+                lollmsElfServer.session.get_client(client_id).discussion = lollmsElfServer.db.load_last_discussion()
 
+        prompt = data["prompt"]
+        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
+        sender = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":","")
 
+        ASCIIColors.green("Queuing message generation by "+lollmsElfServer.personality.name)
+        lollmsElfServer.queue_generation(client_id, lollmsElfServer.start_prompt_generation, (client_id, prompt, sender, lollmsElfServer.message_id, created_at, None, True) if internet_search else (client_id, prompt, sender, lollmsElfServer.message_id, created_at))
 
     @sio.on('generate_msg_from')
-    def handle_generate_msg_from(sid, data):
+    async def handle_generate_msg_from(sid, data):
+        # Loading the message hits the database
+        await lollmsElfServer.run_blocking(queue_generation_from, sid, data)
+
+    def queue_generation_from(sid, data):
         client_id = sid
         client = lollmsElfServer.session.get_client(client_id)
-        lollmsElfServer.cancel_gen = False
-        client.continuing=False
-        client.first_chunk=True
         
         if lollmsElfServer.session.get_client(client_id).discussion is None:
             ASCIIColors.warning("Please select a discussion")
@@ -168,16 +88,15 @@ def add_events(sio:socketio):
             message = lollmsElfServer.session.get_client(client_id).discussion.load_message(id_)
         if message is None:
             return            
-        client.generation_thread = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id, False, generation_type))
-        client.generation_thread.start()
+        lollmsElfServer.queue_generation(client_id, lollmsElfServer.start_message_generation, (message, message.id, client_id, False, generation_type))
 
     @sio.on('continue_generate_msg_from')
-    def handle_continue_generate_msg_from(sid, data):
+    async def handle_continue_generate_msg_from(sid, data):
+        await lollmsElfServer.run_blocking(queue_continue_generation_from, sid, data)
+
+    def queue_continue_generation_from(sid, data):
         client_id = sid
         client = lollmsElfServer.session.get_client(client_id)
-        lollmsElfServer.cancel_gen = False
-        client.continuing=True
-        client.first_chunk=True
         
         if lollmsElfServer.session.get_client(client_id).discussion is None:
             ASCIIColors.yellow("Please select a discussion")
@@ -189,7 +108,56 @@ def add_events(sio:socketio):
         else:
             message = lollmsElfServer.session.get_client(client_id).discussion.load_message(id_)
 
-        client.generated_text=message.content
-        client.generation_thread = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id, True))
-        client.generation_thread.start()
-
+        lollmsElfServer.queue_generation(client_id, lollmsElfServer.start_message_generation, (message, message.id, client_id, True), continuing=True, generated_text=message.content)
+
+
+    @sio.on('set_streaming_protocol')
+    async def handle_set_streaming_protocol(sid, data):
+        """
+        Lets a frontend switch to the compact message_stream frames (protocol "delta", encoding "json" or "msgpack").
+        The server answers with the protocol actually used, which is the legacy one if the request can't be honored.
+        """
+        data = data if isinstance(data, dict) else {}
+        accepted = lollmsElfServer.set_streaming_protocol(sid, data.get("protocol"), data.get("encoding"))
+        ASCIIColors.info(f"Client {sid} streams using the {accepted['protocol']} protocol ({accepted['encoding']})")
+        await sio.emit('streaming_protocol', accepted, to=sid)
+
+    @sio.on('resync_stream')
+    def handle_resync_stream(sid, data):
+        """
+        Sent by a delta protocol client that can't apply a diff frame (its content is not at the frame base sequence number).
+        """
+        data = data if isinstance(data, dict) else {}
+        if not lollmsElfServer.resync_message_stream(sid, data.get("id")):
+            ASCIIColors.warning(f"Client {sid} asked to resync a message that is not streamed anymore")
+
+    @sio.on('resume_stream')
+    async def handle_resume_stream(sid, data):
+        """
+        Sent by a frontend that reconnected while one of its messages was being generated.
+        data: client_id (socket id of the previous connection), message_id and seq (last received sequence number).
+        """
+        data = data if isinstance(data, dict) else {}
+        resumed = lollmsElfServer.resume_message_stream(sid, data.get("client_id"), data.get("message_id"), data.get("seq"))
+        if resumed:
+            ASCIIColors.info(f"Client {sid} resumed the generation of message {data.get('message_id')}")
+        await sio.emit('stream_resumed', {"status": resumed, "message_id": data.get("message_id")}, to=sid)
+
+    @sio.on('cancel_queued_generation')
+    def handle_cancel_queued_generation(sid, data=None):
+        """
+        Removes the generations of the client that are still waiting for their turn.
+        """
+        nb_cancelled = lollmsElfServer.cancel_queued_generation(sid)
+        if nb_cancelled>0:
+            ASCIIColors.info(f"Cancelled {nb_cancelled} queued generation(s) of {sid}")
+
+    @sio.on('cancel_generation')
+    def handle_cancel_generation(sid, data=None):
+        """
+        Stops the generation of the client (replaces the handler of lollms core which stopped every
+        generation and killed the generation thread).
+        """
+        client_id = sid
+        if lollmsElfServer.cancel_generation(client_id):
+            ASCIIColors.error(f'Client {sid} canceled generation')
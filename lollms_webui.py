@@ -33,11 +33,13 @@ from tqdm import tqdm
 import traceback
 import sys
 import gc
-import ctypes
+from collections import OrderedDict
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import json
 import shutil
 import re
+from urllib.parse import urlencode
 import string
 import requests
 from datetime import datetime
@@ -53,24 +55,32 @@ if not PackageManager.check_package_installed("bs4"):
 import requests
 
 from lollms.internet import scrape_and_save
-
-
-def terminate_thread(thread):
-    if thread:
-        if not thread.is_alive():
-            ASCIIColors.yellow("Thread not alive")
-            return
-
-        thread_id = thread.ident
-        exc = ctypes.py_object(SystemExit)
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, exc)
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, None)
-            del thread
-            gc.collect()
-            raise SystemError("Failed to terminate the thread.")
-        else:
-            ASCIIColors.yellow("Canceled successfully")# The current version of the webui
+from utilities.stream_coalescer import StreamCoalescer, StreamingStats
+from utilities.message_write_behind import MessageWriteBehind, WriteBehindStats
+from utilities.antiprompt_matcher import StreamingAntipromptMatcher
+from utilities.text_buffer import GeneratedTextBuffer
+from utilities.stream_protocol import MessageStreamEncoder, StreamRoutes, negotiate_protocol, merge_chunk_frames, PROTOCOL_DELTA, PROTOCOL_LEGACY, ENCODING_JSON
+from utilities.emit_bridge import EmitBridge, EmitBridgeStats
+from utilities.generation_queue import GenerationQueue
+from utilities.generation_context import GenerationContext
+from utilities.model_pool import ModelPool
+from utilities.cancellation import GenerationCancelled, CancellationStats
+from utilities.worker_lanes import WorkerLanes
+from utilities.token_cache import TokenizationCache, MessageTokenCounts
+from utilities.kv_state_cache import KVStateCache, KVStateSession, kv_state_handler, delete_spilled_states
+from utilities.discussion_context import DiscussionContextBuilder
+from utilities.idle_jobs import IdleJobQueue
+from utilities.housekeeping import HousekeepingRouter
+from utilities.keyword_extraction import KeywordExtractor, KeywordCache, DocumentFrequencies, split_rewrite_prompt
+from utilities.discussion_summary import DiscussionSummaries, summary_prompt
+from utilities.metrics import GenerationMetrics, LATENCY_BUCKETS
+from utilities.tracing import Tracer, JSONLTraceExporter
+from utilities.sampling_profiler import ProfilingSwitch, SamplingProfiler
+from utilities.memory_introspection import TracemallocSnapshots, approximate_size
+from utilities.loop_monitor import LoopLagMonitor
+
+
+# The current version of the webui
 
 lollms_webui_version="9.6"
 
@@ -122,6 +132,16 @@ class LOLLMSWebUI(LOLLMSElfServer):
         args=None,
         sio=None
     ) -> None:
+        # Used by the model and busy properties, which the core already sets while loading
+        self._model = None
+        self.model_pool = None
+        self._model_pool_lock = threading.Lock()
+        self._model_pool_ready = False
+        self._busy = False
+        self._active_generations = 0
+        self._active_generations_lock = threading.Lock()
+        # Model instance leased by the generation running on the current thread
+        self._leased_model = threading.local()
         super().__init__(
             config,
             lollms_paths,
@@ -141,7 +161,6 @@ class LOLLMSWebUI(LOLLMSElfServer):
         self.nb_received_tokens = 0
         
         self.config_file_path = config.file_path
-        self.cancel_gen = False
 
         
         if self.config.auto_update:
@@ -194,6 +213,29 @@ class LOLLMSWebUI(LOLLMSElfServer):
         self.db.add_missing_columns()
         ASCIIColors.success("ok")
 
+        # Tokens of the texts that come back in every prompt and token counts of the messages
+        self.tokenization_cache = TokenizationCache(self.config.tokenization_cache_size)
+        self._message_token_counts = {}
+        # Rolling summaries of the discussions and the number of tokens their messages had in the last prompt
+        self._discussion_summaries = {}
+        self._summary_budgets = {}
+        # Context window of the last used discussions
+        self.context_builders = OrderedDict()
+        self._context_builders_lock = threading.Lock()
+
+        # Model states saved at the end of the generations, restored when a prompt of the same discussion shares their prefix
+        self.kv_state_cache = KVStateCache(
+                                            max_entries=self.config.kv_state_cache_max_entries,
+                                            max_entries_per_discussion=self.config.kv_state_cache_max_entries_per_discussion,
+                                            min_prefix=self.config.kv_state_cache_min_prefix
+                                        )
+
+        # Search keywords of the documents retrieval, by prompt
+        self.keyword_extractor = KeywordExtractor(self.config.data_vectorization_keys_words_count)
+        self.keywords_cache = KeywordCache(self.config.data_vectorization_keys_words_cache_size)
+        self._document_frequencies = (None, None)
+        self._preparing_query = threading.local()
+
         # prepare vectorization
         if self.config.data_vectorization_activate and self.config.activate_skills_lib:
             try:
@@ -215,7 +257,12 @@ class LOLLMSWebUI(LOLLMSElfServer):
         # Define a WebSocket event handler
         @sio.event
         async def connect(sid, environ):
-            self.session.add_client(sid, sid, self.db.load_last_discussion(), self.db)
+            # The emits of the generation threads are drained on this loop
+            self.emit_bridge.start(asyncio.get_running_loop())
+            if self.config.loop_lag_monitor:
+                self.loop_monitor.start(asyncio.get_running_loop())
+            discussion = await self.run_blocking(self.db.load_last_discussion)
+            self.session.add_client(sid, sid, discussion, self.db)
             await self.sio.emit('connected', to=sid) 
             ASCIIColors.success(f'Client {sid} connected')
 
@@ -234,6 +281,96 @@ class LOLLMSWebUI(LOLLMSElfServer):
 
         # generation status
         self.generating=False
+
+        # Streamed chunks coalescing
+        self.stream_coalescers = {}
+        self.streaming_stats = StreamingStats()
+        self._stream_ticker = None
+
+        # Write-behind persistence of the messages being generated
+        self.message_write_behinds = {}
+        self.write_behind_stats = WriteBehindStats()
+
+        # Incremental antiprompt detection of the generations in progress
+        self.antiprompt_matchers = {}
+
+        # Append optimized accumulators of the text being generated
+        self.text_buffers = {}
+
+        # Streaming protocol negotiated by each client and frame encoders of their open messages
+        self.stream_protocols = {}
+        self.stream_encoders = {}
+        self._timestamp_cache = (None, None)
+        # Socket ids that resumed the streams of disconnected clients
+        self.stream_routes = StreamRoutes()
+
+        # Every emit of the generation threads goes through this queue, drained on the server loop
+        self.emit_bridge = EmitBridge(
+                                        self.sio.emit,
+                                        max_pending=self.config.emit_queue_max_pending,
+                                        block_timeout_ms=self.config.emit_queue_block_timeout_ms,
+                                        stats=EmitBridgeStats()
+                                    )
+
+        # Bounded pools of workers running the background tasks, by kind of work
+        self.worker_lanes = WorkerLanes()
+        self.worker_lanes.add("generation", max(self.config.model_pool_size, 1), None)
+        self.worker_lanes.add("ingestion", self.config.ingestion_lane_workers, self.config.ingestion_lane_max_queued)
+        self.worker_lanes.add("scraping", self.config.scraping_lane_workers, self.config.scraping_lane_max_queued)
+        self.worker_lanes.add("background", 1, None)
+
+        # Generation requests wait here for their turn instead of being refused while the model is busy
+        self.generation_queue = GenerationQueue(
+                                                    max_depth=self.config.generation_queue_max_depth,
+                                                    max_concurrent=max(self.config.model_pool_size, 1),
+                                                    lane=self.worker_lanes["generation"],
+                                                    on_start=self._on_generation_start,
+                                                    on_position=self._on_queue_position,
+                                                    on_idle=self._on_generation_idle
+                                                )
+
+        # Housekeeping generations (titles, translations, search queries) go to the utility model if there is one
+        self.housekeeping = HousekeepingRouter(self._utility_model_key, self._load_utility_model)
+        self.worker_lanes.submit("background", self.housekeeping.get_model)
+        # Model states spilled by the previous run can't be found anymore
+        self.worker_lanes.submit("background", self._delete_stale_kv_states, time.time())
+
+        # Low priority jobs (discussion titles) run when no generation is running or waiting,
+        # or at any time when they have their own utility model
+        self.background_jobs = IdleJobQueue(
+                                                self.worker_lanes["background"],
+                                                lambda: self.housekeeping.available or self.generation_queue.idle,
+                                                batch_size=self.config.auto_title_batch_size
+                                            )
+
+        # State of the generations in progress and the model instances they run on
+        self.generation_contexts = {}
+        self.cancellation_stats = CancellationStats()
+        # Latency and throughput histograms exposed on /metrics
+        self.generation_metrics = GenerationMetrics()
+        # One trace per generation request with a span per stage, written to the logs folder
+        self.tracer = Tracer(
+                                JSONLTraceExporter(
+                                    self.lollms_paths.personal_log_path/"traces.jsonl",
+                                    max_bytes=self.config.tracing_max_file_size*1024*1024,
+                                    backup_count=self.config.tracing_backup_count,
+                                    keep_last=self.config.tracing_keep_last
+                                ),
+                                enabled=self.config.tracing
+                            )
+        # Sampling profiler armed by an admin for the next generations
+        self.profiling = ProfilingSwitch()
+        # tracemalloc snapshots taken on demand to find what retains memory
+        self.memory_snapshots = TracemallocSnapshots()
+        # Blocking work of the socket.io handlers (database, scraping, translations) runs on these threads
+        self.event_executor = ThreadPoolExecutor(max_workers=max(self.config.event_handlers_workers, 1), thread_name_prefix="sio_handler")
+        # Stalls of the event loop, named after the socket.io handler blocking it
+        self.loop_monitor = LoopLagMonitor(self.config.loop_lag_threshold_ms, on_stall=self._on_loop_stall)
+        self.loop_stalls = self.generation_metrics.registry.counter("event_loop_stalls_total", "Event loop stalls longer than the threshold.", ("handler",))
+        self.loop_stall_duration = self.generation_metrics.registry.histogram("event_loop_stall_seconds", "Duration of the event loop stalls.", LATENCY_BUCKETS)
+        # The other instances of the pool are built in the background from now on, at each model change
+        self._model_pool_ready = True
+        self.rebuild_model_pool()
         ASCIIColors.blue(f"Your personal data is stored here :",end="")
         ASCIIColors.green(f"{self.lollms_paths.personal_path}")
 
@@ -329,52 +466,24 @@ class LOLLMSWebUI(LOLLMSElfServer):
     def audio_callback(self, text):
         if self.summoned:
             client_id = 0
-            self.cancel_gen = False
             client = self.session.get_client(client_id)
-            client.generated_text=""
-            client.cancel_generation=False
-            client.continuing=False
-            client.first_chunk=True
             
             if not self.model:
                 ASCIIColors.error("Model not selected. Please select a model")
                 self.error("Model not selected. Please select a model", client_id=client_id)
                 return
  
-            if not self.busy:
-                if client.discussion is None:
-                    if self.db.does_last_discussion_have_messages():
-                        client.discussion = self.db.create_discussion()
-                    else:
-                        client.discussion = self.db.load_last_discussion()
-
-                prompt = text
-                try:
-                    nb_tokens = len(self.model.tokenize(prompt))
-                except:
-                    nb_tokens = None
-                ump = self.config.discussion_prompt_separator +self.config.user_name.strip() if self.config.use_user_name_in_discussions else self.personality.user_message_prefix
-                message = client.discussion.add_message(
-                    message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
-                    sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
-                    sender          = ump.replace(self.config.discussion_prompt_separator,"").replace(":",""),
-                    content         = prompt,
-                    metadata        = None,
-                    parent_message_id=self.message_id,
-                    nb_tokens=nb_tokens
-                )
+            if client.discussion is None:
+                if self.db.does_last_discussion_have_messages():
+                    client.discussion = self.db.create_discussion()
+                else:
+                    client.discussion = self.db.load_last_discussion()
 
-                ASCIIColors.green("Starting message generation by "+self.personality.name)
-                client.generation_thread = threading.Thread(target=self.start_message_generation, args=(message, message.id, client_id))
-                client.generation_thread.start()
-                
-                self.sio.sleep(0.01)
-                ASCIIColors.info("Started generation task")
-                self.busy=True
-                #tpe = threading.Thread(target=self.start_message_generation, args=(message, message_id, client_id))
-                #tpe.start()
-            else:
-                self.error("I am busy. Come back later.", client_id=client_id)
+            prompt = text
+            ump = self.config.discussion_prompt_separator +self.config.user_name.strip() if self.config.use_user_name_in_discussions else self.personality.user_message_prefix
+
+            ASCIIColors.green("Queuing message generation by "+self.personality.name)
+            self.queue_generation(client_id, self.start_prompt_generation, (client_id, prompt, ump.replace(self.config.discussion_prompt_separator,"").replace(":",""), self.message_id))
         else:
             if "lollms" in text.lower():
                 self.summoned = True
@@ -624,93 +733,109 @@ class LOLLMSWebUI(LOLLMSElfServer):
     def make_discussion_title(self, discussion, client_id=None):
         """
         Builds a title for a discussion
+        The generation stops when the cancellation token of the generation context of client_id is set.
         """
-        # Get the list of messages
-        messages = discussion.get_messages()
         discussion_messages = "!@>instruction: Create a short title to this discussion\nYour response should only contain the title without any comments.\n"
         discussion_title = "\n!@>Discussion title:"
 
-        available_space = self.config.ctx_size - 150 - len(self.model.tokenize(discussion_messages))- len(self.model.tokenize(discussion_title))
-        # Initialize a list to store the full messages
-        full_message_list = []        
-        # Accumulate messages until the cumulative number of tokens exceeds available_space
-        tokens_accumulated = 0
-        # Accumulate messages starting from message_index
-        for message in messages:
-            # Check if the message content is not empty and visible to the AI
-            if message.content != '' and (
-                    message.message_type <= MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_USER.value and message.message_type != MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_AI.value):
-
-                # Tokenize the message content
-                message_tokenized = self.model.tokenize(
-                    "\n" + self.config.discussion_prompt_separator + message.sender + ": " + message.content.strip())
-
-                # Check if adding the message will exceed the available space
-                if tokens_accumulated + len(message_tokenized) > available_space:
-                    break
-
-                # Add the tokenized message to the full_message_list
-                full_message_list.insert(0, message_tokenized)
-
-                # Update the cumulative number of tokens
-                tokens_accumulated += len(message_tokenized)
-
-        # Build the final discussion messages by detokenizing the full_message_list
-        
-        for message_tokens in full_message_list:
-            discussion_messages += self.model.detokenize(message_tokens)
+        available_space = self.config.ctx_size - 150 - len(self.tokenize_cached(discussion_messages))- len(self.tokenize_cached(discussion_title))
+        # The most recent messages fitting in the available space
+        text, _, _ = self.get_discussion_context(discussion).window(available_space)
+        discussion_messages += text
         discussion_messages += discussion_title
-        title = [""]
+        title = self._generate_short_text(discussion_messages, 150, client_id)
+        ASCIIColors.info(title)
+        return title
+
+    def _generate_short_text(self, prompt:str, n_predict:int, client_id=None)->str:
+        """
+        Generates a text for the server itself (title, summary), stopping at the first antiprompt or
+        when the cancellation token of the generation context of client_id is set.
+        """
+        context = self.get_generation_context(client_id)
+        text = [""]
+        matcher = self.build_antiprompt_matcher()
         def receive(
                         chunk:str, 
                         message_type:MSG_TYPE
                     ):
+            if context.cancellation.cancelled:
+                return False
             if chunk:
-                title[0] += chunk
-            antiprompt = self.personality.detect_antiprompt(title[0])
-            if antiprompt:
+                text[0] += chunk
+            if matcher is not None:
+                detection = matcher.feed(chunk)
+            else:
+                antiprompt = self.personality.detect_antiprompt(text[0])
+                detection = (antiprompt, text[0].lower().find(antiprompt)) if antiprompt else None
+            if detection:
+                antiprompt, position = detection
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
-                title[0] = self.remove_text_from_string(title[0],antiprompt)
+                if position!=-1:
+                    text[0] = text[0][:position]
                 return False
             else:
                 return True
             
-        self._generate(discussion_messages, 150, client_id, receive)
-        ASCIIColors.info(title[0])
-        return title[0]
+        self._generate(prompt, n_predict, client_id, receive)
+        return text[0]
    
 
+    def get_discussion_context(self, discussion, message_prefixes:tuple=None)->DiscussionContextBuilder:
+        """
+        Returns the context window of a discussion, synchronized with its messages.
+        Only the messages added since the last call are processed, edits and deletions are reported
+        by invalidate_discussion_context.
+
+        Args:
+            message_prefixes (tuple, optional): (ai sender name, ai prefix, user prefix) to put all the messages
+                as prefix + content, the format of the personality prompts (get_discussion_to), instead of the
+                visible messages as separator + sender + ": " + content.
+        """
+        key = (discussion.discussion_id, self.config.discussion_prompt_separator, message_prefixes)
+        with self._context_builders_lock:
+            builder = self.context_builders.get(key)
+            if builder is None:
+                if message_prefixes is None:
+                    builder = DiscussionContextBuilder(self.config.discussion_prompt_separator, self.is_message_visible_to_ai)
+                else:
+                    ai_name, ai_prefix, user_prefix = message_prefixes
+                    builder = DiscussionContextBuilder(
+                                                        self.config.discussion_prompt_separator,
+                                                        lambda message: True,
+                                                        lambda message: "\n" + (ai_prefix if message.sender==ai_name else user_prefix) + message.content
+                                                    )
+                self.context_builders[key] = builder
+            self.context_builders.move_to_end(key)
+            while len(self.context_builders)>self.config.context_builders_cache_size:
+                self.context_builders.popitem(last=False)
+        builder.sync(discussion.get_messages(), self.count_messages_tokens)
+        return builder
+
+    @staticmethod
+    def is_message_visible_to_ai(message)->bool:
+        return message.content != '' and message.message_type <= MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_USER.value and message.message_type != MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_AI.value
+
     def recover_discussion(self,client_id, message_index=-1):
-        messages = self.session.get_client(client_id).discussion.get_messages()
-        discussion=""
-        for msg in messages:
-            if message_index!=-1 and msg>message_index:
-                break
-            discussion += "\n" + self.config.discussion_prompt_separator + msg.sender + ": " + msg.content.strip()
-        return discussion
+        """
+        The discussion as text, up to the message with id message_index (the whole discussion if -1).
+        """
+        text, _, _ = self.get_discussion_context(self.session.get_client(client_id).discussion).window(upto_message_id=message_index)
+        return text
     
 
     def get_discussion_to(self, client_id,  message_id=-1):
-        messages = self.session.get_client(client_id).discussion.get_messages()
-        full_message_list = []
+        """
+        Conditionning followed by the last messages up to message_id (personality prefix + content, one per line)
+        fitting in the context.
+        """
         ump = self.config.discussion_prompt_separator +self.config.user_name.strip() if self.config.use_user_name_in_discussions else self.personality.user_message_prefix
-
-        for message in messages:
-            if message["id"]<= message_id or message_id==-1: 
-                if message["type"]!=MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_USER:
-                    if message["sender"]==self.personality.name:
-                        full_message_list.append(self.personality.ai_message_prefix+message["content"])
-                    else:
-                        full_message_list.append(ump + message["content"])
-
-        link_text = "\n"# self.personality.link_text
-
-        if len(full_message_list) > self.config["nb_messages_to_remember"]:
-            discussion_messages = self.personality.personality_conditioning+ link_text.join(full_message_list[-self.config["nb_messages_to_remember"]:])
-        else:
-            discussion_messages = self.personality.personality_conditioning+ link_text.join(full_message_list)
-        
-        return discussion_messages # Removes the last return
+        conditionning = self.personality.personality_conditioning
+        budget = self.config.ctx_size - self.config.min_n_predict - len(self.tokenize_cached(conditionning))
+        builder = self.get_discussion_context(self.session.get_client(client_id).discussion, (self.personality.name, self.personality.ai_message_prefix, ump))
+        text, _, _ = builder.window(budget, message_id, self.config["nb_messages_to_remember"])
+        # The messages are joined by new lines
+        return conditionning + text[1:]
 
     def notify(
                 self, 
@@ -720,18 +845,23 @@ class LOLLMSWebUI(LOLLMSElfServer):
                 client_id=None, 
                 display_type:NotificationDisplayType=NotificationDisplayType.TOAST,
                 verbose:bool|None=None,
+                link:dict|None=None,
             ):
+        """
+        Sends a notification to a client. link ({"url", "label"}) adds a link to the toast.
+        """
         if verbose is None:
             verbose = self.verbose
 
-        run_async(partial(self.sio.emit,'notification', {
+        notification = {
                                 'content': content,
                                 'notification_type': notification_type.value,
                                 "duration": duration,
                                 'display_type':display_type.value
-                            }, to=client_id
-                            )
-        )
+                            }
+        if link is not None:
+            notification['link'] = link
+        self.emit_bridge.emit('notification', notification, to=self.get_stream_route(client_id))
         if verbose:
             if notification_type==NotificationType.NOTIF_SUCCESS:
                 ASCIIColors.success(content)
@@ -743,9 +873,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                 ASCIIColors.red(content)
 
     def refresh_files(self, client_id=None):
-        run_async(partial(self.sio.emit,'refresh_files', to=client_id
-                            )
-        )
+        self.emit_bridge.emit('refresh_files', to=client_id)
 
 
     def new_message(self, 
@@ -778,8 +906,10 @@ class LOLLMSWebUI(LOLLMSElfServer):
             personality         = self.config["personalities"][self.config["active_personality_id"]],
             created_at          = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         )  # first the content is empty, but we'll fill it at the end  
-        run_async(partial(
-                    self.sio.emit,'new_message',
+        self.open_message_write_behind(client_id)
+        if self.open_message_stream(client_id, sender=sender, content=content, parameters=parameters, metadata=metadata, ui=ui, message_type=message_type, open=open):
+            return
+        self.emit_bridge.emit('new_message',
                         {
                             "sender":                   sender,
                             "message_type":             message_type.value,
@@ -801,14 +931,12 @@ class LOLLMSWebUI(LOLLMSElfServer):
                             'nb_tokens': client.discussion.current_message.nb_tokens,
 
                             'open':                     open
-                        }, to=client_id
-                )
+                        }, to=self.get_stream_route(client_id), lossless=True
             )
         
     def send_refresh(self, client_id):
         client = self.session.get_client(client_id)
-        run_async(
-            partial(self.sio.emit,'update_message', {
+        self.emit_bridge.emit('update_message', {
                                             "sender": client.discussion.current_message.sender,
                                             'id':client.discussion.current_message.id, 
                                             'content': client.discussion.current_message.content,
@@ -818,59 +946,320 @@ class LOLLMSWebUI(LOLLMSElfServer):
                                             'started_generating_at': client.discussion.current_message.started_generating_at,
                                             'finished_generating_at': client.discussion.current_message.finished_generating_at,
                                             'nb_tokens': client.discussion.current_message.nb_tokens,
-                                        }, to=client_id
-                                )
+                                        }, to=self.get_stream_route(client_id), lossless=True
         )
-    def update_message(self, client_id, chunk,                             
-                            parameters=None,
-                            metadata=[], 
-                            ui=None,
-                            msg_type:MSG_TYPE=None
-                        ):
+    def timestamp(self)->str:
+        """
+        Current date formatted as stored in the database. Formatted at most once per second since
+        it is needed for every streamed token.
+        """
+        now = int(time.time())
+        second, formatted = self._timestamp_cache
+        if second!=now:
+            formatted = datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
+            self._timestamp_cache = (now, formatted)
+        return formatted
+
+    def set_streaming_protocol(self, client_id, protocol:str=None, encoding:str=None):
+        """
+        Selects the streaming protocol of a client. Clients that never call this keep the legacy format.
+
+        Returns:
+            dict: The accepted protocol and encoding
+        """
+        protocol, encoding = negotiate_protocol(protocol, encoding)
+        if protocol==PROTOCOL_LEGACY:
+            self.stream_protocols.pop(client_id, None)
+        else:
+            self.stream_protocols[client_id] = (protocol, encoding)
+        return {"protocol":protocol, "encoding":encoding}
+
+    def open_message_stream(self, client_id, **fields)->bool:
+        """
+        Sends the header frame of the current message of a client using the delta protocol.
+
+        Returns:
+            bool: False if the client uses the legacy protocol (nothing was sent)
+        """
+        protocol, encoding = self.stream_protocols.get(client_id, (PROTOCOL_LEGACY, ENCODING_JSON))
+        if protocol!=PROTOCOL_DELTA:
+            return False
         client = self.session.get_client(client_id)
-        client.discussion.current_message.finished_generating_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        client.discussion.current_message.nb_tokens = self.nb_received_tokens
-        mtdt = json.dumps(metadata, indent=4) if metadata is not None and type(metadata)== list else metadata
-        if self.nb_received_tokens==1:
-            client.discussion.current_message.started_generating_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-            run_async(
-                partial(self.sio.emit,'update_message', {
-                                                "sender": self.personality.name,
-                                                'id':client.discussion.current_message.id, 
-                                                'content': "✍ warming up ...",
-                                                'ui': ui,
-                                                'discussion_id':client.discussion.discussion_id,
-                                                'message_type': MSG_TYPE.MSG_TYPE_STEP_END.value,
-                                                'created_at':client.discussion.current_message.created_at,
-                                                'started_generating_at': client.discussion.current_message.started_generating_at,
-                                                'finished_generating_at': client.discussion.current_message.finished_generating_at,
-                                                'nb_tokens': client.discussion.current_message.nb_tokens,
-                                                'parameters':parameters,
-                                                'metadata':metadata
-                                            }, to=client_id
-                                    )
-            )
+        message = client.discussion.current_message
+        message_type = fields.get("message_type", MSG_TYPE(message.message_type))
+        header = {
+            "sender":                   fields.get("sender", message.sender),
+            "message_type":             message_type.value if isinstance(message_type, MSG_TYPE) else message_type,
+            "sender_type":              SENDER_TYPES.SENDER_TYPES_AI.value,
+            "content":                  fields.get("content", message.content),
+            "parameters":               fields.get("parameters"),
+            "metadata":                 fields.get("metadata"),
+            "ui":                       fields.get("ui", message.ui),
+            "parent_message_id":        message.parent_message_id,
+            "discussion_id":            client.discussion.discussion_id,
+            'binding':                  self.config["binding_name"],
+            'model' :                   self.config["model_name"], 
+            'personality':              self.config["personalities"][self.config["active_personality_id"]],
+            'created_at':               message.created_at,
+            'started_generating_at':    message.started_generating_at,
+            'finished_generating_at':   message.finished_generating_at,
+            'nb_tokens':                message.nb_tokens,
+            'open':                     fields.get("open", False)
+        }
+        encoder = MessageStreamEncoder(message.id, encoding, history_size=self.config.streaming_replay_buffer_size)
+        self.stream_encoders[client_id] = encoder
+        self._emit_stream_frame(client_id, encoder, encoder.header(**header))
+        return True
+
+    def get_stream_encoder(self, client_id):
+        """
+        Returns the frame encoder of the current message of a client, or None if the client uses the legacy protocol.
+        Messages that were not opened by new_message (continued messages) get their header frame here.
+        """
+        if client_id not in self.stream_protocols:
+            return None
+        encoder = self.stream_encoders.get(client_id)
+        if encoder is None or encoder.message_id!=self.session.get_client(client_id).discussion.current_message.id:
+            self.open_message_stream(client_id)
+            encoder = self.stream_encoders.get(client_id)
+        return encoder
+
+    def get_stream_route(self, client_id):
+        """
+        Socket id to which the messages generated for a client must be sent.
+        It differs from the client id when the client reconnected and resumed the generation.
+        """
+        return self.stream_routes.route(client_id)
+
+    def disconnect_stream(self, sid):
+        """
+        Called when a socket disconnects. If a generation is streamed to it, its protocol and frame encoder
+        are kept (the frames keep filling the replay buffer) until the message is closed or the generation
+        is resumed by the reconnected frontend. Otherwise its streaming state is dropped.
+        """
+        client = self.session.get_client(self.stream_routes.origin(sid))
+        if client is not None and client.processing:
+            self.stream_routes.disconnect(sid)
+        else:
+            self.stream_protocols.pop(sid, None)
+
+    def release_message_stream(self, client_id):
+        """
+        Forgets the route of a finished generation and the streaming state of the sockets that disconnected during it.
+        """
+        for sid in self.stream_routes.release(client_id):
+            client = self.session.get_client(sid)
+            if sid==client_id or client is None or not client.processing:
+                self.stream_protocols.pop(sid, None)
+
+    def resume_message_stream(self, sid, client_id, message_id, last_seq:int=None)->bool:
+        """
+        Reattaches a reconnected socket to the generation started by a previous connection.
+        Delta protocol clients get the frames they missed (or a resync), legacy clients get the whole content.
+        The generation is only handed over once the socket receiving it has disconnected.
+
+        Args:
+            sid: The new socket id.
+            client_id: The socket id that started the generation.
+            message_id: The message being generated.
+            last_seq (int): The last sequence number received before disconnecting.
+
+        Returns:
+            bool: False if there is no such generation in progress or if it is still streamed to a connected socket
+        """
+        # A client that reconnects twice only knows the socket id of its previous connection
+        client = self.session.get_client(self.stream_routes.origin(client_id))
+        if client is None or not client.processing or client.discussion is None or client.discussion.current_message is None or client.discussion.current_message.id!=message_id:
+            return False
+        client_id = self.stream_routes.resume(sid, client_id)
+        if client_id is None:
+            ASCIIColors.warning(f"Client {sid} tried to resume a generation streamed to a connected client")
+            return False
+        new_client = self.session.get_client(sid)
+        if new_client is not None:
+            new_client.discussion = client.discussion
+
+        encoder = self.stream_encoders.get(client_id)
+        protocol, encoding = self.stream_protocols.get(sid, (PROTOCOL_LEGACY, ENCODING_JSON))
+        if protocol==PROTOCOL_DELTA:
+            self.stream_protocols[client_id] = (protocol, encoding)
+            if encoder is None:
+                # The previous connection used the legacy protocol: start a stream for the new one
+                self.open_message_stream(client_id, content=self.get_generated_text(client_id))
+            else:
+                encoder.encoding = encoding
+                for frame in encoder.replay(last_seq):
+                    self._emit_stream_frame(client_id, encoder, frame)
+        else:
+            self.stream_protocols.pop(client_id, None)
+            self.stream_encoders.pop(client_id, None)
+            self.flush_stream(client_id)
+            self._emit_update_message(client_id, self.get_generated_text(client_id), msg_type=MSG_TYPE.MSG_TYPE_FULL)
+        return True
+
+    def resync_message_stream(self, client_id, message_id)->bool:
+        """
+        Sends the whole content of a message to a client whose content does not match the diff it received.
+        """
+        # A socket that resumed a generation asks for the stream of the client that started it
+        client_id = self.stream_routes.origin(client_id)
+        encoder = self.stream_encoders.get(client_id)
+        if encoder is None or encoder.message_id!=message_id:
+            return False
+        self._emit_stream_frame(client_id, encoder, encoder.resync())
+        return True
 
-        run_async(
-            partial(self.sio.emit,'update_message', {
+    def _emit_stream_frame(self, client_id, encoder:MessageStreamEncoder, frame:dict):
+        # The frames carry the content of the message, they must not be lost
+        self.emit_bridge.emit('message_stream', frame, to=self.get_stream_route(client_id), merge=merge_chunk_frames, encode=encoder.encode, lossless=True)
+
+    def _emit_update_message(self, client_id, chunk, parameters=None, metadata=None, ui=None, msg_type:MSG_TYPE=None):
+        start = time.perf_counter()
+        try:
+            self._emit_update_message_frame(client_id, chunk, parameters, metadata, ui, msg_type)
+        finally:
+            self.tracer.add_time("emit", (time.perf_counter()-start)*1000)
+
+    def _emit_update_message_frame(self, client_id, chunk, parameters=None, metadata=None, ui=None, msg_type:MSG_TYPE=None):
+        client = self.session.get_client(client_id)
+        encoder = self.get_stream_encoder(client_id)
+        if encoder is not None:
+            if msg_type==MSG_TYPE.MSG_TYPE_CHUNK and ui is None:
+                frame = encoder.chunk(chunk, parameters, metadata)
+            elif msg_type==MSG_TYPE.MSG_TYPE_FULL and ui is None:
+                frame = encoder.full(chunk, parameters, metadata)
+            else:
+                frame = encoder.update(chunk, msg_type.value, parameters, metadata, ui)
+            self._emit_stream_frame(client_id, encoder, frame)
+            return
+        self.emit_bridge.emit('update_message', {
                                             "sender": self.personality.name,
                                             'id':client.discussion.current_message.id, 
                                             'content': chunk,
                                             'ui': ui,
                                             'discussion_id':client.discussion.discussion_id,
-                                            'message_type': msg_type.value if msg_type is not None else MSG_TYPE.MSG_TYPE_CHUNK.value if self.nb_received_tokens>1 else MSG_TYPE.MSG_TYPE_FULL.value,
+                                            'message_type': msg_type.value,
                                             'created_at':client.discussion.current_message.created_at,
                                             'started_generating_at': client.discussion.current_message.started_generating_at,
                                             'finished_generating_at': client.discussion.current_message.finished_generating_at,
                                             'nb_tokens': client.discussion.current_message.nb_tokens,
                                             'parameters':parameters,
                                             'metadata':metadata
-                                        }, to=client_id
-                                )
+                                        }, to=self.get_stream_route(client_id), merge=self._merge_chunk_updates, lossless=True
         )
-        if msg_type != MSG_TYPE.MSG_TYPE_INFO:
-            client.discussion.update_message(client.generated_text, new_metadata=mtdt, new_ui=ui, started_generating_at=client.discussion.current_message.started_generating_at, nb_tokens=client.discussion.current_message.nb_tokens)
+
+    @staticmethod
+    def _merge_chunk_updates(queued:dict, data:dict):
+        # Chunks of the same message still waiting in the emit queue are sent as one update
+        chunk = MSG_TYPE.MSG_TYPE_CHUNK.value
+        if queued["message_type"]!=chunk or data["message_type"]!=chunk or queued["id"]!=data["id"]:
+            return None
+        if queued["ui"] is not None or data["ui"] is not None or queued["parameters"]!=data["parameters"] or queued["metadata"]!=data["metadata"]:
+            return None
+        merged = dict(data)
+        merged["content"] = queued["content"] + data["content"]
+        return merged
+
+    def get_stream_coalescer(self, client_id):
+        """
+        Returns the chunk coalescer of the message currently streamed to a client (created on demand)
+        """
+        coalescer = self.stream_coalescers.get(client_id)
+        if coalescer is None:
+            coalescer = StreamCoalescer(
+                                            lambda text: self._emit_update_message(client_id, text, *coalescer.frame_args, None, MSG_TYPE.MSG_TYPE_CHUNK),
+                                            interval_ms=self.config.streaming_coalesce_interval_ms,
+                                            max_bytes=self.config.streaming_coalesce_max_bytes,
+                                            stats=self.streaming_stats
+                                        )
+            coalescer.frame_args = (None, None)
+            self.stream_coalescers[client_id] = coalescer
+            self._start_stream_ticker()
+        return coalescer
+
+    def flush_stream(self, client_id):
+        """
+        Sends the chunks that are still buffered for a client
+        """
+        coalescer = self.stream_coalescers.get(client_id)
+        if coalescer is not None:
+            coalescer.flush()
+
+    def close_stream(self, client_id):
+        coalescer = self.stream_coalescers.pop(client_id, None)
+        if coalescer is not None:
+            coalescer.close()
+            if coalescer.nb_chunks>0 and self.config.debug:
+                ASCIIColors.info(f"Streamed {coalescer.nb_chunks} chunks in {coalescer.nb_frames} frames")
+
+    def open_message_write_behind(self, client_id):
+        """
+        Creates the write-behind buffer of the message a client starts generating, bound to its current discussion.
+        A buffer left over by a previous message is written and released first.
+        """
+        self.close_message_write_behind(client_id)
+        discussion = self.session.get_client(client_id).discussion
+        write_behind = MessageWriteBehind(
+                                            discussion.update_message,
+                                            interval_ms=self.config.message_checkpoint_interval_ms,
+                                            stats=self.write_behind_stats
+                                        )
+        self.message_write_behinds[client_id] = write_behind
+        self._start_stream_ticker()
+        return write_behind
+
+    def close_message_write_behind(self, client_id):
+        """
+        Writes the pending state of the message (if it was being generated) and releases its buffer
+        """
+        write_behind = self.message_write_behinds.pop(client_id, None)
+        if write_behind is not None:
+            write_behind.flush()
+
+    def _start_stream_ticker(self):
+        # A single daemon thread flushes the buffers of stalled generations and checkpoints their messages
+        if self._stream_ticker is not None:
+            return
+        def tick():
+            while True:
+                time.sleep(max(self.config.streaming_coalesce_interval_ms, 10)/1000)
+                for buffer in list(self.stream_coalescers.values())+list(self.message_write_behinds.values()):
+                    try:
+                        buffer.flush_if_due()
+                    except Exception as ex:
+                        trace_exception(ex)
+        self._stream_ticker = threading.Thread(target=tick, daemon=True, name="stream_ticker")
+        self._stream_ticker.start()
+
+    def update_message(self, client_id, chunk,                             
+                            parameters=None,
+                            metadata=[], 
+                            ui=None,
+                            msg_type:MSG_TYPE=None
+                        ):
+        client = self.session.get_client(client_id)
+        client.discussion.current_message.finished_generating_at=self.timestamp()
+        context = self.get_generation_context(client_id)
+        client.discussion.current_message.nb_tokens = context.nb_received_tokens
+        # Serialized only when the message is checkpointed
+        mtdt = partial(json.dumps, metadata, indent=4) if metadata is not None and type(metadata)== list else metadata
+        if context.nb_received_tokens==1:
+            client.discussion.current_message.started_generating_at=self.timestamp()
+            self.flush_stream(client_id)
+            self._emit_update_message(client_id, "✍ warming up ...", parameters, metadata, ui, MSG_TYPE.MSG_TYPE_STEP_END)
+
+        if msg_type == MSG_TYPE.MSG_TYPE_CHUNK and self.config.streaming_coalesce_chunks:
+            coalescer = self.get_stream_coalescer(client_id)
+            coalescer.frame_args = (parameters, metadata)
+            coalescer.push(chunk)
+        else:
+            # Anything that is not a plain chunk (full rewrite, steps, ui...) must not overtake the buffered text
+            self.flush_stream(client_id)
+            self._emit_update_message(client_id, chunk, parameters, metadata, ui, msg_type if msg_type is not None else MSG_TYPE.MSG_TYPE_CHUNK if context.nb_received_tokens>1 else MSG_TYPE.MSG_TYPE_FULL)
+        # Only the open message is checkpointed, the updates sent after close_message (step ends) are not persisted
+        write_behind = self.message_write_behinds.get(client_id)
+        if write_behind is not None and msg_type != MSG_TYPE.MSG_TYPE_INFO:
+            write_behind.update(partial(self.get_generated_text, client_id), new_metadata=mtdt, new_ui=ui, started_generating_at=client.discussion.current_message.started_generating_at, nb_tokens=client.discussion.current_message.nb_tokens)
 
 
 
@@ -878,16 +1267,34 @@ class LOLLMSWebUI(LOLLMSElfServer):
         client = self.session.get_client(client_id)
         if not client.discussion:
             return
+        self.close_stream(client_id)
+        self.antiprompt_matchers.pop(client_id, None)
         #fix halucination
-        client.generated_text=client.generated_text.split("!@>")[0]
+        buffer = self.text_buffers.pop(client_id, None)
+        client.generated_text = buffer.visible_text() if buffer is not None else client.generated_text.split("!@>")[0]
         # Send final message
         client.discussion.current_message.finished_generating_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        try:
-            client.discussion.current_message.nb_tokens = len(self.model.tokenize(client.generated_text))
-        except:
-            client.discussion.current_message.nb_tokens = None
-        run_async(
-            partial(self.sio.emit,'close_message', {
+        # Counted while streaming, the answer is only tokenized again if it was rewritten or cut
+        nb_tokens = buffer.nb_tokens if buffer is not None else None
+        client.discussion.current_message.nb_tokens = nb_tokens if nb_tokens is not None else self.count_tokens(client.generated_text)
+        # The last checkpoint stores the trimmed answer, not the hallucinated tail still held by the buffer
+        write_behind = self.message_write_behinds.pop(client_id, None)
+        if write_behind is not None:
+            write_behind.close(
+                                client.generated_text,
+                                started_generating_at=client.discussion.current_message.started_generating_at,
+                                nb_tokens=client.discussion.current_message.nb_tokens
+                            )
+        encoder = self.stream_encoders.pop(client_id, None)
+        if encoder is not None and encoder.message_id==client.discussion.current_message.id:
+            self._emit_stream_frame(client_id, encoder, encoder.close(
+                                            content=client.generated_text,
+                                            started_generating_at=client.discussion.current_message.started_generating_at,
+                                            finished_generating_at=client.discussion.current_message.finished_generating_at,
+                                            nb_tokens=client.discussion.current_message.nb_tokens
+                                        ))
+            return
+        self.emit_bridge.emit('close_message', {
                                             "sender": self.personality.name,
                                             "id": client.discussion.current_message.id,
                                             "content":client.generated_text,
@@ -901,10 +1308,67 @@ class LOLLMSWebUI(LOLLMSElfServer):
                                             'finished_generating_at': client.discussion.current_message.finished_generating_at,
                                             'nb_tokens': client.discussion.current_message.nb_tokens,
 
-                                        }, to=client_id
-                                )
+                                        }, to=self.get_stream_route(client_id), lossless=True
         )
 
+    def build_antiprompt_matcher(self, text:str=""):
+        """
+        Builds a streaming antiprompt matcher from the current personality antiprompts.
+        Returns None if the personality does not expose its antiprompts.
+        """
+        anti_prompts = getattr(self.personality, "anti_prompts", None)
+        if anti_prompts is None:
+            return None
+        matcher = StreamingAntipromptMatcher(anti_prompts)
+        matcher.reset(text)
+        return matcher
+
+    def get_text_buffer(self, client_id)->GeneratedTextBuffer:
+        """
+        Returns the accumulator of the text being generated for a client.
+        It is created from client.generated_text on first use and released by close_message.
+        """
+        buffer = self.text_buffers.get(client_id)
+        if buffer is None:
+            client = self.session.get_client(client_id)
+            # When continuing a message, its stored token count is the starting point
+            nb_tokens = client.discussion.current_message.nb_tokens if client.continuing and client.discussion and client.discussion.current_message else None
+            buffer = GeneratedTextBuffer(client.generated_text, nb_tokens=nb_tokens)
+            self.text_buffers[client_id] = buffer
+        return buffer
+
+    def get_generated_text(self, client_id)->str:
+        """
+        Materializes the text generated for a client and stores it in client.generated_text
+        """
+        client = self.session.get_client(client_id)
+        buffer = self.text_buffers.get(client_id)
+        if buffer is not None:
+            client.generated_text = buffer.text
+        return client.generated_text
+
+    def detect_streamed_antiprompt(self, client_id, chunk:str, full_rewrite:bool=False):
+        """
+        Checks the text generated for a client for antiprompts after `chunk` was added to it.
+
+        Returns:
+            tuple: (antiprompt, position) where position is the index at which the generated text must be cut, or None.
+        """
+        buffer = self.get_text_buffer(client_id)
+        matcher = self.antiprompt_matchers.get(client_id)
+        if matcher is None or full_rewrite:
+            matcher = self.build_antiprompt_matcher("" if full_rewrite else buffer.text[:len(buffer)-len(chunk or "")])
+            self.antiprompt_matchers[client_id] = matcher
+        if matcher is None:
+            # Fallback to a full scan
+            antiprompt = self.personality.detect_antiprompt(buffer.text)
+            return (antiprompt, buffer.text.lower().find(antiprompt)) if antiprompt else None
+        detection = matcher.feed(chunk)
+        if detection:
+            # The text will be cut at the antiprompt, restart from there
+            matcher.reset(buffer.text[:detection[1]])
+        return detection
+
     def process_chunk(
                         self, 
                         chunk:str, 
@@ -923,6 +1387,10 @@ class LOLLMSWebUI(LOLLMSElfServer):
         if not client_id in list(self.session.clients.keys()):
             self.error("Connection lost", client_id=client_id)
             return
+        context = self.get_generation_context(client_id)
+        if context.generating and message_type not in (MSG_TYPE.MSG_TYPE_CHUNK, MSG_TYPE.MSG_TYPE_STEP_END, MSG_TYPE.MSG_TYPE_EXCEPTION):
+            # Workflows are stopped at their next step or message
+            context.cancellation.raise_if_cancelled()
         if message_type == MSG_TYPE.MSG_TYPE_STEP:
             ASCIIColors.info("--> Step:"+chunk)
         if message_type == MSG_TYPE.MSG_TYPE_STEP_START:
@@ -945,8 +1413,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
             self.update_message(client_id, "", parameters, metadata, chunk, MSG_TYPE.MSG_TYPE_UI)
 
         if message_type == MSG_TYPE.MSG_TYPE_NEW_MESSAGE:
-            self.nb_received_tokens = 0
-            self.start_time = datetime.now()
+            context.reset_counters()
             self.new_message(
                                     client_id, 
                                     self.personality.name if personality is None else personality.name, 
@@ -965,52 +1432,60 @@ class LOLLMSWebUI(LOLLMSElfServer):
 
         elif message_type == MSG_TYPE.MSG_TYPE_CHUNK:
 
-            if self.nb_received_tokens==0:
-                self.start_time = datetime.now()
+            if context.nb_received_tokens==0:
+                context.start_time = datetime.now()
+                self.tracer.mark("first_token_ms")
                 try:
                     self.update_message(client_id, "✍ warming up ...", msg_type=MSG_TYPE.MSG_TYPE_STEP_END, parameters= {'status':True})
                     self.update_message(client_id, "Generating ...", msg_type=MSG_TYPE.MSG_TYPE_STEP_START)
                 except Exception as ex:
                     ASCIIColors.warning("Couldn't send status update to client")
-            dt =(datetime.now() - self.start_time).seconds
-            if dt==0:
-                dt=1
-            spd = self.nb_received_tokens/dt
-            ASCIIColors.green(f"Received {self.nb_received_tokens} tokens (speed: {spd:.2f}t/s)              ",end="\r",flush=True) 
+            ASCIIColors.green(f"Received {context.nb_received_tokens} tokens (speed: {context.tokens_per_second:.2f}t/s)              ",end="\r",flush=True) 
             sys.stdout = sys.__stdout__
             sys.stdout.flush()
+            buffer = self.get_text_buffer(client_id)
             if chunk:
-                
-                client.generated_text += chunk
-            antiprompt = self.personality.detect_antiprompt(client.generated_text)
-            if antiprompt:
+                # The count is only trusted when the binding reports it, close_message tokenizes the answer otherwise
+                buffer.append(chunk, parameters.get("nb_tokens") if isinstance(parameters, dict) else None)
+            detection = self.detect_streamed_antiprompt(client_id, chunk)
+            if detection:
+                antiprompt, position = detection
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
-                client.generated_text = self.remove_text_from_string(client.generated_text,antiprompt)
-                self.update_message(client_id, client.generated_text, parameters, metadata, None, MSG_TYPE.MSG_TYPE_FULL)
+                self.generation_metrics.antiprompt_stops.inc(self.generation_labels())
+                if position!=-1:
+                    buffer.truncate(position)
+                self.update_message(client_id, self.get_generated_text(client_id), parameters, metadata, None, MSG_TYPE.MSG_TYPE_FULL)
                 return False
             else:
-                self.nb_received_tokens += 1
+                context.nb_received_tokens += 1
+                if context.timer is not None:
+                    self.generation_metrics.chunk(context.timer)
                 if client.continuing and client.first_chunk:
-                    self.update_message(client_id, client.generated_text, parameters, metadata)
+                    self.update_message(client_id, self.get_generated_text(client_id), parameters, metadata)
                 else:
                     self.update_message(client_id, chunk, parameters, metadata, msg_type=MSG_TYPE.MSG_TYPE_CHUNK)
                 client.first_chunk=False
                 # if stop generation is detected then stop
-                if not self.cancel_gen:
+                if not context.cancellation.cancelled:
                     return True
                 else:
-                    self.cancel_gen = False
+                    context.cancellation.mark_stopped()
                     ASCIIColors.warning("Generation canceled")
                     return False
  
         # Stream the generated text to the main process
         elif message_type == MSG_TYPE.MSG_TYPE_FULL:
+            buffer = self.get_text_buffer(client_id)
+            buffer.set(chunk)
             client.generated_text = chunk
-            antiprompt = self.personality.detect_antiprompt(client.generated_text)
-            if antiprompt:
+            detection = self.detect_streamed_antiprompt(client_id, chunk, full_rewrite=True)
+            if detection:
+                antiprompt, position = detection
                 ASCIIColors.warning(f"\n{antiprompt} detected. Stopping generation")
-                client.generated_text = self.remove_text_from_string(client.generated_text,antiprompt)
-                self.update_message(client_id, client.generated_text, parameters, metadata, None, MSG_TYPE.MSG_TYPE_FULL)
+                self.generation_metrics.antiprompt_stops.inc(self.generation_labels())
+                if position!=-1:
+                    buffer.truncate(position)
+                self.update_message(client_id, self.get_generated_text(client_id), parameters, metadata, None, MSG_TYPE.MSG_TYPE_FULL)
                 return False
 
             self.update_message(client_id, chunk,  parameters, metadata, ui=None, msg_type=message_type)
@@ -1026,7 +1501,10 @@ class LOLLMSWebUI(LOLLMSElfServer):
             ASCIIColors.info("Running workflow")
             try:
                 self.personality.callback = callback
-                self.personality.processor.run_workflow(prompt, full_prompt, callback, context_details,client=self.session.get_client(client_id))
+                with self.tracer.span("workflow"):
+                    self.personality.processor.run_workflow(prompt, full_prompt, callback, context_details,client=self.session.get_client(client_id))
+            except GenerationCancelled:
+                ASCIIColors.warning("Workflow canceled")
             except Exception as ex:
                 trace_exception(ex)
                 # Catch the exception and get the traceback as a list of strings
@@ -1044,15 +1522,79 @@ class LOLLMSWebUI(LOLLMSElfServer):
         self._generate(full_prompt, n_predict, client_id, callback)
         ASCIIColors.success("\nFinished executing the generation")
 
+    @staticmethod
+    def kv_states_folder(discussion)->Path:
+        """
+        Folder of the model states spilled for a discussion, None if the discussion has no folder.
+        """
+        discussion_folder = getattr(discussion, "discussion_folder", None)
+        return Path(discussion_folder)/"kv_states" if discussion_folder is not None else None
+
+    def _delete_stale_kv_states(self, started_at:float):
+        try:
+            paths = self.lollms_paths.personal_discussions_path.glob("*/*/kv_states/kv_state_*.bin")
+            # Files written since the start belong to this run
+            deleted = delete_spilled_states(path for path in paths if path.stat().st_mtime<started_at)
+            if deleted>0:
+                ASCIIColors.info(f"Deleted {deleted} model states saved by the previous run")
+        except Exception as ex:
+            trace_exception(ex)
+
+    def forget_discussion(self, discussion):
+        """
+        Drops what the server keeps about a deleted discussion: saved model states (and their files),
+        rolling summary and context windows.
+        """
+        self.kv_state_cache.forget(discussion.discussion_id, self.kv_states_folder(discussion))
+        self.invalidate_discussion_summary(discussion)
+        with self._context_builders_lock:
+            for key in [key for key in self.context_builders if key[0]==discussion.discussion_id]:
+                del self.context_builders[key]
+
+    def start_kv_state_session(self, client, model, prompt:str)->KVStateSession:
+        """
+        Restores the saved model state sharing the longest prefix with the prompt, if the cache is
+        activated and the binding can save its state.
+
+        Returns:
+            KVStateSession: The session to save the state with once generated, or None
+        """
+        if not self.config.kv_state_cache or client is None or client.discussion is None:
+            return None
+        handler = kv_state_handler(model)
+        if handler is None:
+            return None
+        discussion = client.discussion
+        session = KVStateSession(
+                                    self.kv_state_cache,
+                                    handler,
+                                    discussion.discussion_id,
+                                    self.model_key,
+                                    prompt,
+                                    self.kv_states_folder(discussion)
+                                )
+        reused = session.restore()
+        if reused>0:
+            ASCIIColors.info(f"Restored a model state covering {reused}/{len(prompt)} characters of the prompt")
+        return session
+
     def _generate(self, prompt, n_predict, client_id, callback=None):
+        with self.tracer.span("model", n_predict=n_predict, prompt_chars=len(prompt)):
+            return self._generate_with_model(prompt, n_predict, client_id, callback)
+
+    def _generate_with_model(self, prompt, n_predict, client_id, callback=None):
         client = self.session.get_client(client_id)
-        self.nb_received_tokens = 0
-        self.start_time = datetime.now()
-        if self.model is not None:
-            if self.model.binding_type==BindingType.TEXT_IMAGE and len(self.personality.image_files)>0:
+        context = self.get_generation_context(client_id)
+        context.reset_counters()
+        model = context.model if context.model is not None else self.model
+        n_threads = context.n_threads if context.n_threads is not None else self.config['n_threads']
+        if context.timer is not None:
+            self.generation_metrics.generate_started(context.timer)
+        if model is not None:
+            if model.binding_type==BindingType.TEXT_IMAGE and len(self.personality.image_files)>0:
                 ASCIIColors.info(f"warmup for generating up to {n_predict} tokens")
                 if self.config["override_personality_model_parameters"]:
-                    output = self.model.generate_with_images(
+                    output = model.generate_with_images(
                         prompt,
                         self.personality.image_files,
                         callback=callback,
@@ -1063,7 +1605,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         repeat_penalty=self.config['repeat_penalty'],
                         repeat_last_n = self.config['repeat_last_n'],
                         seed=self.config['seed'],
-                        n_threads=self.config['n_threads']
+                        n_threads=n_threads
                     )
                 else:
                     prompt = "\n".join([
@@ -1078,7 +1620,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         "For other queries, I will respond conversationally to the best of my abilities.",
                         prompt
                     ])
-                    output = self.model.generate_with_images(
+                    output = model.generate_with_images(
                         prompt,
                         self.personality.image_files,
                         callback=callback,
@@ -1089,7 +1631,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         repeat_penalty=self.personality.model_repeat_penalty,
                         repeat_last_n = self.personality.model_repeat_last_n,
                         seed=self.config['seed'],
-                        n_threads=self.config['n_threads']
+                        n_threads=n_threads
                     )
                     try:
                         post_processed_output = process_ai_output(output, self.personality.image_files, client.discussion.discussion_folder)
@@ -1099,8 +1641,11 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         ASCIIColors.error(str(ex))                                 
             else:
                 ASCIIColors.info(f"warmup for generating up to {n_predict} tokens")
+                kv_session = self.start_kv_state_session(client, model, prompt)
+                if kv_session is not None:
+                    callback = kv_session.wrap(callback)
                 if self.config["override_personality_model_parameters"]:
-                    output = self.model.generate(
+                    output = model.generate(
                         prompt,
                         callback=callback,
                         n_predict=n_predict,
@@ -1110,10 +1655,10 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         repeat_penalty=self.config['repeat_penalty'],
                         repeat_last_n = self.config['repeat_last_n'],
                         seed=self.config['seed'],
-                        n_threads=self.config['n_threads']
+                        n_threads=n_threads
                     )
                 else:
-                    output = self.model.generate(
+                    output = model.generate(
                         prompt,
                         callback=callback,
                         n_predict=min(n_predict,self.personality.model_n_predicts),
@@ -1123,8 +1668,10 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         repeat_penalty=self.personality.model_repeat_penalty,
                         repeat_last_n = self.personality.model_repeat_last_n,
                         seed=self.config['seed'],
-                        n_threads=self.config['n_threads']
+                        n_threads=n_threads
                     )
+                if kv_session is not None:
+                    kv_session.save(output)
         else:
             print("No model is installed or selected. Please make sure to install a model and select it inside your configuration before attempting to communicate with the model.")
             print("To do this: Install the model to your models/<binding name> folder.")
@@ -1133,14 +1680,758 @@ class LOLLMSWebUI(LOLLMSElfServer):
             output = ""
         return output
 
+    def queue_generation(self, client_id, target, args:tuple=(), continuing:bool=False, generated_text:str=""):
+        """
+        Queues a generation for a client. The generation state of the client is only reset when the
+        request leaves the queue, which the queue only does once the previous generation of the same
+        client has ended (whatever max_concurrent is), so the state is never shared by two generations.
+
+        Returns:
+            GenerationRequest: The queued request or None if the queue is full
+        """
+        def run():
+            client = self.session.get_client(client_id)
+            if client is None:
+                # Disconnected while waiting
+                return
+            client.generated_text = generated_text
+            client.cancel_generation = False
+            client.continuing = continuing
+            client.first_chunk = True
+            target(*args)
+        request = self.generation_queue.submit(client_id, run)
+        # Interactive requests go before the background jobs sharing their model
+        if not self.housekeeping.available:
+            self.background_jobs.preempt()
+        if request is None:
+            self.generation_metrics.busy_rejections.inc(self.generation_labels())
+            self.error("Too many generations are waiting. Come back later.", client_id=client_id)
+        return request
+
+    def new_generation_context(self, client_id, model=None, n_threads:int=None)->GenerationContext:
+        """
+        Creates the context of a new generation of a client, with a fresh cancellation token.
+        """
+        context = GenerationContext(client_id, model if model is not None else self.model, n_threads)
+        self.generation_contexts[client_id] = context
+        return context
+
+    def cancel_generation(self, client_id)->bool:
+        """
+        Stops the running generation of a client and drops its queued ones.
+        The generation stops at its next chunk or workflow step, other clients are not affected.
+
+        Returns:
+            bool: True if a running generation was asked to stop
+        """
+        self.cancel_queued_generation(client_id)
+        context = self.generation_contexts.get(client_id)
+        if context is None or not context.cancellation.cancel():
+            return False
+        ASCIIColors.warning(f"Client {client_id} requested cancelling generation")
+        return True
+
+    def cancel_queued_generation(self, client_id)->int:
+        """
+        Removes the generations of a client that are still waiting in the queue.
+
+        Returns:
+            int: The number of cancelled requests
+        """
+        nb_cancelled = self.generation_queue.cancel(client_id)
+        if nb_cancelled>0:
+            self.emit_bridge.emit('queue_position', {"position": None, "queue_length": self.generation_queue.depth}, to=self.get_stream_route(client_id))
+        return nb_cancelled
+
+    def _on_generation_start(self, request, thread):
+        client = self.session.get_client(request.client_id)
+        if client is not None:
+            client.generation_thread = thread
+        ASCIIColors.info(f"Started generation task of {request.client_id} (waited {time.perf_counter()-request.queued_at:.2f}s)")
+        self.emit_bridge.emit('queue_position', {"position": 0, "queue_length": self.generation_queue.depth}, to=self.get_stream_route(request.client_id))
+
+    def _save_profile(self, profiler:SamplingProfiler, client_id, message_id):
+        """
+        Stops a generation profiler and writes its collapsed stacks to the profiles folder of the discussion.
+        """
+        profiler.stop()
+        client = self.session.get_client(client_id)
+        if client is None or client.discussion is None:
+            return
+        try:
+            path = profiler.write(client.discussion.discussion_folder/"profiles"/f"generation_{message_id}_{int(time.time())}.folded")
+            self.tracer.set_attribute("profile", path.name)
+            ASCIIColors.info(f"Generation profile ({profiler.nb_samples} samples in {profiler.duration:.2f}s) saved to {path}")
+            self.notify(
+                            f"Generation profile saved: {path.name}",
+                            duration=10,
+                            client_id=client_id,
+                            link={"url": f"get_profile?{urlencode({'client_id': client_id, 'name': path.name})}", "label": "Download profile"}
+                        )
+        except Exception as ex:
+            trace_exception(ex)
+
+    async def run_blocking(self, function, *args, **kwargs):
+        """
+        Runs blocking code of a socket.io handler (database, file system, model) on the handlers threads
+        so that the event loop keeps serving the other clients.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.event_executor, partial(function, *args, **kwargs))
+
+    def _on_loop_stall(self, stall):
+        handler = stall.handler or "unknown"
+        self.loop_stalls.inc((handler,))
+        self.loop_stall_duration.observe(stall.duration_ms/1000)
+        ASCIIColors.warning(f"Event loop blocked for {stall.duration_ms:.0f} ms by {handler}" + (f" at {stall.stack[-1]}" if stall.stack else ""))
+
+    def memory_report(self)->dict:
+        """
+        Approximate memory retained by each client session, mounted personality and loaded vector
+        database, and the sessions scheduled for deletion that were never removed.
+        Objects owned by the server (model, configuration, database...) are shared and not counted
+        in the size of the objects referring to them.
+        """
+        shared = {id(self)} | {id(value) for value in vars(self).values()}
+        vectorizers = {}
+        if getattr(self, "long_term_memory", None) is not None:
+            vectorizers["long_term_memory"] = self.long_term_memory
+        personalities = [personality for personality in self.mounted_personalities if personality is not None]
+        for personality in personalities:
+            for attribute in ("persona_data_vectorizer", "vectorizer"):
+                if getattr(personality, attribute, None) is not None:
+                    vectorizers[f"{personality.name}/{attribute}"] = getattr(personality, attribute)
+        clients = list(self.session.clients.items())
+        for client_id, client in clients:
+            if client.discussion is not None and getattr(client.discussion, "vectorizer", None) is not None:
+                vectorizers[f"discussion {client.discussion.discussion_id}"] = client.discussion.vectorizer
+        vectorizer_ids = {id(vectorizer) for vectorizer in vectorizers.values()}
+        personality_ids = {id(personality) for personality in personalities}
+
+        sessions, stale = [], []
+        for client_id, client in clients:
+            sessions.append({
+                "client_id":                client_id,
+                "discussion_id":            client.discussion.discussion_id if client.discussion is not None else None,
+                "processing":               client.processing,
+                "schedule_for_deletion":    client.schedule_for_deletion,
+                "generated_text_chars":     len(client.generated_text or ""),
+                "generation_thread_alive":  client.generation_thread is not None and client.generation_thread.is_alive(),
+                **approximate_size(client, shared | vectorizer_ids | personality_ids)
+            })
+            if client.schedule_for_deletion and not client.processing:
+                stale.append(client_id)
+        return {
+            "sessions":                 sessions,
+            "stale_sessions":           stale,
+            "personalities":            [{"name": personality.name, **approximate_size(personality, shared | vectorizer_ids)} for personality in personalities],
+            "vector_databases":         [{"name": name, **approximate_size(vectorizer, shared)} for name, vectorizer in vectorizers.items()],
+            "server_caches": {
+                "context_builders":     approximate_size(self.context_builders, shared)["bytes"],
+                "tokenization_cache":   approximate_size(self.tokenization_cache, shared)["bytes"],
+                "kv_state_cache":       approximate_size(self.kv_state_cache, shared)["bytes"],
+                "keywords_cache":       approximate_size(self.keywords_cache, shared)["bytes"],
+                "generation_contexts":  len(self.generation_contexts),
+                "stream_routes":        self.stream_routes.to_dict()
+            }
+        }
+
+    def remove_stale_sessions(self)->list:
+        """
+        Removes the sessions scheduled for deletion that are not generating anymore.
+
+        Returns:
+            list: The ids of the removed sessions
+        """
+        removed = []
+        for client_id, client in list(self.session.clients.items()):
+            if client.schedule_for_deletion and not client.processing:
+                self.session.remove_client(client_id, client_id)
+                self.release_message_stream(client_id)
+                if self.session.get_client(client_id) is None:
+                    removed.append(client_id)
+        return removed
+
+    def generation_labels(self)->tuple:
+        """
+        Labels of the generation metrics: binding, model and personality.
+        """
+        return (self.config.binding_name, self.config.model_name, self.personality.name if self.personality is not None else "")
+
+    def _on_generation_idle(self):
+        self.background_jobs.schedule()
+
+    def _title_discussion(self, discussion, client_id, token)->bool:
+        """
+        Background job building the title of a discussion on a free model instance.
+
+        Returns:
+            bool: False if no model instance was free (retried at the next idle time)
+        """
+        ttl = discussion.title()
+        if not (ttl is None or ttl=="" or ttl=="untitled"):
+            return True
+        if not self.model:
+            return False
+        job_id = f"title_{discussion.discussion_id}"
+        done, title = self._run_background_generation(job_id, token, lambda: self.make_discussion_title(discussion, client_id=job_id))
+        if not done:
+            return False
+        if token.cancelled:
+            ASCIIColors.info(f"Title of discussion {discussion.discussion_id} postponed")
+            return False
+        discussion.rename(title)
+        self.emit_bridge.emit('disucssion_renamed',{
+                            'status': True,
+                            'discussion_id':discussion.discussion_id,
+                            'title':title
+                            }, to=self.get_stream_route(client_id)
+        )
+        return True
+
+    def _run_background_generation(self, job_id, token, run):
+        """
+        Runs the generation of a background job on the utility model or on a free model instance,
+        with a generation context job_id stopped by the cancellation token of the job.
+
+        Returns:
+            tuple: (True, result of run()) or (False, None) if no model instance was free
+        """
+        with self.housekeeping.lease() as utility_model:
+            pool, model, n_threads = None, utility_model, self.config.utility_n_threads
+            if model is None:
+                pool = self.get_model_pool()
+                model = pool.acquire(timeout=0) if pool is not None else None
+                if model is None:
+                    return False, None
+                n_threads = pool.threads_per_instance
+                # Instances of the main model also tokenize the texts of the job
+                self._leased_model.model = model
+            try:
+                context = self.new_generation_context(job_id, model, n_threads)
+                context.cancellation = token
+                return True, run()
+            finally:
+                self.generation_contexts.pop(job_id, None)
+                if pool is not None:
+                    self._leased_model.model = None
+                    pool.release(model)
+
+    def _on_queue_position(self, request, position, depth):
+        self.emit_bridge.emit('queue_position', {"position": position, "queue_length": depth}, to=self.get_stream_route(request.client_id))
+
+    def count_tokens(self, text:str):
+        """
+        Tokenizes a text to count its tokens.
+        This is only a fallback for texts whose number of tokens was not reported while generating.
+
+        Returns:
+            int: The number of tokens or None if the model can't tokenize.
+        """
+        try:
+            return len(self.tokenize_cached(text))
+        except Exception as ex:
+            return None
+
+    @property
+    def model_key(self)->str:
+        """
+        Identifies the tokenizer of the current model in the token caches.
+        """
+        return f"{self.config.binding_name}/{self.config.model_name}"
+
+    def tokenize_cached(self, text:str)->list:
+        """
+        Tokenizes a text with the current model, reusing the tokens of the texts already seen.
+        """
+        return self.tokenization_cache.tokenize(self.model_key, text, self.leased_model().tokenize)
+
+    def get_message_token_counts(self)->MessageTokenCounts:
+        """
+        Token counts side table of the current discussions database.
+        """
+        db_name = self.config.discussion_db_name
+        counts = self._message_token_counts.get(db_name)
+        if counts is None:
+            counts = MessageTokenCounts(self.lollms_paths.personal_discussions_path/db_name/"database.db")
+            self._message_token_counts[db_name] = counts
+        return counts
+
+    def invalidate_discussion_context(self, discussion):
+        """
+        Makes the context windows of a discussion check all its messages again after an edit or a deletion.
+        """
+        with self._context_builders_lock:
+            builders = [builder for key, builder in self.context_builders.items() if key[0]==discussion.discussion_id]
+        for builder in builders:
+            builder.invalidate()
+
+    def count_messages_tokens(self, messages:list)->list:
+        """
+        Number of tokens of messages as they appear in a prompt. Only new or edited messages are tokenized.
+
+        Args:
+            messages (list): (message_id, text) tuples.
+        """
+        try:
+            return self.get_message_token_counts().count_messages(messages, self.model_key, lambda text: len(self.tokenize_cached(text)))
+        except Exception as ex:
+            trace_exception(ex)
+            return [len(self.tokenize_cached(text)) for _, text in messages]
+
+    def invalidate_message_tokens(self, message_id:int):
+        try:
+            self.get_message_token_counts().invalidate(message_id)
+        except Exception as ex:
+            trace_exception(ex)
+
+    def start_prompt_generation(self, client_id, prompt:str, sender:str, parent_message_id, created_at=None, generation_type=None, force_using_internet=False):
+        """
+        Adds a user prompt to the discussion of a client then generates the answer.
+        Runs on the generation thread so that the prompt is never tokenized on the socket thread.
+        """
+        client = self.session.get_client(client_id)
+        message = client.discussion.add_message(
+            message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
+            sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
+            sender          = sender,
+            content         = prompt,
+            metadata        = None,
+            parent_message_id=parent_message_id,
+            created_at=created_at if created_at is not None else datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            nb_tokens=self.count_tokens(prompt)
+        )
+        self.start_message_generation(message, message.id, client_id, False, generation_type, force_using_internet)
+
+    def get_generation_context(self, client_id)->GenerationContext:
+        """
+        Returns the context of the generation running for a client.
+        Generations started outside of start_message_generation get one using the main model.
+        """
+        context = self.generation_contexts.get(client_id)
+        if context is None:
+            context = GenerationContext(client_id, self.model)
+            self.generation_contexts[client_id] = context
+        return context
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        # Whoever loads a model (core, binding or model selection), the pool follows it
+        self._model = model
+        if self._model_pool_ready:
+            self.rebuild_model_pool()
+
+    @property
+    def busy(self)->bool:
+        """
+        True while generations hold model instances or an endpoint marked the server busy.
+        """
+        return self._active_generations>0 or self._busy
+
+    @busy.setter
+    def busy(self, value:bool):
+        self._busy = bool(value)
+
+    def get_model_pool(self)->ModelPool:
+        """
+        Returns the pool of model instances of the current model (None if no model is loaded).
+        """
+        with self._model_pool_lock:
+            pool = self.model_pool
+            if pool is None or pool.retired or pool.primary is not self.model or pool.max_size!=max(self.config.model_pool_size, 1):
+                pool = self._replace_model_pool()
+            return pool
+
+    def rebuild_model_pool(self)->ModelPool:
+        """
+        Retires the pool of model instances and starts a new one for the current model.
+        """
+        with self._model_pool_lock:
+            return self._replace_model_pool()
+
+    def _replace_model_pool(self)->ModelPool:
+        # Called with _model_pool_lock held. The new pool starts with the main model only, its other
+        # instances are built on the background lane so that no generation waits for a model load.
+        if self.model_pool is not None:
+            self.model_pool.retire()
+            self.model_pool = None
+        if self.model is None:
+            return None
+        pool = ModelPool(self.model, n_threads=self.config.n_threads, max_size=max(self.config.model_pool_size, 1), dispose=self._dispose_model_instance)
+        self.model_pool = pool
+        self.generation_queue.max_concurrent = pool.size
+        if pool.missing>0:
+            self.worker_lanes.submit("background", self._grow_model_pool, pool)
+        return pool
+
+    def _grow_model_pool(self, pool:ModelPool):
+        """
+        Builds the other instances of a pool with the current binding configuration.
+        """
+        while not pool.retired and pool.missing>0:
+            try:
+                ASCIIColors.yellow(f"Building model instance {pool.size+1}/{pool.max_size}")
+                binding = BindingBuilder().build_binding(self.config, self.lollms_paths, lollmsCom=self)
+                model = ModelBuilder(binding).get_model()
+            except Exception as ex:
+                trace_exception(ex)
+                model = None
+            if model is None:
+                ASCIIColors.warning("Couldn't build another model instance, the pool will be smaller")
+                return
+            with self._model_pool_lock:
+                added = pool.add(model)
+                if added and self.model_pool is pool:
+                    self.generation_queue.max_concurrent = pool.size
+            if not added:
+                # The model changed while the instance was loading
+                self._dispose_model_instance(model)
+                return
+
+    def _dispose_model_instance(self, model):
+        try:
+            if hasattr(model, "destroy_model"):
+                model.destroy_model()
+        except Exception as ex:
+            trace_exception(ex)
+        gc.collect()
+
+    def lease_model(self, primary:bool=False):
+        """
+        Leases an instance of the current model for a generation, waiting for a free one.
+        A lease of a pool retired by a model change is retried on the new pool.
+
+        Returns:
+            tuple: (pool, instance) or (None, None) if no model is loaded
+        """
+        while True:
+            pool = self.get_model_pool()
+            if pool is None:
+                return None, None
+            model = pool.acquire(primary=primary)
+            if model is not None:
+                break
+        with self._active_generations_lock:
+            self._active_generations += 1
+        self._leased_model.model = model
+        return pool, model
+
+    def release_model(self, pool:ModelPool, model):
+        self._leased_model.model = None
+        with self._active_generations_lock:
+            self._active_generations -= 1
+        pool.release(model)
+
+    def leased_model(self):
+        """
+        The model instance leased by the generation running on this thread, the main model otherwise.
+        """
+        model = getattr(self._leased_model, "model", None)
+        return model if model is not None else self.model
+
+    def _utility_model_key(self)->str:
+        if not self.config.utility_binding_name or not self.config.utility_model_name:
+            return ""
+        return f"{self.config.utility_binding_name}/{self.config.utility_model_name}"
+
+    def _load_utility_model(self, key:str):
+        """
+        Builds the utility model from a copy of the configuration using the utility binding and model.
+        """
+        try:
+            ASCIIColors.yellow(f"Loading utility model {key}")
+            # A plain copy of the settings (BaseConfig.copy is missing from older cores), without a file
+            # path so that it never overwrites the configuration file
+            config = LOLLMSConfig(lollms_paths=self.lollms_paths)
+            config.config = dict(self.config.config)
+            config.binding_name = self.config.utility_binding_name
+            config.model_name = self.config.utility_model_name
+            config.n_threads = self.config.utility_n_threads
+            binding = BindingBuilder().build_binding(config, self.lollms_paths, lollmsCom=self)
+            model = ModelBuilder(binding).get_model()
+            if model is not None:
+                ASCIIColors.success(f"Utility model {key} loaded")
+            return model
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.warning("Couldn't load the utility model, housekeeping tasks will use the main model")
+            return None
+
+    def housekeeping_fast_gen(self, prompt:str, max_generation_size:int=None, callback=None)->str:
+        """
+        Short generation for a housekeeping task (translation, title...), on the utility model if one
+        is configured, otherwise on the main model through the personality.
+        """
+        with self.housekeeping.lease() as model:
+            if model is None:
+                return self.personality.fast_gen(prompt, max_generation_size, callback=callback if callback is not None else self.personality.sink)
+            return self.housekeeping.generate(model, prompt, max_generation_size, self.config.ctx_size, callback)
+
+    def prepare_query(self, client_id: str, message_id: int = -1, is_continue: bool = False, n_tokens: int = 0, generation_type = None, force_using_internet=False):
+        """
+        Runs the core query preparation with the search and keywords generations it does through the
+        personality (personality.fast_gen/yes_no) sent to the utility model when one is configured, and
+        the rewriting of the prompt for the documents retrieval handled by build_query_keywords.
+        The utility model is only used by the generations of this thread, the personality is not modified.
+        With summerize_discussion, the messages that don't fit in the prompt are replaced by the rolling
+        summary of the discussion.
+        """
+        personality = self.personality
+        # The search query rewriting goes through build_query_keywords
+        if not getattr(personality.fast_gen, "builds_query_keywords", False):
+            personality.fast_gen = self._keywords_fast_gen(personality.fast_gen)
+            # yes_no and multichoice_question go through personality.generate
+            personality.generate = self._utility_generate(personality.generate)
+        self._preparing_query.client_id = client_id
+        try:
+            with self.housekeeping.lease() as model:
+                self._preparing_query.utility_model = model
+                result = super().prepare_query(client_id, message_id, is_continue, n_tokens=n_tokens, generation_type=generation_type, force_using_internet=force_using_internet)
+        finally:
+            self._preparing_query.client_id = None
+            self._preparing_query.utility_model = None
+        if self.config.summerize_discussion and generation_type!="simple_question":
+            try:
+                with self.tracer.span("discussion_summary"):
+                    result = self._add_discussion_summary(client_id, message_id, result)
+            except Exception as ex:
+                trace_exception(ex)
+        return result
+
+    def get_discussion_summaries(self)->DiscussionSummaries:
+        """
+        Rolling summaries side table of the current discussions database.
+        """
+        db_name = self.config.discussion_db_name
+        summaries = self._discussion_summaries.get(db_name)
+        if summaries is None:
+            summaries = DiscussionSummaries(self.lollms_paths.personal_discussions_path/db_name/"database.db")
+            self._discussion_summaries[db_name] = summaries
+        return summaries
+
+    def invalidate_discussion_summary(self, discussion, message_id:int=None):
+        """
+        Drops the summary of a discussion if it covers an edited or deleted message.
+        """
+        try:
+            self.get_discussion_summaries().invalidate(discussion.discussion_id, message_id)
+        except Exception as ex:
+            trace_exception(ex)
+
+    def _add_discussion_summary(self, client_id, message_id, result):
+        """
+        Puts the rolling summary of the discussion before the messages of the prompt prepared by the core,
+        if some messages were left out, and schedules the folding of the left out messages into the summary.
+        The size of the new prompt is computed from the stored counts of the messages and of the summary
+        and returned in context_details["nb_prompt_tokens"], the prompt is not tokenized again.
+        """
+        prompt_data, content, tokens, context_details, internet_search_infos = result
+        discussion = self.session.get_client(client_id).discussion
+        discussion_messages = context_details.get("discussion_messages", "")
+        position = prompt_data.rfind(discussion_messages)
+        if not discussion_messages or position<0:
+            return result
+        builder = self.get_discussion_context(discussion)
+        n_discussion_tokens = builder.measure(discussion_messages, message_id)
+        if n_discussion_tokens is None:
+            # The core did not put whole messages in the prompt
+            n_discussion_tokens = len(self.tokenize_cached(discussion_messages))
+        if builder.window(upto_message_id=message_id)[1]<=n_discussion_tokens:
+            # The whole discussion is in the prompt
+            return result
+        self._summary_budgets[discussion.discussion_id] = n_discussion_tokens
+        self.background_jobs.submit(("summary", discussion.discussion_id), partial(self._summarize_discussion, discussion))
+        stored = self.get_discussion_summaries().get(discussion.discussion_id)
+        if stored is None:
+            return result
+        _, summary, nb_summary_tokens = stored
+        header = f"\n{self.config.discussion_prompt_separator}discussion summary:\n"
+        summary = header + summary
+        nb_header_tokens = len(self.tokenize_cached(header))
+        text, nb_text_tokens, _ = builder.window(n_discussion_tokens - nb_summary_tokens - nb_header_tokens, message_id)
+        context_details["discussion_messages"] = summary + text
+        context_details["nb_prompt_tokens"] = len(tokens) - n_discussion_tokens + nb_header_tokens + nb_summary_tokens + nb_text_tokens
+        prompt_data = prompt_data[:position] + summary + text + prompt_data[position+len(discussion_messages):]
+        return prompt_data, content, tokens, context_details, internet_search_infos
+
+    def _summarize_discussion(self, discussion, token)->bool:
+        """
+        Background job folding the messages that fell out of the context window into the rolling
+        summary of a discussion, a few messages at a time.
+
+        Returns:
+            bool: False if it was interrupted or no model instance was free (retried at the next idle time)
+        """
+        budget = self._summary_budgets.get(discussion.discussion_id)
+        if budget is None or not self.model:
+            return True
+        # Room kept for the summary in the prompt
+        budget -= self.config.max_summary_size
+        summaries = self.get_discussion_summaries()
+        builder = self.get_discussion_context(discussion)
+        job_id = f"summary_{discussion.discussion_id}"
+        while not token.cancelled:
+            stored = summaries.get(discussion.discussion_id)
+            upto_message_id, summary = (stored[0], stored[1]) if stored is not None else (-1, "")
+            max_tokens = self.config.ctx_size - self.config.max_summary_size - len(self.tokenize_cached(summary_prompt(summary, "", self.config.discussion_prompt_separator)))
+            text, last_message_id = builder.overflow(budget, upto_message_id, max(max_tokens, 1))
+            if last_message_id is None:
+                return True
+            done, summary = self._run_background_generation(job_id, token, lambda: self.make_discussion_summary(summary, text, job_id))
+            if not done or token.cancelled:
+                return False
+            summary = summary.strip()
+            summaries.set(discussion.discussion_id, last_message_id, summary, len(self.tokenize_cached(summary)))
+            ASCIIColors.info(f"Summary of discussion {discussion.discussion_id} updated up to message {last_message_id}")
+        return False
+
+    def make_discussion_summary(self, previous_summary:str, new_messages:str, client_id=None)->str:
+        """
+        Folds messages into the summary of a discussion.
+        The generation stops when the cancellation token of the generation context of client_id is set.
+        """
+        prompt = summary_prompt(previous_summary, new_messages, self.config.discussion_prompt_separator)
+        return self._generate_short_text(prompt, self.config.max_summary_size, client_id)
+
+    def _keywords_fast_gen(self, fast_gen):
+        """
+        Wraps personality.fast_gen so that, while a query is prepared on the same thread, the query
+        rewriting prompts are answered by build_query_keywords and the other prompts by the utility model.
+        """
+        def keywords_fast_gen(prompt, *args, **kwargs):
+            generate = partial(self._utility_fast_gen, fast_gen, prompt, *args, **kwargs)
+            client_id = getattr(self._preparing_query, "client_id", None)
+            if client_id is None or split_rewrite_prompt(prompt) is None:
+                return generate()
+            return self.build_query_keywords(client_id, prompt, generate)
+        keywords_fast_gen.builds_query_keywords = True
+        return keywords_fast_gen
+
+    def _utility_fast_gen(self, fast_gen, prompt, *args, **kwargs)->str:
+        """
+        personality.fast_gen on the utility model leased by the query preparation of this thread, if any.
+        """
+        model = getattr(self._preparing_query, "utility_model", None)
+        if model is None:
+            return fast_gen(prompt, *args, **kwargs)
+        max_generation_size = args[0] if args else kwargs.get("max_generation_size")
+        return self.housekeeping.generate(model, prompt, max_generation_size, self.config.ctx_size, kwargs.get("callback"))
+
+    def _utility_generate(self, generate):
+        """
+        Wraps personality.generate so that the generations of a query preparation (yes_no questions)
+        run on the utility model leased by this thread.
+        """
+        def utility_generate(prompt, max_size, temperature=None, top_k=None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, *args, **kwargs):
+            model = getattr(self._preparing_query, "utility_model", None)
+            if model is None:
+                return generate(prompt, max_size, temperature, top_k, top_p, repeat_penalty, repeat_last_n, callback, *args, **kwargs)
+            gpt_params = {name: value for name, value in (("temperature", temperature), ("top_k", top_k), ("top_p", top_p), ("repeat_penalty", repeat_penalty), ("repeat_last_n", repeat_last_n)) if value is not None}
+            return self.housekeeping.generate(model, prompt, max_size, self.config.ctx_size, callback, **gpt_params)
+        return utility_generate
+
+    def get_document_frequencies(self, client_id)->DocumentFrequencies:
+        """
+        Document frequencies of the words in the chunks of the vector databases used by the generation
+        (discussion documents and personality data), rebuilt when their chunks change.
+        """
+        vectorizers = []
+        client = self.session.get_client(client_id)
+        if client is not None and client.discussion is not None and getattr(client.discussion, "vectorizer", None) is not None:
+            vectorizers.append(client.discussion.vectorizer)
+        if self.personality is not None and getattr(self.personality, "persona_data_vectorizer", None) is not None:
+            vectorizers.append(self.personality.persona_data_vectorizer)
+        signature = tuple((id(vectorizer), len(getattr(vectorizer, "chunks", {}))) for vectorizer in vectorizers)
+        known_signature, frequencies = self._document_frequencies
+        if frequencies is None or known_signature!=signature:
+            frequencies = DocumentFrequencies(
+                chunk["chunk_text"] for vectorizer in vectorizers for chunk in getattr(vectorizer, "chunks", {}).values() if "chunk_text" in chunk
+            )
+            self._document_frequencies = (signature, frequencies)
+        return frequencies, signature
+
+    def build_query_keywords(self, client_id, prompt:str, generate)->str:
+        """
+        Search query of the documents retrieval for a query rewriting prompt of the core.
+        In statistical mode the keywords are extracted from the discussion without using the model,
+        otherwise generate() asks the model to rewrite the prompt. Both are cached by prompt.
+        """
+        with self.tracer.span("query_keywords", mode=self.config.data_vectorization_keys_words_mode):
+            return self._build_query_keywords(client_id, prompt, generate)
+
+    def _build_query_keywords(self, client_id, prompt:str, generate)->str:
+        if self.config.data_vectorization_keys_words_mode=="statistical":
+            messages = split_rewrite_prompt(prompt)
+            if messages:
+                frequencies, signature = self.get_document_frequencies(client_id)
+                context = messages[max(len(messages)-1-self.config.data_vectorization_keys_words_context_messages, 0):-1]
+                return self.keywords_cache.get(
+                    ("statistical", signature, prompt),
+                    lambda: self.keyword_extractor.extract(messages[-1], context, frequencies) or messages[-1]
+                )
+        model_key = self._utility_model_key() if self.housekeeping.available else self.model_key
+        return self.keywords_cache.get(("llm", model_key, prompt), generate)
+
+    def needs_main_model(self, generation_type=None, force_using_internet=False)->bool:
+        """
+        Whether a generation uses the main model outside of the generation itself (scripted personality,
+        internet search or query rewriting run by the core through the personality), in which case it
+        can't run on another instance of the pool.
+        """
+        if self.personality.processor is not None:
+            return True
+        if self.config.activate_internet_search or force_using_internet or generation_type=="full_context_with_internet":
+            return True
+        return self.config.data_vectorization_build_keys_words and self.config.data_vectorization_keys_words_mode!="statistical"
+
     def start_message_generation(self, message, message_id, client_id, is_continue=False, generation_type=None, force_using_internet=False):
+        if self.personality is None:
+            self.warning("Select a personality")
+            return
+        if not self.model:
+            self.error("No model selected. Please make sure you select a model before starting generation", client_id=client_id)
+            return
+        labels = self.generation_labels()
+        with self.tracer.trace("generation", client_id=client_id, message_id=message_id, is_continue=is_continue, generation_type=generation_type, **dict(zip(("binding", "model", "personality"), labels))):
+            # Waiting for a free model instance
+            with self.tracer.span("model_lease"):
+                pool, model = self.lease_model(primary=self.needs_main_model(generation_type, force_using_internet))
+            if model is None:
+                self.error("No model selected. Please make sure you select a model before starting generation", client_id=client_id)
+                return
+            profiler = self.profiling.take(client_id)
+            try:
+                context = self.new_generation_context(client_id, model, pool.threads_per_instance)
+                context.timer = self.generation_metrics.start(labels)
+                try:
+                    return self._start_message_generation(message, message_id, client_id, is_continue, generation_type, force_using_internet)
+                finally:
+                    self.generation_metrics.end(context.timer)
+                    if context.cancellation.cancelled:
+                        self.generation_metrics.cancellations.inc(labels)
+                        self.tracer.set_attribute("cancelled", True)
+                    self.cancellation_stats.record(context.cancellation)
+                    if self.generation_contexts.get(client_id) is context:
+                        del self.generation_contexts[client_id]
+            finally:
+                self.release_model(pool, model)
+                if profiler is not None:
+                    self._save_profile(profiler, client_id, message_id)
+
+    def _start_message_generation(self, message, message_id, client_id, is_continue=False, generation_type=None, force_using_internet=False):
         client = self.session.get_client(client_id)
+        context = self.get_generation_context(client_id)
         if self.personality is None:
             self.warning("Select a personality")
             return
         ASCIIColors.info(f"Text generation requested by client: {client_id}")
         # send the message to the bot
         print(f"Received message : {message.content}")
+        # A buffer left by a message of another discussion must not receive this generation
+        self.close_message_write_behind(client_id)
         if client.discussion:
             try:
                 if not self.model:
@@ -1150,26 +2441,34 @@ class LOLLMSWebUI(LOLLMSElfServer):
                 if is_continue:
                     client.discussion.load_message(message_id)
                     client.generated_text = message.content
+                    self.open_message_write_behind(client_id)
                 else:
                     self.send_refresh(client_id)
                     self.new_message(client_id, self.personality.name, "")
                     self.update_message(client_id, "✍ warming up ...", msg_type=MSG_TYPE.MSG_TYPE_STEP_START)
 
                 # prepare query and reception
-                self.discussion_messages, self.current_message, tokens, context_details, internet_search_infos = self.prepare_query(client_id, message_id, is_continue, n_tokens=self.config.min_n_predict, generation_type=generation_type, force_using_internet=force_using_internet)
+                with self.tracer.span("prepare_query"):
+                    context.discussion_messages, context.current_message, tokens, context_details, internet_search_infos = self.prepare_query(client_id, message_id, is_continue, n_tokens=self.config.min_n_predict, generation_type=generation_type, force_using_internet=force_using_internet)
+                    # Set when the prompt was changed after the core tokenized it
+                    nb_prompt_tokens = context_details.get("nb_prompt_tokens", len(tokens))
+                    self.tracer.set_attribute("prompt_tokens", nb_prompt_tokens)
                 self.prepare_reception(client_id)
-                self.generating = True
+                context.generating = True
                 client.processing=True
                 try:
-                    self.generate(
-                                    self.discussion_messages, 
-                                    self.current_message,
-                                    context_details=context_details,
-                                    n_predict = self.config.ctx_size-len(tokens)-1,
-                                    client_id=client_id,
-                                    callback=partial(self.process_chunk,client_id = client_id)
-                                )
-                    if self.config.enable_voice_service and self.config.auto_read and len(self.personality.audio_samples)>0:
+                    with self.tracer.span("generate"):
+                        self.generate(
+                                        context.discussion_messages, 
+                                        context.current_message,
+                                        context_details=context_details,
+                                        n_predict = self.config.ctx_size-nb_prompt_tokens-1,
+                                        client_id=client_id,
+                                        callback=partial(self.process_chunk,client_id = client_id)
+                                    )
+                        self.tracer.set_attribute("generated_tokens", context.nb_received_tokens)
+                    self.get_generated_text(client_id)
+                    if self.config.enable_voice_service and self.config.auto_read and len(self.personality.audio_samples)>0 and not context.cancellation.cancelled:
                         try:
                             self.process_chunk("Generating voice output",MSG_TYPE.MSG_TYPE_STEP_START,client_id=client_id)
                             from lollms.services.xtts.lollms_xtts import LollmsXTTS
@@ -1186,7 +2485,8 @@ class LOLLMSWebUI(LOLLMSElfServer):
                             fn = self.personality.name.lower().replace(' ',"_").replace('.','')    
                             fn = f"{fn}_{message_id}.wav"
                             url = f"audio/{fn}"
-                            self.tts.tts_to_file(client.generated_text, Path(self.personality.audio_samples[0]).name, f"{fn}", language=language)
+                            with self.tracer.span("tts"):
+                                self.tts.tts_to_file(client.generated_text, Path(self.personality.audio_samples[0]).name, f"{fn}", language=language)
                             fl = f"\n".join([
                             f"<audio controls>",
                             f'    <source src="{url}" type="audio/wav">',
@@ -1195,7 +2495,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                             ])
                             self.process_chunk("Generating voice output", MSG_TYPE.MSG_TYPE_STEP_END, {'status':True},client_id=client_id)
                             self.process_chunk(fl,MSG_TYPE.MSG_TYPE_UI, client_id=client_id)
-                            
+                        
                             """
                             self.info("Creating audio output",10)
                             self.personality.step_start("Creating audio output")
@@ -1209,7 +2509,7 @@ class LOLLMSWebUI(LOLLMSElfServer):
                             tk = self.model.tokenize(client.generated_text)
                             if len(tk)>100:
                                 chunk_size = 100
-                                
+                            
                                 for i in range(0, len(tk), chunk_size):
                                     chunk = self.model.detokenize(tk[i:i+chunk_size])
                                     if i==0:
@@ -1230,16 +2530,18 @@ class LOLLMSWebUI(LOLLMSElfServer):
                     print()
                     ASCIIColors.success("## Done Generation ##")
                     print()
+                except GenerationCancelled:
+                    ASCIIColors.warning("## Generation canceled ##")
                 except Exception as ex:
                     trace_exception(ex)
                     print()
                     ASCIIColors.error("## Generation Error ##")
                     print()
 
-                self.cancel_gen = False
+                context.generating = False
 
                 # Send final message
-                if self.config.activate_internet_search or force_using_internet or generation_type == "full_context_with_internet":
+                if (self.config.activate_internet_search or force_using_internet or generation_type == "full_context_with_internet") and not context.cancellation.cancelled:
                     from lollms.internet import get_favicon_url, get_root_url
                     sources_text = '<div class="mt-4 flex flex-wrap items-center gap-x-2 gap-y-1.5 text-sm ">'
                     sources_text += '<div class="text-gray-400 mr-10px">Sources:</div>'
@@ -1258,12 +2560,13 @@ class LOLLMSWebUI(LOLLMSElfServer):
                         f'</a>',
                         ])
                     sources_text += '</div>'
-                    client.generated_text=client.generated_text.split("!@>")[0] + "\n" + sources_text
+                    client.generated_text=self.get_text_buffer(client_id).visible_text() + "\n" + sources_text
                     self.personality.full(client.generated_text)
             except Exception as ex:
                 trace_exception(ex)
-            self.close_message(client_id)
-            self.update_message(client_id, "Generating ...", msg_type=MSG_TYPE.MSG_TYPE_STEP_END)
+            with self.tracer.span("close_message"):
+                self.close_message(client_id)
+                self.update_message(client_id, "Generating ...", msg_type=MSG_TYPE.MSG_TYPE_STEP_END)
 
             client.processing=False
             if client.schedule_for_deletion:
@@ -1276,26 +2579,17 @@ class LOLLMSWebUI(LOLLMSElfServer):
                 d = client.discussion
                 ttl = d.title()
                 if ttl is None or ttl=="" or ttl=="untitled":
-                    title = self.make_discussion_title(d, client_id=client_id)
-                    d.rename(title)
-                    asyncio.run(
-                        self.sio.emit('disucssion_renamed',{
-                                        'status': True,
-                                        'discussion_id':d.discussion_id,
-                                        'title':title
-                                        }, to=client_id) 
-                    )
-            self.busy=False
+                    # Titled in the background once the model is idle
+                    self.background_jobs.submit(("title", d.discussion_id), partial(self._title_discussion, d, client_id))
+            self.release_message_stream(client_id)
 
         else:
             ump = self.config.discussion_prompt_separator +self.config.user_name.strip() if self.config.use_user_name_in_discussions else self.personality.user_message_prefix
             
-            self.cancel_gen = False
             #No discussion available
             ASCIIColors.warning("No discussion selected!!!")
 
             self.error("No discussion selected!!!", client_id=client_id)
             
             print()
-            self.busy=False
             return ""
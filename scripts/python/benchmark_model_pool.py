@@ -0,0 +1,66 @@
+"""
+project: lollms_webui
+file: benchmark_model_pool.py
+author: ParisNeo
+description:
+    Measures the aggregate generation speed (tokens/s) of the model pool for pool sizes from 1 to N.
+    For each size, that many instances of the configured model generate at the same time, the
+    n_threads of the configuration being split between them as the server does.
+
+    usage: python scripts/python/benchmark_model_pool.py [max_pool_size] [n_predict]
+"""
+import sys
+import threading
+import time
+from pathlib import Path
+
+from ascii_colors import ASCIIColors
+from lollms.paths import LollmsPaths
+from lollms.main_config import LOLLMSConfig
+from lollms.binding import BindingBuilder, ModelBuilder
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+from utilities.model_pool import ModelPool
+
+PROMPT = "!@>user: Write a long story about a robot learning to paint.\n!@>assistant:"
+
+max_pool_size = int(sys.argv[1]) if len(sys.argv)>1 else 4
+n_predict = int(sys.argv[2]) if len(sys.argv)>2 else 128
+
+lollms_paths = LollmsPaths.find_paths(force_local=True, custom_default_cfg_path="configs/config.yaml")
+config = LOLLMSConfig.autoload(lollms_paths)
+
+ASCIIColors.yellow(f"Binding: {config.binding_name} - Model: {config.model_name} - n_threads: {config.n_threads}")
+models = []
+for i in range(max_pool_size):
+    ASCIIColors.yellow(f"Loading model instance {i+1}/{max_pool_size}")
+    binding = BindingBuilder().build_binding(config, lollms_paths)
+    model = ModelBuilder(binding).get_model()
+    if model is None:
+        ASCIIColors.error("Couldn't load the model")
+        break
+    models.append(model)
+
+def run(model, n_threads, counts, index):
+    def callback(chunk, message_type, *args, **kwargs):
+        counts[index] += 1
+        return True
+    model.generate(PROMPT, n_predict, callback, verbose=False, n_threads=n_threads)
+
+results = []
+for size in range(1, len(models)+1):
+    pool = ModelPool(models[0], models[1:size], n_threads=config.n_threads)
+    counts = [0]*size
+    threads = [threading.Thread(target=run, args=(model, pool.threads_per_instance, counts, i)) for i, model in enumerate(pool.instances)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    results.append((size, pool.threads_per_instance, sum(counts), duration))
+    ASCIIColors.green(f"pool size {size}: {sum(counts)} tokens in {duration:.2f}s -> {sum(counts)/duration:.2f} t/s")
+
+ASCIIColors.cyan("pool size | threads/instance | tokens | aggregate t/s")
+for size, n_threads, tokens, duration in results:
+    ASCIIColors.cyan(f"{size:>9} | {str(n_threads):>16} | {tokens:>6} | {tokens/duration:>13.2f}")
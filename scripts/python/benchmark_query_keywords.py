@@ -0,0 +1,86 @@
+"""
+project: lollms_webui
+file: benchmark_query_keywords.py
+author: ParisNeo
+description:
+    Compares the two ways of building the search query of the documents retrieval
+    (data_vectorization_keys_words_mode): the model rewriting the last prompt (llm) and the
+    statistical keywords (statistical).
+    For each question, it measures the time taken to build the query and the overlap between the
+    chunks retrieved with the llm query and with the statistical one (and with the raw question).
+
+    usage: python scripts/python/benchmark_query_keywords.py <document> <questions file, one per line> [top_k]
+"""
+import sys
+import time
+from pathlib import Path
+
+from ascii_colors import ASCIIColors
+from lollms.paths import LollmsPaths
+from lollms.main_config import LOLLMSConfig
+from lollms.binding import BindingBuilder, ModelBuilder
+from safe_store import TextVectorizer, GenericDataLoader, VisualizationMethod
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+from utilities.keyword_extraction import KeywordExtractor, DocumentFrequencies, split_rewrite_prompt
+
+document = Path(sys.argv[1])
+questions = [line.strip() for line in Path(sys.argv[2]).read_text(encoding="utf-8").splitlines() if line.strip()]
+top_k = int(sys.argv[3]) if len(sys.argv)>3 else 3
+
+lollms_paths = LollmsPaths.find_paths(force_local=True, custom_default_cfg_path="configs/config.yaml")
+config = LOLLMSConfig.autoload(lollms_paths)
+
+ASCIIColors.yellow(f"Binding: {config.binding_name} - Model: {config.model_name}")
+binding = BindingBuilder().build_binding(config, lollms_paths)
+model = ModelBuilder(binding).get_model()
+if model is None:
+    ASCIIColors.error("Couldn't load the model")
+    sys.exit(1)
+
+vectorizer = TextVectorizer("tfidf_vectorizer", model=model, save_db=False, data_visualization_method=VisualizationMethod.PCA, database_dict=None)
+vectorizer.add_document(document, GenericDataLoader.read_file(document), config.data_vectorization_chunk_size, config.data_vectorization_overlap_size)
+vectorizer.index()
+frequencies = DocumentFrequencies(chunk["chunk_text"] for chunk in vectorizer.chunks.values())
+extractor = KeywordExtractor(config.data_vectorization_keys_words_count)
+
+def retrieve(query):
+    docs, _, _ = vectorizer.recover_text(query, top_k=top_k)
+    return set(docs)
+
+def overlap(a, b):
+    return len(a & b)/len(a | b) if a | b else 1
+
+def llm_query(prompt):
+    text = [""]
+    def callback(chunk, message_type, *args, **kwargs):
+        text[0] += chunk
+        return True
+    model.generate(prompt, 256, callback)
+    return text[0].strip()
+
+results = {"llm": [], "statistical": [], "overlap": [], "raw_overlap": []}
+for question in questions:
+    # Same prompt as the core builds before the retrieval
+    prompt = f"\n!@>instruction: Read the discussion and rewrite the last prompt for someone who didn't read the entire discussion.\nDo not answer the prompt. Do not add explanations.\n!@>discussion:\n\n!@>user: {question}\n!@>enhanced query: "
+    start = time.perf_counter()
+    rewritten = llm_query(prompt)
+    results["llm"].append(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    messages = split_rewrite_prompt(prompt)
+    keywords = extractor.extract(messages[-1], messages[:-1], frequencies)
+    results["statistical"].append(time.perf_counter()-start)
+
+    llm_chunks = retrieve(rewritten)
+    results["overlap"].append(overlap(llm_chunks, retrieve(keywords)))
+    results["raw_overlap"].append(overlap(llm_chunks, retrieve(question)))
+    ASCIIColors.cyan(f"{question}\n  llm: {rewritten}\n  statistical: {keywords}")
+
+def mean(values):
+    return sum(values)/len(values) if values else 0
+
+ASCIIColors.yellow(f"{len(questions)} questions, top_k={top_k}")
+ASCIIColors.yellow(f"llm query: {mean(results['llm'])*1000:.1f} ms/query")
+ASCIIColors.yellow(f"statistical query: {mean(results['statistical'])*1000:.3f} ms/query")
+ASCIIColors.yellow(f"retrieved chunks overlap with the llm query (jaccard): statistical {mean(results['overlap']):.2f} - raw question {mean(results['raw_overlap']):.2f}")
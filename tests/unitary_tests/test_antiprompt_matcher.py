@@ -0,0 +1,53 @@
+import random
+
+from utilities.antiprompt_matcher import StreamingAntipromptMatcher
+
+
+def reference_stop(chunks, anti_prompts):
+    # Same logic as detect_antiprompt + remove_text_from_string applied after each chunk
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        for prompt in anti_prompts:
+            if prompt.lower() in text.lower():
+                return prompt.lower(), text.lower().find(prompt.lower())
+    return None
+
+
+def streamed_stop(chunks, anti_prompts):
+    matcher = StreamingAntipromptMatcher(anti_prompts)
+    for chunk in chunks:
+        detection = matcher.feed(chunk)
+        if detection:
+            return detection
+    return None
+
+
+def test_detects_antiprompt_split_across_chunks():
+    matcher = StreamingAntipromptMatcher(["!@>"])
+    assert matcher.feed("Hello there !") is None
+    assert matcher.feed("@") is None
+    assert matcher.feed(">user: hi") == ("!@>", 12)
+
+
+def test_list_order_wins_inside_a_chunk():
+    anti_prompts = ["### user", "!@>"]
+    chunks = ["answer ", "!@>ai ### USER"]
+    assert streamed_stop(chunks, anti_prompts) == reference_stop(chunks, anti_prompts) == ("### user", 13)
+
+
+def test_reset_keeps_only_a_bounded_tail():
+    matcher = StreamingAntipromptMatcher(["!@>"])
+    matcher.reset("a long answer ending with !@")
+    assert matcher.feed(">") == ("!@>", 26)
+
+
+def test_matches_reference_on_random_streams():
+    rng = random.Random(0)
+    alphabet = "ab!@>Xx "
+    anti_prompts = ["!@>", "xab", "b!", "aaa"]
+    for _ in range(500):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        cuts = sorted(rng.sample(range(len(text)+1), k=min(len(text)+1, rng.randint(0, 6))))
+        chunks = [text[i:j] for i, j in zip([0]+cuts, cuts+[len(text)])]
+        assert streamed_stop(chunks, anti_prompts) == reference_stop(chunks, anti_prompts)
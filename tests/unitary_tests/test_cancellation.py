@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from utilities.cancellation import CancellationToken, CancellationStats, GenerationCancelled
+
+
+def test_tokens_are_independent():
+    first, second = CancellationToken(), CancellationToken()
+    assert first.cancel()
+    assert not first.cancel()
+    assert first.cancelled and not second.cancelled
+    second.raise_if_cancelled()
+    with pytest.raises(GenerationCancelled):
+        first.raise_if_cancelled()
+    assert first.stopped_at is not None
+
+
+def test_stop_latency_is_recorded_once_the_thread_is_done():
+    token = CancellationToken()
+    stats = CancellationStats()
+    chunks = []
+
+    def callback(chunk):
+        chunks.append(chunk)
+        if token.cancelled:
+            token.mark_stopped()
+            return False
+        return True
+
+    def generate():
+        i = 0
+        while callback(i):
+            i += 1
+            if i==10:
+                token.cancel()
+        stats.record(token)
+
+    thread = threading.Thread(target=generate)
+    thread.start()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert len(chunks) == 11
+    result = stats.to_dict()
+    assert result["cancellations"] == 1
+    assert 0 <= result["max_cancel_stop_ms"] <= result["max_cancel_exit_ms"]
+    stats.record(CancellationToken())
+    assert stats.to_dict()["cancellations"] == 1
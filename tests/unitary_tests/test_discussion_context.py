@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+from utilities.discussion_context import DiscussionContextBuilder
+
+
+def message(id, sender, content):
+    return SimpleNamespace(id=id, sender=sender, content=content)
+
+
+def test_window_fits_the_most_recent_messages():
+    counted = []
+    def count_many(messages):
+        counted.extend(message_id for message_id, _ in messages)
+        return [len(text.split()) for _, text in messages]
+
+    builder = DiscussionContextBuilder("!@>")
+    messages = [message(i, "user" if i%2==0 else "ai", f"message number {i}") for i in range(500)]
+    builder.sync(messages, count_many)
+    assert len(counted) == 500 and builder.nb_tokens == 500*4
+    text, nb_tokens, nb_messages = builder.window(10)
+    assert nb_messages == 2 and nb_tokens == 8
+    assert text == "\n!@>user: message number 498\n!@>ai: message number 499"
+    assert builder.window(upto_message_id=1)[0] == "\n!@>user: message number 0\n!@>ai: message number 1"
+    assert builder.window(max_messages=3)[2] == 3
+
+    # Only new and edited messages are counted again
+    counted.clear()
+    messages.append(message(500, "user", "new"))
+    builder.sync(messages, count_many)
+    assert counted == [500]
+    counted.clear()
+    messages[498] = message(498, "user", "edited")
+    # Older messages are not compared again until an edit is reported
+    builder.sync(messages, count_many)
+    assert counted == []
+    builder.invalidate()
+    builder.sync(messages, count_many)
+    assert counted == [498, 499, 500]
+    counted.clear()
+    builder.sync(messages, count_many)
+    assert counted == []
+    assert builder.window(6)[0] == "\n!@>ai: message number 499\n!@>user: new"
+    # Empty messages don't go in the prompt
+    builder.sync(messages + [message(501, "ai", "")], count_many)
+    assert len(builder) == 501
+
+
+def test_sync_only_formats_the_new_messages():
+    formatted = []
+    def format(message):
+        formatted.append(message.id)
+        return "\n" + message.sender + ": " + message.content
+    builder = DiscussionContextBuilder("!@>", format=format)
+    messages = [message(i, "user", f"message number {i}") for i in range(100)]
+    count_many = lambda items: [len(text.split()) for _, text in items]
+    builder.sync(messages, count_many)
+    formatted.clear()
+    # The last message is still being generated
+    messages.append(message(100, "ai", ""))
+    builder.sync(messages, count_many)
+    assert formatted == [99] and len(builder) == 100
+    formatted.clear()
+    messages[100].content = "the answer"
+    builder.sync(messages, count_many)
+    assert formatted == [100] and len(builder) == 101
+    assert builder.window(3)[0] == "\nai: the answer"
+    # A deleted message is taken into account once reported
+    del messages[50]
+    builder.invalidate()
+    builder.sync(messages, count_many)
+    assert len(builder) == 100 and builder.nb_tokens == 99*4 + 3
+    assert builder.window(upto_message_id=51)[0].count("\n") == 51
+
+
+def test_overflow_returns_the_messages_left_out_of_the_window():
+    builder = DiscussionContextBuilder("!@>")
+    messages = [message(i, "user", f"message number {i}") for i in range(10)]
+    builder.sync(messages, lambda items: [len(text.split()) for _, text in items])
+    # The window of 12 tokens keeps the 3 last messages
+    assert builder.overflow(12) == ("".join(f"\n!@>user: message number {i}" for i in range(7)), 6)
+    assert builder.overflow(12, after_message_id=4) == ("\n!@>user: message number 5\n!@>user: message number 6", 6)
+    assert builder.overflow(12, after_message_id=6) == ("", None)
+    assert builder.overflow(12, max_tokens=9) == ("\n!@>user: message number 0\n!@>user: message number 1", 1)
+    # At least one message even if it is bigger than max_tokens
+    assert builder.overflow(12, max_tokens=1)[1] == 0
+    assert builder.overflow(100) == ("", None)
+
+
+def test_message_format_hook():
+    builder = DiscussionContextBuilder("!@>", lambda message: True, lambda message: "\n" + ("ai: " if message.sender=="lollms" else "user: ") + message.content)
+    builder.sync([message(1, "user", "hello"), message(2, "lollms", ""), message(3, "lollms", "hi")], lambda texts: [len(text.split()) for _, text in texts])
+    assert builder.window()[0] == "\nuser: hello\nai: \nai: hi"
+
+
+def test_measure_counts_the_last_messages_from_the_stored_counts():
+    builder = DiscussionContextBuilder("!@>")
+    messages = [message(i, "user", f"message number {i}") for i in range(10)]
+    builder.sync(messages, lambda items: [len(text.split()) for _, text in items])
+    text, nb_tokens, _ = builder.window(12)
+    assert builder.measure(text) == nb_tokens == 12
+    assert builder.measure(builder.window(8, upto_message_id=5)[0], 5) == 8
+    assert builder.measure("") == 0
+    # Not made of whole messages
+    assert builder.measure(text[1:]) is None
+    assert builder.measure("x" + text) is None
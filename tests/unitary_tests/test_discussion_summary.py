@@ -0,0 +1,24 @@
+from utilities.discussion_summary import DiscussionSummaries, summary_prompt
+
+
+def test_summaries_are_persisted_and_invalidated(tmp_path):
+    db_path = tmp_path/"database.db"
+    summaries = DiscussionSummaries(db_path)
+    assert summaries.get(1) is None
+    summaries.set(1, 10, "the user wants a poem", 5)
+    summaries.set(2, 20, "the user asks about python", 6)
+    assert DiscussionSummaries(db_path).get(1) == (10, "the user wants a poem", 5)
+    # Edited message after the summarized ones
+    summaries.invalidate(1, 11)
+    assert summaries.get(1) is not None
+    summaries.invalidate(1, 7)
+    assert summaries.get(1) is None
+    summaries.invalidate(2)
+    assert summaries.get(2) is None
+
+
+def test_summary_prompt():
+    prompt = summary_prompt("", "\n!@>user: hello")
+    assert "previous summary" not in prompt
+    assert prompt.endswith("!@>new messages:\n!@>user: hello\n!@>updated summary:\n")
+    assert "!@>previous summary:\nold\n" in summary_prompt("old", "\n!@>user: hello")
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+from utilities.emit_bridge import EmitBridge
+
+
+def test_per_client_order_round_robin_and_merge():
+    sent = []
+
+    async def emit(event, data, to=None):
+        sent.append((to, data))
+
+    def merge(queued, data):
+        return queued + data if queued.startswith("chunk") else None
+
+    async def scenario():
+        bridge = EmitBridge(emit)
+        # Queued from a worker thread before the drain task runs
+        def produce():
+            bridge.emit("update", "chunk a", to="A", merge=merge)
+            bridge.emit("update", " b", to="A", merge=merge)
+            bridge.emit("update", "step", to="A")
+            bridge.emit("update", "chunk x", to="B", merge=merge)
+        worker = threading.Thread(target=produce)
+        worker.start()
+        worker.join()
+        bridge.start(asyncio.get_running_loop())
+        for _ in range(20):
+            await asyncio.sleep(0)
+        return bridge
+
+    bridge = asyncio.run(scenario())
+    assert sent == [("A", "chunk a b"), ("B", "chunk x"), ("A", "step")]
+    stats = bridge.stats.to_dict()
+    assert stats["frames_merged"]==1 and stats["frames_sent"]==3 and bridge.depth==0
+
+
+def test_full_queue_drops_frames_emitted_from_the_loop():
+    async def emit(event, data, to=None):
+        pass
+
+    async def scenario():
+        bridge = EmitBridge(emit, max_pending=1)
+        bridge.start(asyncio.get_running_loop())
+        assert bridge.emit("update", 1, to="A")
+        assert not bridge.emit("update", 2, to="A")
+        return bridge
+
+    assert asyncio.run(scenario()).stats.frames_dropped==1
+
+
+def test_full_queue_never_drops_message_contents():
+    sent = []
+
+    async def emit(event, data, to=None):
+        sent.append((event, to, data))
+
+    def merge(queued, data):
+        return queued + data if queued.startswith("chunk") else None
+
+    async def scenario():
+        bridge = EmitBridge(emit, max_pending=2, block_timeout_ms=0)
+        def produce():
+            bridge.emit("notification", "busy", to="B")
+            bridge.emit("update", "step", to="A", merge=merge, lossless=True)
+            # The queue is full: the content goes over the limit, the next chunks are merged into it
+            assert bridge.emit("update", "chunk a", to="A", merge=merge, lossless=True)
+            assert bridge.emit("update", " b", to="A", merge=merge, lossless=True)
+            assert not bridge.emit("notification", "dropped", to="B")
+        worker = threading.Thread(target=produce)
+        worker.start()
+        worker.join()
+        bridge.start(asyncio.get_running_loop())
+        for _ in range(20):
+            await asyncio.sleep(0)
+        return bridge
+
+    bridge = asyncio.run(scenario())
+    assert [data for event, to, data in sent if to=="A"] == ["step", "chunk a b"]
+    stats = bridge.stats.to_dict()
+    assert stats["frames_over_limit"]==1 and stats["frames_dropped"]==1 and bridge.depth==0
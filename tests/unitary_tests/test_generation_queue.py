@@ -0,0 +1,67 @@
+import threading
+
+from utilities.generation_queue import GenerationQueue
+
+
+def test_round_robin_positions_and_cancel():
+    started = []
+    positions = {}
+    running = threading.Event()
+    release = threading.Event()
+    done = threading.Semaphore(0)
+
+    def generate(name):
+        started.append(name)
+        if name=="a1":
+            running.set()
+            release.wait(5)
+        done.release()
+
+    queue = GenerationQueue(max_depth=4, on_position=lambda request, position, depth: positions.__setitem__(request.args[0], position))
+    queue.submit("A", generate, ("a1",))
+    # Wait for a1 to run so that the next requests have to queue
+    assert running.wait(5)
+    for client_id, name in [("A", "a2"), ("A", "a3"), ("B", "b1"), ("C", "c1")]:
+        assert queue.submit(client_id, generate, (name,)) is not None
+    assert queue.submit("D", generate, ("d1",)) is None
+    positions.pop("a1")
+    assert positions == {"a2":1, "b1":2, "c1":3, "a3":4}
+    assert queue.cancel("C")==1
+    assert positions["a3"]==3
+    release.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    assert started == ["a1", "a2", "b1", "a3"]
+
+
+def test_a_client_never_runs_two_generations_at_once():
+    active = {}
+    overlaps = []
+    started = []
+    lock = threading.Lock()
+    release = threading.Event()
+    done = threading.Semaphore(0)
+
+    def generate(client_id, name):
+        with lock:
+            if active.get(client_id):
+                overlaps.append(name)
+            active[client_id] = True
+            started.append(name)
+        if name=="a1":
+            release.wait(5)
+        with lock:
+            active[client_id] = False
+        done.release()
+
+    queue = GenerationQueue(max_depth=4, max_concurrent=2)
+    for client_id, name in [("A", "a1"), ("A", "a2"), ("B", "b1")]:
+        assert queue.submit(client_id, generate, (client_id, name)) is not None
+    # a2 waits for a1 even though a worker is free, b1 takes it
+    assert done.acquire(timeout=5)
+    assert sorted(started) == ["a1", "b1"]
+    release.set()
+    for _ in range(2):
+        assert done.acquire(timeout=5)
+    assert started[2] == "a2"
+    assert overlaps == []
@@ -0,0 +1,71 @@
+from utilities.housekeeping import HousekeepingRouter
+
+
+class FakeModel:
+    def __init__(self, name):
+        self.name = name
+
+    def tokenize(self, text):
+        return text.split()
+
+    def generate(self, prompt, n_predict, callback, **kwargs):
+        self.n_predict = n_predict
+        for chunk in ["<s>", " short", " title", "</s>"]:
+            if not callback(chunk, 0):
+                break
+
+
+def test_falls_back_to_the_main_model_without_utility_model():
+    router = HousekeepingRouter(lambda: "", lambda key: FakeModel(key))
+    with router.lease() as model:
+        assert model is None
+    assert not router.available
+    assert router.to_dict()["fallback_generations"] == 1
+
+
+def test_utility_model_is_loaded_once_and_reloaded_on_change():
+    key = ["tiny/a"]
+    loads = []
+    def load(k):
+        loads.append(k)
+        return FakeModel(k)
+    router = HousekeepingRouter(lambda: key[0], load)
+    with router.lease() as model:
+        assert model.name == "tiny/a"
+    with router.lease() as model:
+        assert model.name == "tiny/a"
+    assert loads == ["tiny/a"]
+    assert router.available
+    key[0] = "tiny/b"
+    assert not router.available
+    with router.lease() as model:
+        assert model.name == "tiny/b"
+    key[0] = ""
+    with router.lease() as model:
+        assert model is None
+    stats = router.to_dict()
+    assert stats["utility_generations"] == 3 and stats["fallback_generations"] == 1
+
+
+def test_failed_load_falls_back():
+    def load(key):
+        raise RuntimeError("no such model")
+    router = HousekeepingRouter(lambda: "tiny/a", load)
+    with router.lease() as model:
+        assert model is None
+    # Not retried until the configuration changes
+    assert router.get_model() is None
+
+
+def test_generate_bounds_the_size_and_cleans_the_text():
+    router = HousekeepingRouter(lambda: "tiny/a", lambda key: FakeModel(key))
+    chunks = []
+    with router.lease() as model:
+        text = router.generate(model, "a b c d", 100, 10, callback=lambda chunk, message_type: chunks.append(chunk) or True)
+    assert text == "short title"
+    assert model.n_predict == 6
+    assert len(chunks) == 4
+    # A sink returning None doesn't stop the generation, False does
+    with router.lease() as model:
+        assert router.generate(model, "a", 100, 10, callback=lambda chunk, message_type: None) == "short title"
+        assert router.generate(model, "a", 100, 10, callback=lambda chunk, message_type: False) == ""
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from utilities.idle_jobs import IdleJobQueue
+from utilities.worker_lanes import WorkerLane
+
+
+def test_jobs_run_when_idle_and_are_preempted():
+    idle = threading.Event()
+    started = threading.Event()
+    finished = threading.Semaphore(0)
+    runs = []
+
+    def job(name):
+        def run(token):
+            runs.append(name)
+            if name=="slow" and len(runs)==1:
+                started.set()
+                # Stops at the next chunk once pre-empted
+                while not token.cancelled:
+                    token._event.wait(0.01)
+            finished.release()
+            return True
+        return run
+
+    jobs = IdleJobQueue(WorkerLane("background", 1, None), idle.is_set, batch_size=4)
+    jobs.submit("slow", job("slow"))
+    jobs.submit("other", job("other"))
+    assert runs == []
+    idle.set()
+    jobs.schedule()
+    assert started.wait(5)
+    # An interactive request arrives
+    idle.clear()
+    jobs.preempt()
+    assert finished.acquire(timeout=5)
+    # The pre-empted job goes back to the front of the queue
+    deadline = time.time() + 5
+    while jobs.to_dict()["job_running"] and time.time()<deadline:
+        time.sleep(0.01)
+    assert jobs.to_dict()["jobs_pending"] == 2
+    idle.set()
+    jobs.schedule()
+    for _ in range(2):
+        assert finished.acquire(timeout=5)
+    assert runs == ["slow", "slow", "other"]
+    stats = jobs.to_dict()
+    assert stats["jobs_completed"] == 2 and stats["jobs_preempted"] == 1
@@ -0,0 +1,55 @@
+from utilities.keyword_extraction import KeywordExtractor, KeywordCache, DocumentFrequencies, split_rewrite_prompt, words
+
+PROMPT = (
+    "\n!@>instruction: Read the discussion and rewrite the last prompt for someone who didn't read the entire discussion.\n"
+    "Do not answer the prompt. Do not add explanations.\n!@>discussion:\n"
+    "\n!@>user: I am configuring the vector database of my documents."
+    "\n!@>lollms: Sure, what do you need?"
+    "\n!@>user: How do I change the chunk size of the vectorizer?\n!@>enhanced query: "
+)
+
+
+def test_split_rewrite_prompt():
+    messages = split_rewrite_prompt(PROMPT)
+    assert messages == [
+        "I am configuring the vector database of my documents.",
+        "Sure, what do you need?",
+        "How do I change the chunk size of the vectorizer?"
+    ]
+    assert split_rewrite_prompt("!@>user: translate this\n!@>translation:") is None
+
+
+def test_words_drop_stop_words():
+    assert words("How do I change the Chunk size, 42 times?") == ["change", "chunk", "size", "times"]
+
+
+def test_extract_prefers_discriminating_words():
+    frequencies = DocumentFrequencies([
+        "the chunk size sets the number of characters of each chunk",
+        "the vectorizer turns each document into vectors",
+        "documents are split then vectorized",
+        "change the model in the settings",
+        "change the personality in the settings",
+    ])
+    messages = split_rewrite_prompt(PROMPT)
+    keywords = KeywordExtractor(max_keywords=3).extract(messages[-1], messages[:-1], frequencies).split()
+    assert "chunk" in keywords and "size" in keywords
+    assert "change" not in keywords
+    # Order of appearance in the prompt
+    assert keywords.index("chunk") < keywords.index("size")
+
+
+def test_keyword_cache():
+    cache = KeywordCache(max_entries=1)
+    calls = []
+    def build(result):
+        def run():
+            calls.append(result)
+            return result
+        return run
+    assert cache.get(("llm", "model", PROMPT), build("chunk size")) == "chunk size"
+    assert cache.get(("llm", "model", PROMPT), build("other")) == "chunk size"
+    assert cache.get(("llm", "model", "another prompt"), build("other")) == "other"
+    assert cache.get(("llm", "model", PROMPT), build("again")) == "again"
+    assert calls == ["chunk size", "other", "again"]
+    assert cache.to_dict()["keywords_cache_hits"] == 1
@@ -0,0 +1,67 @@
+from utilities.kv_state_cache import KVStateCache, KVStateSession, kv_state_handler, delete_spilled_states
+
+
+class FakeLlama:
+    def __init__(self):
+        self.state = None
+        self.loaded = None
+
+    def save_state(self):
+        return {"tokens": self.state}
+
+    def load_state(self, state):
+        self.loaded = state
+
+
+class FakeBinding:
+    def __init__(self):
+        self.model = FakeLlama()
+
+
+def test_follow_up_and_regenerate_reuse_the_longest_prefix(tmp_path):
+    cache = KVStateCache(max_entries=1, max_entries_per_discussion=2, min_prefix=10)
+    binding = FakeBinding()
+    handler = kv_state_handler(binding)
+    assert handler is not None and kv_state_handler(object()) is None
+
+    prompt = "!@>system: be nice\n!@>user: hello\n!@>assistant:"
+    session = KVStateSession(cache, handler, 1, "m", prompt, tmp_path)
+    assert session.restore() == 0
+    binding.model.state = "first"
+    session.wrap(lambda chunk: True)("Hi")
+    session.save(" Hi there")
+
+    # Follow-up of the same discussion
+    follow_up = prompt + " Hi there\n!@>user: how are you?\n!@>assistant:"
+    session = KVStateSession(cache, handler, 1, "m", follow_up, tmp_path)
+    assert session.restore() == len(prompt + " Hi there")
+    assert binding.model.loaded == {"tokens": "first"}
+    binding.model.state = "second"
+    session.save(" Fine")
+    # The first state left the memory for the disk
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Regenerating the first answer restores the spilled state
+    binding.model.loaded = None
+    session = KVStateSession(cache, handler, 1, "m", prompt, tmp_path)
+    assert session.restore() == len(prompt)
+    assert binding.model.loaded is not None
+    # Other discussions and models don't share states
+    assert cache.lookup(2, "m", prompt) == (None, 0)
+    assert cache.lookup(1, "other", prompt) == (None, 0)
+    stats = cache.stats.to_dict()
+    assert stats["kv_lookups"] == 5 and stats["kv_prefix_hit_rate"] == 2/5
+
+
+def test_forget_deletes_the_spilled_states(tmp_path):
+    cache = KVStateCache(max_entries=1, max_entries_per_discussion=2, min_prefix=1)
+    cache.store(1, "m", "first text", "first", tmp_path)
+    cache.store(1, "m", "second text", "second", tmp_path)
+    assert len(list(tmp_path.glob("kv_state_*.bin"))) == 1
+    # A file left by a previous run is not indexed
+    (tmp_path/"kv_state_0_0.bin").write_bytes(b"old")
+    cache.forget(1, tmp_path)
+    assert list(tmp_path.glob("kv_state_*.bin")) == []
+    assert cache.lookup(1, "m", "second text") == (None, 0)
+    (tmp_path/"kv_state_1_1.bin").write_bytes(b"old")
+    assert delete_spilled_states(tmp_path.glob("kv_state_*.bin")) == 1
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from utilities.loop_monitor import LoopLagMonitor
+
+
+def blocking_handler(sid, data):
+    time.sleep(0.3)
+
+
+async def async_blocking_handler(sid, data):
+    await asyncio.sleep(0)
+    time.sleep(0.3)
+
+
+def test_stall_is_named_after_its_handler():
+    stalls = []
+    monitor = LoopLagMonitor(threshold_ms=100, interval_ms=10, on_stall=stalls.append)
+    monitor.register_socketio_handlers({"/": {"add_webpage": blocking_handler, "load_discussion": async_blocking_handler}})
+
+    async def main():
+        monitor.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.05)
+        blocking_handler(None, None)
+        await asyncio.sleep(0.05)
+        await async_blocking_handler(None, None)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    asyncio.run(main())
+    assert [stall.handler for stall in stalls] == ["add_webpage", "load_discussion"]
+    assert all(stall.duration_ms>=250 for stall in stalls)
+    assert monitor.last(1)[0]["handler"] == "load_discussion"
+    assert monitor.to_dict()["nb_stalls"] == 2
+
+
+def test_no_stall_when_the_loop_is_free():
+    monitor = LoopLagMonitor(threshold_ms=100, interval_ms=10)
+
+    async def main():
+        monitor.start(asyncio.get_running_loop())
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+        monitor.stop()
+
+    asyncio.run(main())
+    assert monitor.nb_stalls == 0
+    assert monitor.last() == []
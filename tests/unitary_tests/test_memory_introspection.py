@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+from utilities.memory_introspection import TracemallocSnapshots, approximate_size
+
+
+def test_approximate_size_skips_shared_objects():
+    shared_model = SimpleNamespace(weights=bytearray(1_000_000))
+    client = SimpleNamespace(generated_text="x"*10_000, model=shared_model)
+    with_model = approximate_size(client)
+    without_model = approximate_size(client, {id(shared_model)})
+    assert with_model["bytes"] > 1_000_000
+    assert 10_000 < without_model["bytes"] < 100_000
+    assert not without_model["truncated"]
+    assert approximate_size([list(range(100)) for _ in range(100)], max_objects=50)["truncated"]
+
+
+def test_snapshots_diff():
+    snapshots = TracemallocSnapshots(max_snapshots=2)
+    try:
+        first = snapshots.take()
+        retained = [bytearray(1000) for _ in range(1000)]
+        second = snapshots.take()
+        diff = snapshots.diff(first, second, limit=5)
+        assert diff[0]["bytes_diff"] >= 1_000_000
+        assert "test_memory_introspection.py" in diff[0]["location"]
+        assert snapshots.top(second, limit=3)
+        third = snapshots.take()
+        # Only the last two snapshots are kept
+        assert [snapshot["id"] for snapshot in snapshots.list()] == [second, third]
+    finally:
+        snapshots.stop()
+    assert not snapshots.tracing
@@ -0,0 +1,43 @@
+from utilities.message_write_behind import MessageWriteBehind, WriteBehindStats
+from utilities.text_buffer import GeneratedTextBuffer
+
+
+class FakeDiscussion:
+    def __init__(self):
+        self.writes = []
+
+    def update_message(self, new_content, **kwargs):
+        self.writes.append((new_content, kwargs))
+
+
+def test_updates_are_checkpointed_at_interval():
+    discussion = FakeDiscussion()
+    stats = WriteBehindStats()
+    write_behind = MessageWriteBehind(discussion.update_message, interval_ms=60000, stats=stats)
+    for text in ["a", "ab", "abc"]:
+        write_behind.update(text, nb_tokens=len(text))
+    assert discussion.writes == []
+    write_behind.flush()
+    assert discussion.writes == [("abc", {"nb_tokens": 3})]
+    assert stats.to_dict() == {"db_writes": 1, "db_writes_saved": 2}
+
+
+def test_close_writes_the_trimmed_text_when_a_marker_appears_mid_stream():
+    discussion = FakeDiscussion()
+    buffer = GeneratedTextBuffer()
+    write_behind = MessageWriteBehind(discussion.update_message, interval_ms=60000)
+    for chunk in ["The answer", " is 42.", "\n!@>user:", " thanks"]:
+        buffer.append(chunk)
+        write_behind.update(lambda: buffer.text, new_metadata="{}", nb_tokens=len(buffer))
+    assert discussion.writes == []
+    write_behind.close(buffer.visible_text(), nb_tokens=5)
+    assert discussion.writes == [("The answer is 42.\n", {"new_metadata": "{}", "nb_tokens": 5})]
+    # The checkpoint that held the hallucinated tail is gone
+    write_behind.flush()
+    assert len(discussion.writes) == 1
+
+
+def test_close_does_nothing_for_a_message_never_updated():
+    discussion = FakeDiscussion()
+    MessageWriteBehind(discussion.update_message).close("", nb_tokens=0)
+    assert discussion.writes == []
@@ -0,0 +1,38 @@
+import time
+
+from utilities.metrics import GenerationMetrics, Histogram, format_labels
+
+
+def test_histogram_buckets_are_cumulated():
+    histogram = Histogram("latency_seconds", "Latency.", (0.1, 1), ("model",))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, ("a",))
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{model="a",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{model="a",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{model="a",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{model="a"} 4' in lines
+
+
+def test_label_values_are_escaped():
+    assert format_labels(("model",), ('my "model"\n',)) == '{model="my \\"model\\"\\n"}'
+
+
+def test_generation_metrics():
+    metrics = GenerationMetrics()
+    labels = ("binding", "model", "personality")
+    timer = metrics.start(labels)
+    metrics.generate_started(timer)
+    for _ in range(5):
+        time.sleep(0.001)
+        metrics.chunk(timer)
+    metrics.end(timer)
+    metrics.cancellations.inc(labels)
+    assert metrics.requests.value(labels) == 1
+    assert metrics.ttft.count(labels) == 1
+    assert metrics.prefill.count(labels) == 1
+    assert metrics.inter_token.count(labels) == 4
+    assert metrics.tokens_per_second.count(labels) == 1
+    text = metrics.render()
+    assert 'lollms_generation_cancellations_total{binding="binding",model="model",personality="personality"} 1' in text
+    assert "# TYPE lollms_generation_duration_seconds histogram" in text
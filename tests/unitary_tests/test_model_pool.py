@@ -0,0 +1,59 @@
+import threading
+
+from utilities.model_pool import ModelPool
+
+
+def test_secondary_instances_are_leased_first():
+    pool = ModelPool("main", ["second", "third"], n_threads=8)
+    assert pool.threads_per_instance == 2
+    with pool.lease() as first, pool.lease() as second:
+        assert {first, second} == {"second", "third"}
+        with pool.lease(primary=True) as main:
+            assert main == "main"
+            assert pool.acquire(timeout=0.01) is None
+    assert pool.idle
+
+
+def test_primary_lease_waits_for_the_main_model():
+    pool = ModelPool("main", ["second"], n_threads=3)
+    assert pool.threads_per_instance == 1
+    main = pool.acquire(primary=True)
+    leased = []
+    waiter = threading.Thread(target=lambda: leased.append(pool.acquire(primary=True)))
+    waiter.start()
+    waiter.join(0.05)
+    assert leased == []
+    pool.release(main)
+    waiter.join(1)
+    assert leased == ["main"]
+    assert ModelPool("main").threads_per_instance is None
+
+
+def test_retired_pool_disposes_of_its_instances():
+    disposed = []
+    pool = ModelPool("main", ["second", "third"], dispose=disposed.append)
+    leased = pool.acquire()
+    waiting = []
+    waiter = threading.Thread(target=lambda: waiting.append(pool.acquire(primary=True, timeout=1)))
+    main = pool.acquire(primary=True)
+    waiter.start()
+    pool.retire()
+    waiter.join(1)
+    # Waiting leases are refused, the free instance is disposed of now and the leased one when released
+    assert waiting == [None]
+    assert pool.acquire(timeout=0) is None
+    assert disposed == ["third"]
+    pool.release(leased)
+    pool.release(main)
+    assert disposed == ["third", "second"]
+
+
+def test_pool_grows_up_to_its_size():
+    pool = ModelPool("main", n_threads=8, max_size=2)
+    assert pool.threads_per_instance == 4
+    assert pool.missing == 1
+    assert pool.add("second")
+    assert not pool.add("third")
+    assert pool.acquire() == "second"
+    pool.retire()
+    assert not pool.add("fourth")
@@ -0,0 +1,38 @@
+import threading
+import time
+
+from utilities.sampling_profiler import ProfilingSwitch, SamplingProfiler
+
+
+def busy_function(duration):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler_samples_the_generation_thread(tmp_path):
+    profiler = SamplingProfiler(threading.get_ident(), interval=0.001).start()
+    busy_function(0.1)
+    samples = profiler.stop()
+    assert profiler.nb_samples > 0
+    assert any("busy_function (test_sampling_profiler.py:" in stack for stack in samples)
+    path = profiler.write(tmp_path/"profiles"/"generation.folded")
+    line = path.read_text().splitlines()[0]
+    stack, count = line.rsplit(" ", 1)
+    assert ";" in stack and int(count) > 0
+
+
+def test_switch_profiles_the_next_generations():
+    switch = ProfilingSwitch()
+    assert switch.take("a") is None
+    switch.arm(2, client_id="a", interval_ms=1)
+    assert switch.take("b") is None
+    first = switch.take("a")
+    second = switch.take("a")
+    assert first is not None and second is not None
+    first.stop(), second.stop()
+    assert switch.take("a") is None
+    assert switch.to_dict()["armed"] is False and switch.to_dict()["profiled"] == 2
+    switch.arm(5)
+    switch.disarm()
+    assert switch.take("a") is None
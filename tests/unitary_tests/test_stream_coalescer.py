@@ -0,0 +1,40 @@
+import time
+
+from utilities.stream_coalescer import StreamCoalescer, StreamingStats
+
+
+def test_first_chunk_is_sent_immediately_then_coalesced():
+    frames = []
+    coalescer = StreamCoalescer(frames.append, interval_ms=10000, max_bytes=1024)
+    coalescer.push("Hello")
+    coalescer.push(" world")
+    coalescer.push("!")
+    assert frames == ["Hello"]
+    coalescer.flush()
+    assert frames == ["Hello", " world!"]
+
+
+def test_size_window_triggers_flush():
+    frames = []
+    coalescer = StreamCoalescer(frames.append, interval_ms=10000, max_bytes=4)
+    for chunk in ["a", "b", "c", "d", "e"]:
+        coalescer.push(chunk)
+    assert frames == ["a", "bcde"]
+
+
+def test_stalled_buffer_is_flushed_by_ticker():
+    frames = []
+    stats = StreamingStats()
+    coalescer = StreamCoalescer(frames.append, interval_ms=5, max_bytes=1024, stats=stats)
+    coalescer.push("a")
+    coalescer.push("b")
+    coalescer.flush_if_due()
+    assert frames == ["a"]
+    time.sleep(0.01)
+    coalescer.flush_if_due()
+    coalescer.close()
+    assert frames == ["a", "b"]
+    infos = stats.to_dict()
+    assert infos["chunks_received"] == 2
+    assert infos["frames_emitted"] == 2
+    assert infos["nb_messages"] == 1
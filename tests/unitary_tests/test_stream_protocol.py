@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+from utilities.stream_protocol import MessageStreamEncoder, StreamRoutes, negotiate_protocol, text_splice, apply_splice, msgpack, FRAME_CHUNK, FRAME_DIFF, FRAME_HEADER, FRAME_RESYNC
+
+
+def test_frames_only_carry_what_changed():
+    encoder = MessageStreamEncoder(7)
+    header = encoder.header(sender="lollms", metadata=[], parameters=None)
+    assert header["t"]==FRAME_HEADER and header["s"]==0
+    assert encoder.chunk("Hel", None, []) == {"t":FRAME_CHUNK, "id":7, "s":1, "c":"Hel"}
+    frame = encoder.chunk("lo", None, [{"title":"source"}])
+    assert frame["m"]==[{"title":"source"}] and "p" not in frame
+    assert "m" not in encoder.chunk("!", None, [{"title":"source"}])
+
+
+def test_negotiation_falls_back():
+    assert negotiate_protocol(None, None) == ("legacy", "json")
+    assert negotiate_protocol("unknown", "msgpack") == ("legacy", "json")
+    assert negotiate_protocol("delta", "msgpack") == ("delta", "msgpack" if msgpack is not None else "json")
+
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack is not installed")
+def test_msgpack_round_trip():
+    encoder = MessageStreamEncoder(1, "msgpack")
+    frame = encoder.chunk("text")
+    assert msgpack.unpackb(encoder.encode(frame), raw=False) == frame
+
+
+def test_splice_round_trip():
+    rng = random.Random(0)
+    for _ in range(300):
+        old = "".join(rng.choice("abc ") for _ in range(rng.randint(0, 30)))
+        new = "".join(rng.choice("abc ") for _ in range(rng.randint(0, 30)))
+        assert apply_splice(old, *text_splice(old, new)) == new
+
+
+def test_full_rewrites_are_sent_as_diffs():
+    encoder = MessageStreamEncoder(3)
+    encoder.header(content="")
+    encoder.chunk("A long answer")
+    frame = encoder.full("A long answer\n<div>Sources</div>")
+    assert frame["t"]==FRAME_DIFF and frame["b"]==1
+    assert (frame["o"], frame["x"], frame["c"]) == (13, 0, "\n<div>Sources</div>")
+    assert "c" not in encoder.close(content="A long answer\n<div>Sources</div>")
+
+
+def test_replay_from_ring_buffer():
+    encoder = MessageStreamEncoder(5, history_size=4)
+    encoder.header(content="")
+    for text in ["a", "b", "c", "d", "e"]:
+        encoder.chunk(text)
+    assert [frame["c"] for frame in encoder.replay(3)] == ["d", "e"]
+    assert encoder.replay(5) == []
+    # Frame 1 is not in the ring buffer anymore
+    frames = encoder.replay(0)
+    assert len(frames)==1 and frames[0]["t"]==FRAME_RESYNC and frames[0]["c"]=="abcde"
+
+
+def test_resume_after_disconnect_replays_missed_chunks():
+    routes = StreamRoutes()
+    encoder = MessageStreamEncoder(9)
+    encoder.header(content="")
+    received = encoder.chunk("Hello")
+    # The socket receiving the stream is still connected: it can not be taken over
+    assert routes.resume("sid2", "sid1") is None
+    assert routes.route("sid1") == "sid1"
+    routes.disconnect("sid1")
+    # Chunks generated while the frontend is away keep filling the replay buffer
+    encoder.chunk(" wor")
+    encoder.chunk("ld")
+    assert routes.resume("sid2", "sid1") == "sid1"
+    assert routes.route("sid1") == "sid2"
+    assert routes.origin("sid2") == "sid1"
+    assert received["c"] + "".join(frame["c"] for frame in encoder.replay(received["s"])) == "Hello world"
+    # sid2 is connected now, reconnecting again requires it to be gone
+    assert routes.resume("sid3", "sid2") is None
+    routes.disconnect("sid2")
+    assert routes.resume("sid3", "sid2") == "sid1"
+    assert sorted(routes.release("sid1")) == ["sid1", "sid2"]
+    assert routes.route("sid1") == "sid1" and len(routes) == 0
@@ -0,0 +1,52 @@
+from utilities.text_buffer import GeneratedTextBuffer
+
+
+def test_lazy_join_is_cached():
+    buffer = GeneratedTextBuffer("Once")
+    for chunk in [" upon", " a", " time"]:
+        buffer.append(chunk)
+    assert len(buffer) == len("Once upon a time")
+    text = buffer.text
+    assert text == "Once upon a time"
+    assert buffer.text is text
+
+
+def test_marker_split_across_chunks():
+    buffer = GeneratedTextBuffer()
+    for chunk in ["The answer is 42.", "\n!", "@", ">user: thanks"]:
+        buffer.append(chunk)
+    assert buffer.visible_text() == "The answer is 42.".split("!@>")[0] + "\n"
+    assert buffer.visible_text() == buffer.text.split("!@>")[0]
+
+
+def test_set_and_truncate_keep_marker_consistent():
+    buffer = GeneratedTextBuffer()
+    buffer.set("abc!@>def!@>")
+    assert buffer.visible_text() == "abc"
+    buffer.truncate(4)
+    assert buffer.text == "abc!"
+    assert buffer.visible_text() == "abc!"
+    buffer.append("@>x")
+    assert buffer.visible_text() == "abc"
+
+
+def test_token_count_is_only_exact_for_streamed_text():
+    buffer = GeneratedTextBuffer()
+    for chunk, nb_tokens in [("Hel", 1), ("lo", 1), (" world", 2)]:
+        buffer.append(chunk, nb_tokens)
+    assert buffer.nb_tokens == 4
+    buffer.append("!@>user", 3)
+    assert buffer.nb_tokens is None
+    assert GeneratedTextBuffer("continued", nb_tokens=2).nb_tokens == 2
+    buffer.set("rewritten")
+    assert buffer.nb_tokens is None
+
+
+def test_token_count_is_unknown_when_the_binding_does_not_report_it():
+    buffer = GeneratedTextBuffer()
+    buffer.append("Hello", 1)
+    # A chunk can carry several tokens, it is not counted as one
+    buffer.append(" world, how are you")
+    buffer.append("?", 1)
+    assert buffer.nb_tokens is None
+    assert GeneratedTextBuffer("continued", nb_tokens=2).nb_tokens == 2
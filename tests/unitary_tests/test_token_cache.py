@@ -0,0 +1,41 @@
+from utilities.token_cache import TokenizationCache, MessageTokenCounts
+
+
+def tokenize(text):
+    calls.append(text)
+    return text.split()
+
+calls = []
+
+
+def test_lru_cache_per_model():
+    calls.clear()
+    cache = TokenizationCache(max_entries=2)
+    assert cache.tokenize("m1", "a b", tokenize) == ["a", "b"]
+    assert cache.tokenize("m1", "a b", tokenize) == ["a", "b"]
+    assert cache.count("m2", "a b", tokenize) == 2
+    cache.tokenize("m1", "c", tokenize)
+    # "a b" for m1 was the least recently used entry
+    cache.tokenize("m1", "a b", tokenize)
+    assert calls == ["a b", "a b", "c", "a b"]
+    assert cache.to_dict()["tokenization_cache_hits"] == 1
+
+
+def test_only_new_or_edited_messages_are_counted(tmp_path):
+    calls.clear()
+    counts = MessageTokenCounts(tmp_path/"database.db")
+    count = lambda text: len(tokenize(text))
+    messages = [(i, f"message {i} " * (i+1)) for i in range(500)]
+    assert counts.count_messages(messages, "m1", count)[:2] == [2, 4]
+    assert len(calls) == 500
+    calls.clear()
+    messages.append((500, "a new one"))
+    messages[3] = (3, "edited")
+    assert counts.count_messages(messages, "m1", count)[3] == 1
+    assert calls == ["edited", "a new one"]
+    calls.clear()
+    counts.invalidate(4)
+    counts.count_messages(messages, "m1", count)
+    assert calls == [messages[4][1]]
+    counts.count_messages(messages[:1], "m2", count)
+    assert len(calls) == 2
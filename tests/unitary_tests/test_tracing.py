@@ -0,0 +1,62 @@
+import json
+import threading
+
+import pytest
+
+from utilities.tracing import Tracer, JSONLTraceExporter
+
+
+def test_nested_spans_are_exported(tmp_path):
+    exporter = JSONLTraceExporter(tmp_path/"traces.jsonl")
+    tracer = Tracer(exporter)
+    with tracer.trace("generation", client_id="a"):
+        with tracer.span("prepare_query"):
+            with tracer.span("query_keywords", mode="statistical"):
+                pass
+        with tracer.span("generate"):
+            tracer.mark("first_token_ms")
+            tracer.add_time("emit", 1.5)
+            tracer.add_time("emit", 0.5)
+        with pytest.raises(ValueError):
+            with tracer.span("tts"):
+                raise ValueError("no voice")
+    assert tracer.current is None
+    trace = exporter.last(1)[0]
+    assert trace["attributes"] == {"client_id": "a"}
+    spans = {span["name"]: span for span in trace["spans"]}
+    assert spans["query_keywords"]["parent_id"] == spans["prepare_query"]["span_id"]
+    assert spans["prepare_query"]["parent_id"] == spans["generate"]["parent_id"]
+    assert "first_token_ms" in spans["generate"]["attributes"]
+    assert "no voice" in spans["tts"]["error"]
+    assert trace["totals"]["emit"] == {"total_ms": 2.0, "count": 2}
+    # Written to the file and reloaded by a new exporter
+    line = (tmp_path/"traces.jsonl").read_text().splitlines()[0]
+    assert json.loads(line)["trace_id"] == trace["trace_id"]
+    assert JSONLTraceExporter(tmp_path/"traces.jsonl").last(5)[0]["trace_id"] == trace["trace_id"]
+
+
+def test_spans_without_trace_do_nothing(tmp_path):
+    tracer = Tracer(JSONLTraceExporter(tmp_path/"traces.jsonl"), enabled=False)
+    with tracer.trace("generation") as trace:
+        with tracer.span("generate") as span:
+            tracer.add_time("emit", 1)
+    assert trace is None and span is None
+    assert not (tmp_path/"traces.jsonl").exists()
+
+
+def test_traces_are_per_thread_and_rotated(tmp_path):
+    exporter = JSONLTraceExporter(tmp_path/"traces.jsonl", max_bytes=2000, backup_count=2, keep_last=3)
+    tracer = Tracer(exporter)
+    def run(i):
+        with tracer.trace("generation", index=i):
+            with tracer.span("generate"):
+                pass
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(exporter.last(10)) == 3
+    assert all(len(trace["spans"]) == 1 for trace in exporter.last(10))
+    assert (tmp_path/"traces.jsonl.1").exists()
+    assert not (tmp_path/"traces.jsonl.3").exists()
@@ -0,0 +1,42 @@
+import threading
+
+from utilities.worker_lanes import WorkerLane, WorkerLanes
+
+
+def test_lane_bounds_workers_and_queue():
+    lane = WorkerLane("test", max_workers=2, max_queued=1)
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    done = threading.Semaphore(0)
+    names = set()
+
+    def task():
+        names.add(threading.current_thread().name)
+        started.release()
+        release.wait(5)
+        done.release()
+
+    assert lane.submit(task) and lane.submit(task)
+    for _ in range(2):
+        assert started.acquire(timeout=5)
+    assert lane.submit(task)
+    assert not lane.submit(task)
+    stats = lane.to_dict()
+    assert stats["busy"] == 2 and stats["occupancy"] == 1
+    assert stats["queued"] == 1 and stats["rejected"] == 1
+    release.set()
+    for _ in range(3):
+        assert done.acquire(timeout=5)
+    assert names <= {"test_1", "test_2"}
+
+
+def test_failing_task_does_not_kill_the_worker():
+    lanes = WorkerLanes()
+    lanes.add("ingestion", 1, None)
+    done = threading.Event()
+    assert lanes.submit("ingestion", lambda: 1/0)
+    assert lanes.submit("ingestion", done.set)
+    assert done.wait(5)
+    stats = lanes.to_dict()["ingestion"]
+    assert stats["failed"] == 1
+    assert stats["workers"] == 1
@@ -0,0 +1,111 @@
+"""
+project: lollms_webui
+file: antiprompt_matcher.py
+author: ParisNeo
+description:
+    Incremental antiprompt detection for streamed generations.
+    An Aho-Corasick automaton is built once per generation from the personality antiprompts and
+    carries its state from one chunk to the next, so each chunk only costs its own length instead
+    of rescanning the whole generated text.
+
+"""
+from collections import deque
+
+
+class StreamingAntipromptMatcher:
+    """
+    Case insensitive multi pattern matcher fed chunk by chunk.
+
+    It reports the same antiprompt and the same cut position as running
+    `personality.detect_antiprompt` followed by `remove_text_from_string` on the accumulated text:
+    when several antiprompts appear in the same chunk, the first one in the antiprompts list wins and
+    the position is the one of its first occurrence in the lowered text.
+
+    Args:
+        anti_prompts (list): The antiprompts to detect.
+    """
+    def __init__(self, anti_prompts:list):
+        self.anti_prompts = []
+        for prompt in anti_prompts:
+            if prompt=="":
+                # detect_antiprompt returns the (falsy) empty prompt here and never reaches the next ones
+                break
+            self.anti_prompts.append(prompt.lower())
+        self.max_length = max([len(p) for p in self.anti_prompts], default=0)
+        self._build()
+        self.reset()
+
+    def _build(self):
+        # Each node: transitions, failure link and indices of the antiprompts ending there
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for index, prompt in enumerate(self.anti_prompts):
+            node = 0
+            for c in prompt:
+                nxt = self._goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][c] = nxt
+                node = nxt
+            self._out[node].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(c, 0) if self._goto[fail].get(c, 0)!=nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def reset(self, text:str=""):
+        """
+        Restarts the matcher as if `text` had already been fed.
+        Only the last characters that can still be part of an antiprompt are scanned.
+        """
+        self._state = 0
+        lowered = text.lower()
+        tail = lowered[-(self.max_length-1):] if self.max_length>1 else ""
+        self.position = len(lowered)-len(tail)
+        if tail:
+            self.feed(tail)
+
+    def feed(self, chunk:str):
+        """
+        Feeds newly generated text.
+
+        Returns:
+            tuple: (antiprompt, position) where position is the index in the accumulated text at which
+            the text must be cut, or None if no antiprompt was completed by this chunk.
+        """
+        if not self.anti_prompts or not chunk:
+            self.position += len(chunk.lower()) if chunk else 0
+            return None
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = self._state
+        best_index = None
+        best_position = None
+        position = self.position
+        for c in chunk.lower():
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                for index in out[state]:
+                    if best_index is None or index<best_index:
+                        best_index = index
+                        best_position = position - len(self.anti_prompts[index]) + 1
+            position += 1
+        self._state = state
+        self.position = position
+        if best_index is None:
+            return None
+        return self.anti_prompts[best_index], best_position
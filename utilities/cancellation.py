@@ -0,0 +1,101 @@
+"""
+project: lollms_webui
+file: cancellation.py
+author: ParisNeo
+description:
+    Cooperative cancellation of the generations.
+    Each generation gets its own token. Stopping a generation only sets the token of that request:
+    the generation thread checks it on each received chunk (the binding stops when the callback
+    returns False), at each workflow step of scripted personalities and before the post processing
+    (voice output, internet sources). The thread then ends normally and the message is closed with
+    what was generated so far, instead of killing the thread with an asynchronous exception.
+    The delays between a stop request and the actual stop are recorded.
+
+"""
+import threading
+import time
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised in the generation thread to leave a workflow when its token was cancelled.
+    """
+
+
+class CancellationToken:
+    """
+    Cancellation flag of one generation request.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self.requested_at = None
+        self.stopped_at = None
+
+    @property
+    def cancelled(self)->bool:
+        return self._event.is_set()
+
+    def cancel(self)->bool:
+        """
+        Asks the generation to stop. Can be called from any thread.
+
+        Returns:
+            bool: False if the token was already cancelled
+        """
+        if self._event.is_set():
+            return False
+        self.requested_at = time.perf_counter()
+        self._event.set()
+        return True
+
+    def mark_stopped(self):
+        """
+        Called by the generation thread when it stops because of the token (the first time counts).
+        """
+        if self.cancelled and self.stopped_at is None:
+            self.stopped_at = time.perf_counter()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            self.mark_stopped()
+            raise GenerationCancelled()
+
+
+class CancellationStats:
+    """
+    Delays between stop requests and the generations stopping (stop) or their thread ending (exit), in ms.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancellations = 0
+        self.total_stop_ms = 0.0
+        self.max_stop_ms = 0.0
+        self.total_exit_ms = 0.0
+        self.max_exit_ms = 0.0
+
+    def record(self, token:CancellationToken):
+        """
+        Records the delays of a cancelled token once its generation thread is done.
+        """
+        if not token.cancelled:
+            return
+        now = time.perf_counter()
+        stop_ms = ((token.stopped_at or now) - token.requested_at)*1000
+        exit_ms = (now - token.requested_at)*1000
+        with self._lock:
+            self.cancellations += 1
+            self.total_stop_ms += stop_ms
+            self.max_stop_ms = max(self.max_stop_ms, stop_ms)
+            self.total_exit_ms += exit_ms
+            self.max_exit_ms = max(self.max_exit_ms, exit_ms)
+
+    def to_dict(self):
+        with self._lock:
+            count = max(self.cancellations, 1)
+            return {
+                "cancellations":        self.cancellations,
+                "mean_cancel_stop_ms":  self.total_stop_ms/count,
+                "max_cancel_stop_ms":   self.max_stop_ms,
+                "mean_cancel_exit_ms":  self.total_exit_ms/count,
+                "max_cancel_exit_ms":   self.max_exit_ms
+            }
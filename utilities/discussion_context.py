@@ -0,0 +1,180 @@
+"""
+project: lollms_webui
+file: discussion_context.py
+author: ParisNeo
+description:
+    Token budgeted view of the messages of a discussion, shared by everything that puts the
+    discussion in a prompt (titles, recovery of the discussion text for searches...).
+    The builder keeps the messages visible to the AI as they appear in the prompt with their number
+    of tokens and the running sums of these numbers. When synchronized with the discussion, only the
+    messages added since the last synchronization (and the last synchronized one, that may still be
+    generating) are processed. Edits and deletions of older messages must be reported with invalidate().
+    Fitting the most recent messages into a token budget is a binary search on the running sums.
+
+"""
+import threading
+from bisect import bisect_left, bisect_right
+
+
+class DiscussionContextBuilder:
+    """
+    Context window of one discussion.
+
+    Args:
+        separator (str): The discussion prompt separator put before each sender name.
+        is_visible (Callable, optional): Tells if a message goes in the prompt (all the non empty ones if None).
+        format (Callable, optional): Text of a message in the prompt ("\n" + separator + sender + ": " + content if None).
+    """
+    def __init__(self, separator:str="!@>", is_visible=None, format=None):
+        self.separator = separator
+        self.is_visible = is_visible if is_visible is not None else (lambda message: message.content != '')
+        self._format = format
+        # Visible messages in discussion order, their text in the prompt and their number of tokens
+        self._ids = []
+        self._texts = []
+        self._tokens = []
+        # _sums[i] is the number of tokens of the i first messages
+        self._sums = [0]
+        # Number of messages at the last sync, id of the last one and number of visible messages before it
+        self._synced = None
+        self._full_text = None
+        self._lock = threading.Lock()
+
+    def format(self, message)->str:
+        if self._format is not None:
+            return self._format(message)
+        return "\n" + self.separator + message.sender + ": " + message.content.strip()
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def nb_tokens(self)->int:
+        return self._sums[-1]
+
+    def invalidate(self):
+        """
+        Makes the next sync compare all the messages (after a message was edited or deleted).
+        Only the messages that actually changed are counted again.
+        """
+        with self._lock:
+            self._synced = None
+
+    def sync(self, messages:list, count_many):
+        """
+        Updates the window from the messages of the discussion (active branch, in order).
+
+        Args:
+            messages (list): The messages of the discussion.
+            count_many (Callable): count_many([(message_id, text), ...]) returns the number of tokens of each text.
+        """
+        with self._lock:
+            # The messages before the last synced one are kept as long as it is still at the same place
+            start, kept = 0, 0
+            if self._synced is not None:
+                count, last_id, visible = self._synced
+                if len(messages)>=count and messages[count-1].id==last_id:
+                    start, kept = count-1, visible
+            ids, texts = [], []
+            visible = kept
+            for index in range(start, len(messages)):
+                message = messages[index]
+                if index==len(messages)-1:
+                    visible = kept + len(ids)
+                if self.is_visible(message):
+                    ids.append(message.id)
+                    texts.append(self.format(message))
+            self._synced = (len(messages), messages[-1].id, visible) if messages else None
+            # Everything before the first added, removed or edited message is kept
+            unchanged = kept
+            limit = min(kept + len(ids), len(self._ids))
+            while unchanged<limit and ids[unchanged-kept]==self._ids[unchanged] and texts[unchanged-kept]==self._texts[unchanged]:
+                unchanged += 1
+            if unchanged==kept + len(ids)==len(self._ids):
+                return
+            counts = count_many(list(zip(ids[unchanged-kept:], texts[unchanged-kept:])))
+            self._tokens = self._tokens[:unchanged] + list(counts)
+            del self._sums[unchanged+1:]
+            for nb_tokens in self._tokens[unchanged:]:
+                self._sums.append(self._sums[-1] + nb_tokens)
+            self._ids = self._ids[:kept] + ids
+            self._texts = self._texts[:kept] + texts
+            self._full_text = None
+
+    def _end(self, upto_message_id):
+        if upto_message_id is None or upto_message_id==-1:
+            return len(self._ids)
+        # Messages up to upto_message_id included
+        for index in range(len(self._ids)-1, -1, -1):
+            if self._ids[index]<=upto_message_id:
+                return index+1
+        return 0
+
+    def window(self, budget:int=None, upto_message_id:int=None, max_messages:int=None):
+        """
+        The most recent messages fitting in a number of tokens, in discussion order.
+
+        Args:
+            budget (int, optional): Maximum number of tokens (no limit if None).
+            upto_message_id (int, optional): Last message to include (the whole discussion if None or -1).
+            max_messages (int, optional): Maximum number of messages.
+
+        Returns:
+            tuple: (text, number of tokens, number of messages)
+        """
+        with self._lock:
+            end = self._end(upto_message_id)
+            start = 0
+            if budget is not None:
+                start = bisect_left(self._sums, self._sums[end] - max(budget, 0), 0, end+1)
+            if max_messages is not None:
+                start = max(start, end - max(max_messages, 0))
+            if start==0 and end==len(self._ids):
+                if self._full_text is None:
+                    self._full_text = "".join(self._texts)
+                text = self._full_text
+            else:
+                text = "".join(self._texts[start:end])
+            return text, self._sums[end] - self._sums[start], end - start
+
+    def measure(self, text:str, upto_message_id:int=None):
+        """
+        Number of tokens of a text made of the last messages of the window (up to upto_message_id
+        included), from the stored counts.
+
+        Returns:
+            int: The number of tokens, or None if the text is not made of these messages
+        """
+        with self._lock:
+            end = self._end(upto_message_id)
+            start, length = end, 0
+            while start>0 and length<len(text):
+                start -= 1
+                length += len(self._texts[start])
+            if length!=len(text) or "".join(self._texts[start:end])!=text:
+                return None
+            return self._sums[end] - self._sums[start]
+
+    def overflow(self, budget:int, after_message_id:int=-1, max_tokens:int=None):
+        """
+        Messages left out of the window of budget tokens (whole discussion) that come after the message
+        after_message_id, the oldest first (the ones a rolling summary has to fold in).
+
+        Args:
+            max_tokens (int, optional): Maximum number of tokens returned (at least one message is returned).
+
+        Returns:
+            tuple: (text, id of the last returned message) or ("", None) if there are none
+        """
+        with self._lock:
+            end = len(self._ids)
+            start = bisect_left(self._sums, self._sums[end] - max(budget, 0), 0, end+1)
+            first = 0
+            while first<start and self._ids[first]<=after_message_id:
+                first += 1
+            if first>=start:
+                return "", None
+            last = start
+            if max_tokens is not None:
+                last = max(bisect_right(self._sums, self._sums[first] + max_tokens, first+1, start+1) - 1, first+1)
+            return "".join(self._texts[first:last]), self._ids[last-1]
@@ -0,0 +1,72 @@
+"""
+project: lollms_webui
+file: discussion_summary.py
+author: ParisNeo
+description:
+    Rolling summaries of the discussions (summerize_discussion), persisted in a side table of the
+    discussion database. A summary covers the messages of its discussion up to a message id. When
+    messages fall out of the context window, a background job folds them into the summary (previous
+    summary + new messages -> updated summary) so that each message is summarized only once and the
+    prompt uses the summary followed by the most recent messages without waiting for a generation.
+
+"""
+import sqlite3
+from pathlib import Path
+
+
+def summary_prompt(previous_summary:str, new_messages:str, separator:str="!@>")->str:
+    """
+    Prompt folding messages into the summary of a discussion.
+    """
+    prompt = f"{separator}instruction: Update the summary of the discussion with the new messages. Keep the important information (facts, decisions, names, numbers, requests of the user). Your response should only contain the updated summary.\n"
+    if previous_summary:
+        prompt += f"{separator}previous summary:\n{previous_summary}\n"
+    prompt += f"{separator}new messages:{new_messages}\n{separator}updated summary:\n"
+    return prompt
+
+
+class DiscussionSummaries:
+    """
+    Args:
+        db_path (Path): The discussion database file.
+    """
+    def __init__(self, db_path:Path):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS discussion_summaries (
+                    discussion_id INTEGER PRIMARY KEY,
+                    upto_message_id INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    nb_tokens INTEGER NOT NULL
+                )
+            """)
+
+    def get(self, discussion_id:int):
+        """
+        Returns:
+            tuple: (upto_message_id, summary, nb_tokens) or None if the discussion has no summary
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT upto_message_id, summary, nb_tokens FROM discussion_summaries WHERE discussion_id=?",
+                (discussion_id,)
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set(self, discussion_id:int, upto_message_id:int, summary:str, nb_tokens:int):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO discussion_summaries (discussion_id, upto_message_id, summary, nb_tokens) VALUES (?, ?, ?, ?)",
+                (discussion_id, upto_message_id, summary, nb_tokens)
+            )
+
+    def invalidate(self, discussion_id:int, message_id:int=None):
+        """
+        Forgets the summary of a discussion, or only if it covers message_id (edited or deleted message).
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            if message_id is None:
+                conn.execute("DELETE FROM discussion_summaries WHERE discussion_id=?", (discussion_id,))
+            else:
+                conn.execute("DELETE FROM discussion_summaries WHERE discussion_id=? AND upto_message_id>=?", (discussion_id, message_id))
@@ -0,0 +1,206 @@
+"""
+project: lollms_webui
+file: emit_bridge.py
+author: ParisNeo
+description:
+    Thread safe bridge between the generation threads and the socket.io server.
+    Emits are put in a single bounded outbound queue and sent by one drain task running on the
+    server event loop, so worker threads never create event loops of their own.
+    Frames are sent in order for each client and clients are served in turn, so that a slow client
+    does not delay the others. While a frame waits in the queue, the next chunks of the same message
+    are merged into it. When the queue stays full, frames are dropped except the ones carrying the
+    content of the messages, which go over the limit (the next chunks are merged into them).
+
+"""
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+
+class EmitBridgeStats:
+    """
+    Counters of the outbound queue.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames_queued = 0
+        self.frames_sent = 0
+        self.frames_merged = 0
+        self.frames_dropped = 0
+        self.frames_over_limit = 0
+        self.max_queue_depth = 0
+
+    def record(self, counter:str, value:int=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def record_depth(self, depth:int):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "frames_queued":    self.frames_queued,
+                "frames_sent":      self.frames_sent,
+                "frames_merged":    self.frames_merged,
+                "frames_dropped":   self.frames_dropped,
+                "frames_over_limit":self.frames_over_limit,
+                "max_queue_depth":  self.max_queue_depth
+            }
+
+
+class EmitBridge:
+    """
+    Single outbound queue of a server.
+
+    Args:
+        emit (Callable): Coroutine function sending an event (sio.emit).
+        max_pending (int): Maximum number of frames waiting in the queue (all clients).
+        block_timeout_ms (int): How long a worker thread waits for room in a full queue before the frame is dropped
+                                (or queued over the limit if it can't be lost).
+        stats (EmitBridgeStats, optional): Counters to update.
+    """
+    def __init__(self, emit, max_pending:int=2000, block_timeout_ms:int=1000, stats:EmitBridgeStats=None):
+        self._emit = emit
+        self.max_pending = max(max_pending, 1)
+        self.block_timeout = max(block_timeout_ms, 0)/1000
+        self.stats = stats if stats is not None else EmitBridgeStats()
+
+        self.loop = None
+        self._task = None
+        self._wakeup = None
+        self._waiting = False
+
+        # One deque of (event, data, merge, encode) per destination and the destinations having frames, in turn order
+        self._queues = {}
+        self._ready = deque()
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+
+    @property
+    def depth(self)->int:
+        return self._depth
+
+    def start(self, loop:asyncio.AbstractEventLoop):
+        """
+        Binds the bridge to the server event loop. Must be called from that loop.
+        Frames queued before are sent as soon as the drain task runs.
+        """
+        if self.loop is not None:
+            return
+        self.loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._drain())
+
+    def _on_loop(self)->bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def emit(self, event:str, data=None, to=None, merge=None, encode=None, lossless:bool=False)->bool:
+        """
+        Queues an event. Can be called from any thread.
+
+        Args:
+            event (str): The event name.
+            data: The payload.
+            to: Destination socket id (None for everybody).
+            merge (Callable, optional): merge(queued_data, data) returns a payload replacing the last queued frame
+                                        of the same destination with both contents, or None if they can't be merged.
+            encode (Callable, optional): Applied to the payload when it is sent (after any merge).
+            lossless (bool): The frame is never dropped (content of a message). It is queued over the limit
+                             when there is still no room after the backpressure wait.
+
+        Returns:
+            bool: False if the frame was dropped
+        """
+        if self.loop is None:
+            try:
+                # Bind lazily when the first emit comes from the server loop itself
+                self.start(asyncio.get_running_loop())
+            except RuntimeError:
+                pass
+        with self._lock:
+            if self._merge(to, event, data, merge, encode):
+                return True
+
+            if self._depth>=self.max_pending:
+                # Backpressure: a worker thread waits for the drain task, the loop itself can't
+                if self._on_loop() or self.loop is None or not self._room.wait_for(lambda: self._depth<self.max_pending, self.block_timeout):
+                    if not lossless:
+                        self.stats.record("frames_dropped")
+                        return False
+                    self.stats.record("frames_over_limit")
+                # The frames of the destination changed while waiting
+                if self._merge(to, event, data, merge, encode):
+                    return True
+
+            queue = self._queues.get(to)
+            if queue is None:
+                queue = deque()
+                self._queues[to] = queue
+            if not queue:
+                self._ready.append(to)
+            queue.append((event, data, merge, encode))
+            self._depth += 1
+            self.stats.record("frames_queued")
+            self.stats.record_depth(self._depth)
+            wake = self._waiting
+            self._waiting = False
+        if wake:
+            if self._on_loop():
+                self._wakeup.set()
+            else:
+                self.loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def _merge(self, to, event:str, data, merge, encode)->bool:
+        # Must be called with the lock held, merges the frame into the last queued frame of the destination
+        queue = self._queues.get(to)
+        if merge is None or not queue:
+            return False
+        last_event, last_data, last_merge, last_encode = queue[-1]
+        if last_event!=event or last_merge is None or last_encode!=encode:
+            return False
+        merged = merge(last_data, data)
+        if merged is None:
+            return False
+        queue[-1] = (event, merged, merge, encode)
+        self.stats.record("frames_merged")
+        return True
+
+    def _next(self):
+        # Pops the next frame, serving the destinations in turn
+        with self._lock:
+            if not self._ready:
+                self._waiting = True
+                return None
+            to = self._ready.popleft()
+            queue = self._queues[to]
+            event, data, _, encode = queue.popleft()
+            if queue:
+                self._ready.append(to)
+            else:
+                del self._queues[to]
+            self._depth -= 1
+            self._room.notify_all()
+            return to, event, data, encode
+
+    async def _drain(self):
+        while True:
+            item = self._next()
+            if item is None:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            to, event, data, encode = item
+            try:
+                await self._emit(event, data if encode is None else encode(data), to=to)
+                self.stats.record("frames_sent")
+            except Exception as ex:
+                # The drain task must survive a failing emit
+                traceback.print_exc()
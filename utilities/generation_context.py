@@ -0,0 +1,57 @@
+"""
+project: lollms_webui
+file: generation_context.py
+author: ParisNeo
+description:
+    State of one generation request.
+    The counters, flags and prompt of a generation used to live on the server singleton, which
+    prevented two generations from running at the same time. Each request now gets its own context
+    holding them, along with the model instance it leased from the model pool.
+
+"""
+from datetime import datetime
+
+from utilities.cancellation import CancellationToken
+
+
+class GenerationContext:
+    """
+    Everything that belongs to a single generation.
+
+    Args:
+        client_id: The client the generation is made for.
+        model (LLMBinding, optional): The model instance used by this generation.
+        n_threads (int, optional): Number of threads the model instance can use.
+    """
+    def __init__(self, client_id, model=None, n_threads:int=None):
+        self.client_id = client_id
+        self.model = model
+        self.n_threads = n_threads
+
+        self.nb_received_tokens = 0
+        self.start_time = datetime.now()
+        self.cancellation = CancellationToken()
+        self.generating = False
+
+        # Timestamps recorded in the generation metrics (GenerationTimer)
+        self.timer = None
+
+        # Prompt built by prepare_query
+        self.discussion_messages = None
+        self.current_message = None
+
+    @property
+    def cancel_gen(self)->bool:
+        return self.cancellation.cancelled
+
+    def reset_counters(self):
+        """
+        Restarts the token counting (a new message or a new generation pass begins).
+        """
+        self.nb_received_tokens = 0
+        self.start_time = datetime.now()
+
+    @property
+    def tokens_per_second(self)->float:
+        dt = (datetime.now() - self.start_time).total_seconds()
+        return self.nb_received_tokens/dt if dt>0 else 0
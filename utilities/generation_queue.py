@@ -0,0 +1,210 @@
+"""
+project: lollms_webui
+file: generation_queue.py
+author: ParisNeo
+description:
+    Server side queue of the generation requests.
+    Instead of refusing the requests received while a generation is running, they wait in a queue
+    served in turn for each client (round robin), so that a client sending many requests can not
+    starve the others. A client never has two generations running at the same time, its next request
+    waits for the running one to end. Waiting clients are told their position and can cancel their requests.
+    The requests run on the workers of a lane (see worker_lanes.py).
+
+"""
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+
+from utilities.worker_lanes import WorkerLane
+
+
+class GenerationRequest:
+    """
+    A generation waiting for its turn.
+
+    Args:
+        client_id: The client that asked for it.
+        target (Callable): Function running the generation.
+        args (tuple): Its arguments.
+    """
+    def __init__(self, client_id, target, args:tuple=()):
+        self.client_id = client_id
+        self.target = target
+        self.args = args
+        self.queued_at = time.perf_counter()
+        self.started_at = None
+
+
+class GenerationQueue:
+    """
+    Round robin queue of generation requests, dispatched to the workers of a lane.
+
+    Args:
+        max_depth (int): Maximum number of waiting requests (all clients).
+        max_concurrent (int): Number of generations that can run at the same time.
+        lane (WorkerLane, optional): Lane running the requests (one is created if None). Its workers follow max_concurrent.
+        on_start (Callable, optional): on_start(request, thread) called by the worker thread before running a request.
+        on_position (Callable, optional): on_position(request, position, depth) called for each waiting
+                                          request when its position changes (1 is the next one).
+        on_idle (Callable, optional): Called when the last running request ends and none is waiting.
+    """
+    def __init__(self, max_depth:int=16, max_concurrent:int=1, lane:WorkerLane=None, on_start=None, on_position=None, on_idle=None):
+        self.max_depth = max(max_depth, 0)
+        # The queue bounds the requests, the lane only runs them
+        self.lane = lane if lane is not None else WorkerLane("generation", max_concurrent, None)
+        self.on_start = on_start
+        self.on_position = on_position
+        self.on_idle = on_idle
+
+        # Waiting requests of each client, in turn order
+        self._pending = OrderedDict()
+        self._depth = 0
+        self._running = 0
+        # Clients having a running generation
+        self._running_clients = set()
+        self._positions = {}
+        self._condition = threading.Condition()
+        self._dispatcher = None
+        self.max_concurrent = max_concurrent
+
+    @property
+    def max_concurrent(self)->int:
+        return self._max_concurrent
+
+    @max_concurrent.setter
+    def max_concurrent(self, value:int):
+        with self._condition:
+            self._max_concurrent = max(value, 1)
+            self.lane.max_workers = self._max_concurrent
+            self._condition.notify_all()
+
+    @property
+    def depth(self)->int:
+        return self._depth
+
+    @property
+    def running(self)->int:
+        return self._running
+
+    @property
+    def idle(self)->bool:
+        return self._running==0 and self._depth==0
+
+    def submit(self, client_id, target, args:tuple=()):
+        """
+        Queues a generation.
+
+        Returns:
+            GenerationRequest: The queued request or None if the queue is full
+        """
+        request = GenerationRequest(client_id, target, args)
+        with self._condition:
+            if self._depth>=self.max_depth + max(self.max_concurrent-self._running, 0):
+                return None
+            self._pending.setdefault(client_id, deque()).append(request)
+            self._depth += 1
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, daemon=True, name="generation_queue")
+                self._dispatcher.start()
+            self._condition.notify_all()
+        self._notify_positions()
+        return request
+
+    def cancel(self, client_id)->int:
+        """
+        Removes the waiting requests of a client (a running generation is not affected).
+
+        Returns:
+            int: The number of removed requests
+        """
+        with self._condition:
+            requests = self._pending.pop(client_id, None)
+            if not requests:
+                return 0
+            self._depth -= len(requests)
+            for request in requests:
+                self._positions.pop(id(request), None)
+        self._notify_positions()
+        return len(requests)
+
+    def position(self, client_id):
+        """
+        Position of the first waiting request of a client (1 is the next one) or None.
+        """
+        with self._condition:
+            for position, request in enumerate(self._order(), 1):
+                if request.client_id==client_id:
+                    return position
+        return None
+
+    def _order(self):
+        # Dispatch order: the first request of each client in turn, then the second ones...
+        queues = list(self._pending.values())
+        order = []
+        rank = 0
+        while True:
+            row = [queue[rank] for queue in queues if len(queue)>rank]
+            if not row:
+                return order
+            order += row
+            rank += 1
+
+    def _notify_positions(self):
+        if self.on_position is None:
+            return
+        with self._condition:
+            order = self._order()
+            depth = self._depth
+            changed = []
+            for position, request in enumerate(order, 1):
+                if self._positions.get(id(request))!=position:
+                    self._positions[id(request)] = position
+                    changed.append((request, position))
+        for request, position in changed:
+            self.on_position(request, position, depth)
+
+    def _ready(self)->bool:
+        # Must be called with the condition held
+        return self._running<self.max_concurrent and any(client_id not in self._running_clients for client_id in self._pending)
+
+    def _pop(self):
+        # Must be called with the condition held, the first client in turn that is not already generating is served
+        client_id, queue = next((client_id, queue) for client_id, queue in self._pending.items() if client_id not in self._running_clients)
+        request = queue.popleft()
+        del self._pending[client_id]
+        if queue:
+            # The client goes back to the end of the turn
+            self._pending[client_id] = queue
+        self._depth -= 1
+        self._positions.pop(id(request), None)
+        return request
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._ready)
+                request = self._pop()
+                self._running += 1
+                self._running_clients.add(request.client_id)
+            request.started_at = time.perf_counter()
+            self.lane.submit(self._run, request)
+            self._notify_positions()
+
+    def _run(self, request:GenerationRequest):
+        try:
+            if self.on_start is not None:
+                try:
+                    self.on_start(request, threading.current_thread())
+                except Exception as ex:
+                    # The generation must run anyway
+                    traceback.print_exc()
+            request.target(*request.args)
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._running_clients.discard(request.client_id)
+                self._condition.notify_all()
+                idle = self.idle
+            if idle and self.on_idle is not None:
+                self.on_idle()
@@ -0,0 +1,105 @@
+"""
+project: lollms_webui
+file: housekeeping.py
+author: ParisNeo
+description:
+    Routing of the housekeeping generations (discussion titles, personality translations, search
+    queries, yes/no decisions...) to a small utility model running next to the main one.
+    When no utility model is configured (or it can't be loaded) the callers fall back to the main
+    model. The utility model serves one housekeeping generation at a time.
+
+"""
+import threading
+import traceback
+from contextlib import contextmanager
+
+
+class HousekeepingRouter:
+    """
+    Args:
+        get_key (Callable): Returns the identifier of the configured utility model ("" when there is none).
+        load (Callable): load(key) builds the utility model instance, returns None on failure.
+    """
+    def __init__(self, get_key, load):
+        self.get_key = get_key
+        self.load = load
+        self.model = None
+        self._key = ""
+        self._load_lock = threading.Lock()
+        self._use_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.utility_generations = 0
+        self.fallback_generations = 0
+
+    def get_model(self):
+        """
+        The utility model, loaded (or reloaded when the configuration changed) on demand.
+        """
+        key = self.get_key() or ""
+        if key==self._key:
+            return self.model
+        with self._load_lock:
+            if key!=self._key:
+                # Wait for the running housekeeping generation before replacing the model
+                with self._use_lock:
+                    self.model = None
+                    if key:
+                        try:
+                            self.model = self.load(key)
+                        except Exception as ex:
+                            traceback.print_exc()
+                            self.model = None
+                    self._key = key
+        return self.model
+
+    @property
+    def available(self)->bool:
+        return self.model is not None and self._key==(self.get_key() or "")
+
+    def record(self, utility:bool):
+        with self._stats_lock:
+            if utility:
+                self.utility_generations += 1
+            else:
+                self.fallback_generations += 1
+
+    @contextmanager
+    def lease(self):
+        """
+        Yields the utility model for the exclusive use of the caller, or None if the main model must be used.
+        """
+        model = self.get_model()
+        if model is None:
+            self.record(False)
+            yield None
+            return
+        with self._use_lock:
+            self.record(True)
+            yield self.model
+
+    def generate(self, model, prompt:str, max_generation_size:int, ctx_size:int, callback=None, **gpt_params)->str:
+        """
+        Generates a short text with the utility model.
+
+        Args:
+            callback (Callable, optional): Receives the chunks, generation stops if it returns False.
+        """
+        n_prompt_tokens = len(model.tokenize(prompt))
+        max_generation_size = min(ctx_size - n_prompt_tokens, max_generation_size or ctx_size)
+        text = [""]
+        def receive(chunk, message_type, *args, **kwargs):
+            if chunk:
+                text[0] += chunk
+            # Sinks returning None (personality.sink) don't stop the generation
+            return callback is None or callback(chunk, message_type) is not False
+        model.generate(prompt, max(max_generation_size, 1), receive, **gpt_params)
+        return text[0].replace("</s>", "").replace("<s>", "").strip()
+
+    def to_dict(self):
+        with self._stats_lock:
+            return {
+                "utility_model":            self._key,
+                "utility_model_loaded":     self.model is not None,
+                "utility_generations":      self.utility_generations,
+                "fallback_generations":     self.fallback_generations
+            }
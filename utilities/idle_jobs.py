@@ -0,0 +1,116 @@
+"""
+project: lollms_webui
+file: idle_jobs.py
+author: ParisNeo
+description:
+    Low priority jobs using the model only when no generation is running or waiting (discussion
+    titles for example). Jobs are run in batches on a worker lane while the server stays idle.
+    A generation request pre-empts the running job: its cancellation token is set, the job stops
+    at its next chunk and is put back at the front of the queue to be run at the next idle time.
+
+"""
+import threading
+import traceback
+from collections import OrderedDict
+
+from utilities.cancellation import CancellationToken
+from utilities.worker_lanes import WorkerLane
+
+
+class IdleJobQueue:
+    """
+    Args:
+        lane (WorkerLane): Lane running the batches.
+        is_idle (Callable): Returns True when the jobs can use the model.
+        batch_size (int): Maximum number of jobs run in a row.
+    """
+    def __init__(self, lane:WorkerLane, is_idle, batch_size:int=4):
+        self.lane = lane
+        self.is_idle = is_idle
+        self.batch_size = max(batch_size, 1)
+        # Pending jobs by key, a job submitted again with the same key replaces the previous one
+        self._pending = OrderedDict()
+        self._current = None
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.preempted = 0
+
+    @property
+    def pending(self)->int:
+        return len(self._pending)
+
+    def submit(self, key, job):
+        """
+        Queues a job.
+
+        Args:
+            key: Identifies the job (for example the discussion id).
+            job (Callable): job(token) runs the job, checking the cancellation token on each received chunk.
+                            It returns False if it could not run now and must be retried later.
+        """
+        with self._lock:
+            self._pending[key] = job
+        self.schedule()
+
+    def schedule(self):
+        """
+        Starts a batch if jobs are pending and the server is idle. Called when the server may have become idle.
+        """
+        with self._lock:
+            if self._scheduled or not self._pending or not self.is_idle():
+                return
+            self._scheduled = True
+        if not self.lane.submit(self._run_batch):
+            with self._lock:
+                self._scheduled = False
+
+    def preempt(self):
+        """
+        Stops the running job (an interactive request needs the model).
+        """
+        with self._lock:
+            current = self._current
+        if current is not None and current[2].cancel():
+            self.preempted += 1
+
+    def _run_batch(self):
+        interrupted = False
+        try:
+            for _ in range(self.batch_size):
+                with self._lock:
+                    if not self._pending or not self.is_idle():
+                        break
+                    key, job = self._pending.popitem(last=False)
+                    token = CancellationToken()
+                    self._current = (key, job, token)
+                try:
+                    done = job(token)
+                except Exception as ex:
+                    # A failing job is not retried
+                    traceback.print_exc()
+                    done = True
+                with self._lock:
+                    self._current = None
+                    if token.cancelled or done is False:
+                        if key not in self._pending:
+                            self._pending[key] = job
+                            self._pending.move_to_end(key, last=False)
+                        interrupted = True
+                        break
+                    self.completed += 1
+        finally:
+            with self._lock:
+                self._scheduled = False
+        # Keep going while the server stays idle, an interrupted job waits for the next idle time
+        if not interrupted:
+            self.schedule()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "jobs_pending":     len(self._pending),
+                "job_running":      self._current is not None,
+                "jobs_completed":   self.completed,
+                "jobs_preempted":   self.preempted
+            }
@@ -0,0 +1,169 @@
+"""
+project: lollms_webui
+file: keyword_extraction.py
+author: ParisNeo
+description:
+    Statistical search keywords for the documents retrieval, used instead of asking the model to
+    rewrite the last prompt of the discussion (one generation less before each answer).
+    The words of the prompt (and, with a lower weight, of the previous messages) are scored by their
+    frequency times their inverse document frequency in the chunks of the vector database, so the
+    words that actually discriminate between the chunks are kept. Keywords are cached by prompt.
+
+"""
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from utilities.token_cache import text_hash
+
+# Marker ending the query rewriting prompt built by the core when data_vectorization_build_keys_words is on
+QUERY_REWRITE_MARKER = "enhanced query:"
+DISCUSSION_MARKER = "discussion:\n"
+
+WORD_PATTERN = re.compile(r"[^\W_][\w\-']*[^\W_]|[^\W_]", re.UNICODE)
+
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are aren't as at be because been before being below
+between both but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each
+few for from further had hadn't has hasn't have haven't having he he'd he'll he's her here here's hers herself
+him himself his how how's i i'd i'll i'm i've if in into is isn't it it's its itself let's me more most mustn't
+my myself no nor not of off on once only or other ought our ours ourselves out over own same shan't she she'd
+she'll she's should shouldn't so some such than that that's the their theirs them themselves then there there's
+these they they'd they'll they're they've this those through to too under until up very was wasn't we we'd we'll
+we're we've were weren't what what's when when's where where's which while who who's whom why why's with won't
+would wouldn't you you'd you'll you're you've your yours yourself yourselves
+please tell give explain show want need know like also just could would make get use using thanks thank
+""".split())
+
+
+def words(text:str)->list:
+    """
+    Lower case words of a text, without stop words and numbers alone.
+    """
+    return [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS and not word.isdigit() and len(word)>1]
+
+
+def split_rewrite_prompt(prompt:str, separator:str="!@>"):
+    """
+    Finds the messages of the discussion in a query rewriting prompt.
+
+    Returns:
+        list: The contents of the messages, in order, or None if prompt is not a query rewriting prompt
+    """
+    end = prompt.rfind(QUERY_REWRITE_MARKER)
+    start = prompt.rfind(DISCUSSION_MARKER, 0, end)
+    if end<0 or start<0 or prompt[end+len(QUERY_REWRITE_MARKER):].strip()!="":
+        return None
+    discussion = prompt[start+len(DISCUSSION_MARKER):end]
+    if discussion.endswith(separator):
+        discussion = discussion[:-len(separator)]
+    messages = []
+    for part in discussion.split(separator):
+        # Each message starts with its sender name
+        sender, _, content = part.partition(":")
+        if content.strip():
+            messages.append(content.strip())
+    return messages
+
+
+class DocumentFrequencies:
+    """
+    Number of chunks of a vector database containing each word.
+    """
+    def __init__(self, texts:list=()):
+        self.nb_documents = 0
+        self.frequencies = Counter()
+        for text in texts:
+            self.nb_documents += 1
+            self.frequencies.update(set(words(text)))
+
+    def idf(self, word:str)->float:
+        return math.log((1 + self.nb_documents)/(1 + self.frequencies.get(word, 0))) + 1
+
+
+class KeywordExtractor:
+    """
+    Args:
+        max_keywords (int): Maximum number of keywords returned.
+        context_weight (float): Weight of the words of the previous messages relative to the prompt ones.
+    """
+    def __init__(self, max_keywords:int=8, context_weight:float=0.3):
+        self.max_keywords = max_keywords
+        self.context_weight = context_weight
+
+    def scores(self, query:str, context:list=(), frequencies:DocumentFrequencies=None)->dict:
+        term_frequencies = Counter(words(query))
+        for message in context:
+            for word, count in Counter(words(message)).items():
+                term_frequencies[word] += self.context_weight*count
+        scores = {}
+        for word, tf in term_frequencies.items():
+            if frequencies is None or frequencies.nb_documents==0:
+                scores[word] = tf
+            elif word in frequencies.frequencies:
+                scores[word] = tf*frequencies.idf(word)
+            else:
+                # Words missing from the database can't match any chunk with a tf-idf vectorizer,
+                # they are kept for the semantic vectorizers with a lower score
+                scores[word] = 0.5*tf
+        return scores
+
+    def extract(self, query:str, context:list=(), frequencies:DocumentFrequencies=None)->str:
+        """
+        Returns:
+            str: The best keywords, in their order of appearance in the query then the context
+        """
+        scores = self.scores(query, context, frequencies)
+        best = set(sorted(scores, key=lambda word: -scores[word])[:self.max_keywords])
+        keywords = []
+        for word in words(query) + [word for message in reversed(context) for word in words(message)]:
+            if word in best and word not in keywords:
+                keywords.append(word)
+        return " ".join(keywords)
+
+
+class KeywordCache:
+    """
+    LRU cache of the search keywords of the prompts.
+
+    Args:
+        max_entries (int): Maximum number of cached prompts. 0 disables the cache.
+    """
+    def __init__(self, max_entries:int=256):
+        self.max_entries = max(max_entries, 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key:tuple, build)->str:
+        """
+        Returns the keywords of key, calling build() only if they are not cached.
+
+        Args:
+            key (tuple): Identifies the prompt (mode, database and prompt text).
+        """
+        key = tuple(text_hash(part) if isinstance(part, str) else part for part in key)
+        with self._lock:
+            keywords = self._entries.get(key)
+            if keywords is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return keywords
+            self.misses += 1
+        keywords = build()
+        if self.max_entries>0 and keywords:
+            with self._lock:
+                self._entries[key] = keywords
+                while len(self._entries)>self.max_entries:
+                    self._entries.popitem(last=False)
+        return keywords
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "keywords_cache_entries":   len(self._entries),
+                "keywords_cache_hits":      self.hits,
+                "keywords_cache_misses":    self.misses
+            }
@@ -0,0 +1,283 @@
+"""
+project: lollms_webui
+file: kv_state_cache.py
+author: ParisNeo
+description:
+    Cache of the model states (KV cache) at the end of the generations, per discussion.
+    Continuing, regenerating or answering a follow-up message sends a prompt sharing a long prefix
+    with the text the model processed during the previous generation of the discussion. When the
+    binding can save and restore its state (llama.cpp for example), the state saved after that
+    generation is loaded before generating so that only the part of the prompt after the common
+    prefix has to be processed (the binding compares the tokens of the loaded state with the prompt).
+    The last states are kept in memory, older ones are spilled to the discussion folder. The index of
+    the spilled states only lives in memory, so the files left by a previous run are deleted at startup.
+
+"""
+import pickle
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+from utilities.stream_protocol import common_prefix_length
+
+
+def kv_state_handler(model):
+    """
+    Finds the state saving functions of a model instance: save_state()/load_state(state) on the
+    binding itself or on the model object it wraps (llama-cpp-python).
+
+    Returns:
+        tuple: (save_state, load_state) or None if the binding does not support it
+    """
+    for target in (model, getattr(model, "model", None)):
+        if target is not None and callable(getattr(target, "save_state", None)) and callable(getattr(target, "load_state", None)):
+            return target.save_state, target.load_state
+    return None
+
+
+def delete_spilled_states(paths)->int:
+    """
+    Deletes state files (left by a previous run or by deleted discussions).
+
+    Returns:
+        int: The number of deleted files
+    """
+    deleted = 0
+    for path in paths:
+        try:
+            Path(path).unlink()
+            deleted += 1
+        except Exception as ex:
+            traceback.print_exc()
+    return deleted
+
+
+class KVStateStats:
+    """
+    Prefix hit rate and time to first token with and without a restored state.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.reused_chars = 0
+        self.prompt_chars = 0
+        self.ttft_hit_ms = 0.0
+        self.ttft_hits = 0
+        self.ttft_miss_ms = 0.0
+        self.ttft_misses = 0
+
+    def record_lookup(self, prompt_chars:int, reused_chars:int):
+        with self._lock:
+            self.lookups += 1
+            self.prompt_chars += prompt_chars
+            if reused_chars>0:
+                self.hits += 1
+                self.reused_chars += reused_chars
+
+    def record_ttft(self, ttft_ms:float, hit:bool):
+        with self._lock:
+            if hit:
+                self.ttft_hit_ms += ttft_ms
+                self.ttft_hits += 1
+            else:
+                self.ttft_miss_ms += ttft_ms
+                self.ttft_misses += 1
+
+    def to_dict(self):
+        with self._lock:
+            mean_hit = self.ttft_hit_ms/self.ttft_hits if self.ttft_hits else 0
+            mean_miss = self.ttft_miss_ms/self.ttft_misses if self.ttft_misses else 0
+            return {
+                "kv_lookups":               self.lookups,
+                "kv_prefix_hit_rate":       self.hits/self.lookups if self.lookups else 0,
+                "kv_reused_prompt_ratio":   self.reused_chars/self.prompt_chars if self.prompt_chars else 0,
+                "kv_mean_ttft_hit_ms":      mean_hit,
+                "kv_mean_ttft_miss_ms":     mean_miss,
+                # Estimated from the mean time to first token of the generations without a state
+                "kv_ttft_saved_ms":         max(mean_miss - mean_hit, 0)*self.ttft_hits if self.ttft_misses else 0
+            }
+
+
+class KVStateEntry:
+    def __init__(self, discussion_id, model_key:str, text:str, state, spill_path:Path=None):
+        self.discussion_id = discussion_id
+        self.model_key = model_key
+        # The text processed by the model when the state was saved
+        self.text = text
+        self.state = state
+        self.spill_path = spill_path
+
+
+class KVStateCache:
+    """
+    Args:
+        max_entries (int): Number of states kept in memory (all discussions).
+        max_entries_per_discussion (int): Number of states kept for each discussion (memory and disk).
+        min_prefix (int): Minimum number of characters shared with the prompt for a state to be used.
+    """
+    def __init__(self, max_entries:int=4, max_entries_per_discussion:int=2, min_prefix:int=256):
+        self.max_entries = max(max_entries, 0)
+        self.max_entries_per_discussion = max(max_entries_per_discussion, 1)
+        self.min_prefix = min_prefix
+        self.stats = KVStateStats()
+        self._discussions = {}
+        # Entries having their state in memory, least recently used first
+        self._in_memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, discussion_id, model_key:str, prompt:str):
+        """
+        Finds the state sharing the longest prefix with a prompt.
+
+        Returns:
+            tuple: (state, prefix_length) or (None, 0)
+        """
+        best, best_length = None, 0
+        with self._lock:
+            for entry in self._discussions.get(discussion_id, []):
+                if entry.model_key!=model_key:
+                    continue
+                length = common_prefix_length(entry.text, prompt)
+                if length>best_length:
+                    best, best_length = entry, length
+            if best is None or best_length<self.min_prefix:
+                best, best_length = None, 0
+            elif best.state is not None:
+                self._in_memory.move_to_end(id(best))
+            state = best.state if best is not None else None
+            spill_path = best.spill_path if best is not None else None
+        if best is not None and state is None:
+            try:
+                with open(spill_path, "rb") as f:
+                    state = pickle.load(f)
+            except Exception as ex:
+                traceback.print_exc()
+                best_length = 0
+        self.stats.record_lookup(len(prompt), best_length)
+        return state, best_length
+
+    def store(self, discussion_id, model_key:str, text:str, state, spill_folder:Path=None):
+        """
+        Records the state of a model after it processed text.
+
+        Args:
+            spill_folder (Path, optional): Where the state is written when it leaves the memory (dropped if None).
+        """
+        entry = KVStateEntry(discussion_id, model_key, text, state)
+        if spill_folder is not None:
+            entry.spill_path = Path(spill_folder)/f"kv_state_{int(time.time()*1000)}_{id(entry)}.bin"
+        to_spill, to_delete = [], []
+        with self._lock:
+            entries = self._discussions.setdefault(discussion_id, [])
+            entries.append(entry)
+            while len(entries)>self.max_entries_per_discussion:
+                old = entries.pop(0)
+                self._in_memory.pop(id(old), None)
+                to_delete.append(old)
+            self._in_memory[id(entry)] = entry
+            while len(self._in_memory)>self.max_entries:
+                _, old = self._in_memory.popitem(last=False)
+                if old.spill_path is not None:
+                    to_spill.append((old, old.state))
+                else:
+                    self._discussions[old.discussion_id].remove(old)
+                old.state = None
+        for old, old_state in to_spill:
+            try:
+                old.spill_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(old.spill_path, "wb") as f:
+                    pickle.dump(old_state, f)
+            except Exception as ex:
+                traceback.print_exc()
+                self._forget(old)
+        for old in to_delete:
+            self._delete_file(old)
+
+    def _forget(self, entry:KVStateEntry):
+        with self._lock:
+            entries = self._discussions.get(entry.discussion_id, [])
+            if entry in entries:
+                entries.remove(entry)
+        self._delete_file(entry)
+
+    def _delete_file(self, entry:KVStateEntry):
+        if entry.spill_path is not None and entry.spill_path.exists():
+            try:
+                entry.spill_path.unlink()
+            except Exception as ex:
+                traceback.print_exc()
+
+    def forget(self, discussion_id, spill_folder:Path=None):
+        """
+        Drops the states of a discussion (deleted discussion).
+
+        Args:
+            spill_folder (Path, optional): Folder of the spilled states of the discussion, emptied too.
+        """
+        with self._lock:
+            entries = self._discussions.pop(discussion_id, [])
+            for entry in entries:
+                self._in_memory.pop(id(entry), None)
+        for entry in entries:
+            self._delete_file(entry)
+        if spill_folder is not None and Path(spill_folder).exists():
+            delete_spilled_states(Path(spill_folder).glob("kv_state_*.bin"))
+
+
+class KVStateSession:
+    """
+    Use of the cache by one generation: restores the best state before generating, measures the
+    time to first token and saves the state once the generation is done.
+
+    Args:
+        cache (KVStateCache): The cache.
+        handler (tuple): (save_state, load_state) returned by kv_state_handler.
+        discussion_id: The discussion being generated.
+        model_key (str): Identifies the model.
+        prompt (str): The full prompt.
+        spill_folder (Path, optional): Folder of the discussion.
+    """
+    def __init__(self, cache:KVStateCache, handler, discussion_id, model_key:str, prompt:str, spill_folder:Path=None):
+        self.cache = cache
+        self.save_state, self.load_state = handler
+        self.discussion_id = discussion_id
+        self.model_key = model_key
+        self.prompt = prompt
+        self.spill_folder = spill_folder
+        self.hit = False
+        self.start_time = None
+        self.first_chunk_time = None
+
+    def restore(self):
+        state, prefix_length = self.cache.lookup(self.discussion_id, self.model_key, self.prompt)
+        if state is not None:
+            try:
+                self.load_state(state)
+                self.hit = True
+            except Exception as ex:
+                traceback.print_exc()
+        self.start_time = time.perf_counter()
+        return prefix_length if self.hit else 0
+
+    def wrap(self, callback):
+        """
+        Returns a callback recording when the first chunk is received.
+        """
+        def timed_callback(*args, **kwargs):
+            if self.first_chunk_time is None:
+                self.first_chunk_time = time.perf_counter()
+            return callback(*args, **kwargs) if callback is not None else True
+        return timed_callback
+
+    def save(self, output:str):
+        if self.first_chunk_time is not None:
+            self.cache.stats.record_ttft((self.first_chunk_time-self.start_time)*1000, self.hit)
+        try:
+            state = self.save_state()
+        except Exception as ex:
+            traceback.print_exc()
+            return
+        self.cache.store(self.discussion_id, self.model_key, self.prompt + (output or ""), state, self.spill_folder)
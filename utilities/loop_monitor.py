@@ -0,0 +1,170 @@
+"""
+project: lollms_webui
+file: loop_monitor.py
+author: ParisNeo
+description:
+    Event loop lag monitor of the socket.io server.
+    A heartbeat task wakes up on the loop at a fixed interval and measures how late it is. A watchdog
+    thread checks the heartbeat: when the loop has not run it for longer than the threshold, the stack
+    of the loop thread is captured while the stall is still going on, and the socket.io handler found
+    in it names the stall. The stall is reported once the loop runs again, with its duration.
+
+"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+
+class LoopStall:
+    def __init__(self, started_at:float, handler:str=None, stack:list=None):
+        self.started_at = started_at
+        self.handler = handler
+        self.stack = stack or []
+        self.duration_ms = None
+
+    def to_dict(self):
+        return {
+            "started_at":   self.started_at,
+            "duration_ms":  self.duration_ms,
+            "handler":      self.handler,
+            "stack":        self.stack
+        }
+
+
+class LoopLagMonitor:
+    """
+    Args:
+        threshold_ms (float): Lag above which the loop is considered stalled.
+        interval_ms (float): Heartbeat and watchdog period.
+        max_stalls (int): Number of stalls kept for last().
+        on_stall (Callable, optional): Called with each finished LoopStall (on the loop thread).
+    """
+    def __init__(self, threshold_ms:float=100, interval_ms:float=20, max_stalls:int=100, on_stall=None):
+        self.threshold = max(threshold_ms, 1)/1000
+        self.interval = max(interval_ms, 1)/1000
+        self.on_stall = on_stall
+        self.loop = None
+        self.nb_stalls = 0
+        self.max_lag_ms = 0.0
+        self._stalls = deque(maxlen=max(max_stalls, 1))
+        # code object -> name of the registered handlers
+        self._handlers = {}
+        self._beat = None
+        self._loop_thread_id = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+        self._watchdog = None
+
+    def register(self, name:str, handler):
+        """
+        Names the stalls happening while handler runs on the loop.
+        """
+        handler = getattr(handler, "__wrapped__", handler)
+        code = getattr(handler, "__code__", None)
+        if code is not None:
+            self._handlers[code] = name
+
+    def register_socketio_handlers(self, handlers:dict):
+        """
+        Registers the handlers of a socket.io server (sio.handlers: namespace -> event -> handler).
+        """
+        for namespace, events in handlers.items():
+            for event, handler in events.items():
+                self.register(event if namespace=="/" else f"{namespace}:{event}", handler)
+
+    def start(self, loop:asyncio.AbstractEventLoop):
+        """
+        Starts monitoring the loop. Must be called from the loop thread, does nothing if already started.
+        """
+        if self.loop is loop and self._task is not None and not self._task.done():
+            return
+        self.loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stop.clear()
+        self._task = loop.create_task(self._heartbeat())
+        if self._watchdog is None or not self._watchdog.is_alive():
+            self._watchdog = threading.Thread(target=self._watch, name="loop_lag_monitor", daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while not self._stop.is_set():
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._beat = now
+            self._record_lag(now - expected)
+
+    def _record_lag(self, lag:float):
+        self.max_lag_ms = max(self.max_lag_ms, lag*1000)
+        with self._lock:
+            stall = self._pending
+            self._pending = None
+        if lag<self.threshold:
+            return
+        if stall is None:
+            # Shorter than the watchdog period, the culprit was not caught in the act
+            stall = LoopStall(time.time()-lag)
+        stall.duration_ms = lag*1000
+        self.nb_stalls += 1
+        self._stalls.append(stall)
+        if self.on_stall is not None:
+            try:
+                self.on_stall(stall)
+            except Exception as ex:
+                traceback.print_exc()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if beat is None or time.perf_counter() - beat - self.interval<self.threshold:
+                continue
+            with self._lock:
+                if self._pending is not None:
+                    continue
+            stall = self.capture()
+            with self._lock:
+                # The loop may have come back in the meantime
+                if self._beat==beat:
+                    self._pending = stall
+
+    def capture(self)->LoopStall:
+        """
+        What the loop thread is running now.
+        """
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = []
+        handler = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+            # The outermost handler is kept
+            handler = self._handlers.get(code, handler)
+            frame = frame.f_back
+        return LoopStall(time.time()-(time.perf_counter()-self._beat), handler, stack[::-1])
+
+    def last(self, n:int=20)->list:
+        """
+        The n last stalls, the most recent first.
+        """
+        return [stall.to_dict() for stall in list(self._stalls)[::-1][:max(n, 0)]]
+
+    def to_dict(self):
+        return {
+            "running":          self._task is not None and not self._task.done(),
+            "threshold_ms":     self.threshold*1000,
+            "nb_stalls":        self.nb_stalls,
+            "max_lag_ms":       self.max_lag_ms
+        }
@@ -0,0 +1,127 @@
+"""
+project: lollms_webui
+file: memory_introspection.py
+author: ParisNeo
+description:
+    Tools to find out what the long lived server keeps in memory.
+    TracemallocSnapshots takes tracemalloc snapshots on demand and compares them (the allocations
+    that grew between two snapshots point to the code retaining memory). approximate_size walks the
+    objects reachable from an object (client session, personality, vector database) to estimate the
+    memory it retains, without entering the shared objects it is told to skip (the server, the model).
+
+"""
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import OrderedDict
+
+# Objects shared by everything, never counted in the size of an object
+SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.CodeType, types.FrameType, threading.Thread)
+
+
+def approximate_size(root, skip_ids:set=frozenset(), max_objects:int=200000)->dict:
+    """
+    Approximate number of bytes retained by an object: the sum of the sizes of the objects reachable
+    from it, each object being counted once.
+
+    Args:
+        root: The object.
+        skip_ids (set): ids of objects not to enter (shared objects like the server or the model).
+        max_objects (int): Maximum number of visited objects (the size is then a lower bound).
+
+    Returns:
+        dict: {"bytes", "objects", "truncated"}
+    """
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack and len(seen)<max_objects:
+        obj = stack.pop()
+        obj_id = id(obj)
+        if obj_id in seen or (obj_id in skip_ids and obj is not root) or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(obj_id)
+        try:
+            size += sys.getsizeof(obj)
+        except Exception:
+            pass
+        stack.extend(gc.get_referents(obj))
+    return {"bytes": size, "objects": len(seen), "truncated": bool(stack)}
+
+
+class TracemallocSnapshots:
+    """
+    Named tracemalloc snapshots.
+
+    Args:
+        max_snapshots (int): Number of snapshots kept, the oldest ones are dropped.
+    """
+    def __init__(self, max_snapshots:int=4):
+        self.max_snapshots = max(max_snapshots, 2)
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    @property
+    def tracing(self)->bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, nframes:int=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+
+    def stop(self):
+        """
+        Stops tracing (it slows down every allocation) and drops the snapshots.
+        """
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with self._lock:
+            self._snapshots.clear()
+
+    def take(self)->int:
+        """
+        Returns:
+            int: The id of the new snapshot
+        """
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self._snapshots)>self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return snapshot_id
+
+    def _get(self, snapshot_id:int):
+        with self._lock:
+            entry = self._snapshots.get(snapshot_id)
+        if entry is None:
+            raise KeyError(f"Unknown snapshot {snapshot_id}")
+        return entry[1]
+
+    def list(self)->list:
+        with self._lock:
+            return [{"id": snapshot_id, "taken_at": taken_at, "traced_bytes": sum(stat.size for stat in snapshot.statistics("filename"))} for snapshot_id, (taken_at, snapshot) in self._snapshots.items()]
+
+    def top(self, snapshot_id:int, limit:int=20, key_type:str="lineno")->list:
+        stats = self._get(snapshot_id).statistics(key_type)
+        return [{"location": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in stats[:limit]]
+
+    def diff(self, first_id:int, second_id:int, limit:int=20, key_type:str="lineno")->list:
+        """
+        The allocations that changed the most from the first snapshot to the second one.
+        """
+        stats = self._get(second_id).compare_to(self._get(first_id), key_type)
+        return [
+            {"location": str(stat.traceback), "bytes_diff": stat.size_diff, "bytes": stat.size, "count_diff": stat.count_diff, "count": stat.count}
+            for stat in stats[:limit]
+        ]
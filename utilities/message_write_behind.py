@@ -0,0 +1,113 @@
+"""
+project: lollms_webui
+file: message_write_behind.py
+author: ParisNeo
+description:
+    Write-behind persistence for the message being generated.
+    The streamed content is kept in memory and checkpointed to the discussion database at
+    a fixed interval instead of rewriting the whole message row for every received token.
+    A crash can lose at most the tokens received during the last interval.
+
+"""
+import threading
+import time
+
+
+class WriteBehindStats:
+    """
+    Counts the database writes performed and the ones that were avoided.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.db_writes = 0
+        self.db_writes_saved = 0
+
+    def record_write(self):
+        with self._lock:
+            self.db_writes += 1
+
+    def record_saved(self):
+        with self._lock:
+            self.db_writes_saved += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "db_writes":        self.db_writes,
+                "db_writes_saved":  self.db_writes_saved
+            }
+
+
+class MessageWriteBehind:
+    """
+    Holds the latest state of an in-flight message and writes it back periodically.
+
+    Args:
+        write (Callable): Called with the pending state (content and keyword arguments) to persist it.
+        interval_ms (int): Checkpoint interval. 0 writes on every update (no buffering).
+        stats (WriteBehindStats, optional): Counters to update.
+    """
+    def __init__(self, write, interval_ms:int=1000, stats:WriteBehindStats=None):
+        self.write = write
+        self.interval = max(interval_ms, 0)/1000
+        self.stats = stats
+
+        self._pending = None
+        # Keyword arguments of the latest update, reused by close()
+        self._kwargs = None
+        self._last_write_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self)->bool:
+        return self._pending is not None
+
+    def update(self, content, **kwargs):
+        """
+        Records the new state of the message (any value can be a callable returning it).
+        It is written immediately if the last checkpoint is older than the interval, otherwise it
+        stays in memory until the next checkpoint.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            if self._pending is not None and self.stats:
+                # The previous state will never reach the database
+                self.stats.record_saved()
+            self._pending = (content, kwargs)
+            self._kwargs = kwargs
+            if now - self._last_write_time >= self.interval:
+                self._write(now)
+
+    def flush_if_due(self):
+        now = time.perf_counter()
+        with self._lock:
+            if self._pending is not None and now - self._last_write_time >= self.interval:
+                self._write(now)
+
+    def flush(self):
+        with self._lock:
+            self._write(time.perf_counter())
+
+    def close(self, content, **kwargs):
+        """
+        Writes the final state of the message, replacing any pending checkpoint.
+        The given keyword arguments override the ones of the latest update. Nothing is written if the
+        message was never updated.
+        """
+        with self._lock:
+            if self._kwargs is None:
+                return
+            self._pending = (content, {**self._kwargs, **kwargs})
+            self._write(time.perf_counter())
+
+    def _write(self, now:float):
+        # Must be called with the lock held so that checkpoints are written in order
+        if self._pending is None:
+            return
+        content, kwargs = self._pending
+        self._pending = None
+        self._last_write_time = now
+        # Values can be given lazily so that they are only materialized when they are written
+        self.write(content() if callable(content) else content, **{k:v() if callable(v) else v for k,v in kwargs.items()})
+        if self.stats:
+            self.stats.record_write()
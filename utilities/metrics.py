@@ -0,0 +1,179 @@
+"""
+project: lollms_webui
+file: metrics.py
+author: ParisNeo
+description:
+    Generation latency and throughput metrics exposed in the Prometheus text format (/metrics).
+    Histograms and counters are kept per label values (binding, model, personality). Recording a
+    value is a dictionary lookup, a bisection in the buckets and a few additions under a lock, cheap
+    enough to be done for every received token.
+
+"""
+import threading
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+GENERATION_LABELS = ("binding", "model", "personality")
+
+
+def escape_label_value(value)->str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names:tuple, values:tuple, extra:str="")->str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name:str, help:str, label_names:tuple=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels:tuple=(), amount:float=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels:tuple=())->float:
+        return self._values.get(labels, 0)
+
+    def render(self)->list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name:str, help:str, buckets:tuple, label_names:tuple=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = label_names
+        # labels -> [count of each bucket (not cumulated) + overflow, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, labels:tuple=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = [[0]*(len(self.buckets)+1), 0.0, 0]
+                self._series[labels] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, labels:tuple=())->int:
+        series = self._series.get(labels)
+        return series[2] if series is not None else 0
+
+    def render(self)->list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(series[0]), series[1], series[2]) for labels, series in self._series.items()]
+        for labels, counts, total, count in snapshot:
+            cumulated = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulated}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix:str="lollms_"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name:str, help:str, label_names:tuple=())->Counter:
+        metric = Counter(self.prefix+name, help, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name:str, help:str, buckets:tuple, label_names:tuple=())->Histogram:
+        metric = Histogram(self.prefix+name, help, buckets, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self)->str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class GenerationTimer:
+    """
+    Timestamps of one generation request (time.perf_counter values).
+    """
+    def __init__(self, labels:tuple=()):
+        self.labels = labels
+        self.started_at = time.perf_counter()
+        self.generate_started_at = None
+        self.first_chunk_at = None
+        self.last_chunk_at = None
+        self.nb_chunks = 0
+
+
+class GenerationMetrics:
+    """
+    The generation metrics of the server.
+    """
+    def __init__(self, registry:MetricsRegistry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        r = self.registry
+        self.requests = r.counter("generation_requests_total", "Generation requests started.", GENERATION_LABELS)
+        self.cancellations = r.counter("generation_cancellations_total", "Generations stopped by their client.", GENERATION_LABELS)
+        self.antiprompt_stops = r.counter("generation_antiprompt_stops_total", "Generations stopped because an antiprompt was detected.", GENERATION_LABELS)
+        self.busy_rejections = r.counter("generation_busy_rejections_total", "Requests refused because the server was busy or the queue was full.", GENERATION_LABELS)
+        self.ttft = r.histogram("generation_time_to_first_token_seconds", "Time between the request and its first generated token.", LATENCY_BUCKETS, GENERATION_LABELS)
+        self.prefill = r.histogram("generation_prefill_seconds", "Time between the call to the model and its first token (prompt processing).", LATENCY_BUCKETS, GENERATION_LABELS)
+        self.inter_token = r.histogram("generation_inter_token_seconds", "Time between two generated tokens.", INTER_TOKEN_BUCKETS, GENERATION_LABELS)
+        self.total = r.histogram("generation_duration_seconds", "Total duration of the generation requests.", LATENCY_BUCKETS, GENERATION_LABELS)
+        self.tokens_per_second = r.histogram("generation_tokens_per_second", "Generation speed after the first token.", TOKENS_PER_SECOND_BUCKETS, GENERATION_LABELS)
+
+    def start(self, labels:tuple)->GenerationTimer:
+        self.requests.inc(labels)
+        return GenerationTimer(labels)
+
+    def generate_started(self, timer:GenerationTimer):
+        """
+        The model starts processing a prompt (a request can call the model several times).
+        """
+        timer.generate_started_at = time.perf_counter()
+
+    def chunk(self, timer:GenerationTimer):
+        now = time.perf_counter()
+        if timer.first_chunk_at is None:
+            timer.first_chunk_at = now
+            self.ttft.observe(now - timer.started_at, timer.labels)
+        if timer.generate_started_at is not None:
+            self.prefill.observe(now - timer.generate_started_at, timer.labels)
+            timer.generate_started_at = None
+        elif timer.last_chunk_at is not None:
+            self.inter_token.observe(now - timer.last_chunk_at, timer.labels)
+        timer.last_chunk_at = now
+        timer.nb_chunks += 1
+
+    def end(self, timer:GenerationTimer):
+        now = time.perf_counter()
+        self.total.observe(now - timer.started_at, timer.labels)
+        if timer.first_chunk_at is not None and timer.last_chunk_at>timer.first_chunk_at:
+            self.tokens_per_second.observe((timer.nb_chunks-1)/(timer.last_chunk_at-timer.first_chunk_at), timer.labels)
+
+    def render(self)->str:
+        return self.registry.render()
@@ -0,0 +1,141 @@
+"""
+project: lollms_webui
+file: model_pool.py
+author: ParisNeo
+description:
+    Pool of model instances.
+    Each generation leases one instance for its whole duration so that several clients can be
+    served in parallel, for example by N llama.cpp instances sharing the cpu cores. The first
+    instance is the main model of the server, which personalities and the core also use directly:
+    generations that need it (scripted personalities, internet search...) lease it explicitly.
+    A pool starts with the main model and grows as its other instances get built. When the main
+    model changes, the pool is retired: waiting leases are refused and the other instances are
+    disposed of as soon as their generations give them back.
+
+"""
+import threading
+from contextlib import contextmanager
+
+
+class ModelPool:
+    """
+    Args:
+        primary: The main model instance.
+        extra (list): The other instances.
+        n_threads (int): Total number of threads, split between the instances.
+        max_size (int, optional): Number of instances once the pool is complete (the current number if None).
+        dispose (Callable, optional): Called with the other instances of a retired pool once they are free.
+    """
+    def __init__(self, primary, extra:list=None, n_threads:int=None, max_size:int=None, dispose=None):
+        self.primary = primary
+        self.instances = [primary] + list(extra or [])
+        self.n_threads = n_threads
+        self.max_size = max(max_size or 0, len(self.instances))
+        self.dispose = dispose
+        self.retired = False
+        self._free = list(self.instances)
+        self._condition = threading.Condition()
+
+    @property
+    def size(self)->int:
+        return len(self.instances)
+
+    @property
+    def missing(self)->int:
+        """
+        Number of instances still to be built.
+        """
+        return self.max_size - self.size
+
+    def add(self, instance)->bool:
+        """
+        Adds a newly built instance.
+
+        Returns:
+            bool: False if the pool is retired or complete (the instance is not used)
+        """
+        with self._condition:
+            if self.retired or self.size>=self.max_size:
+                return False
+            self.instances.append(instance)
+            self._free.append(instance)
+            self._condition.notify_all()
+            return True
+
+    def retire(self):
+        """
+        Stops leasing instances. The free other instances are disposed of now, the leased ones when released.
+        """
+        with self._condition:
+            self.retired = True
+            disposed = [m for m in self._free if m is not self.primary]
+            self._free = []
+            self._condition.notify_all()
+        for instance in disposed:
+            self._dispose(instance)
+
+    def _dispose(self, instance):
+        if self.dispose is not None:
+            self.dispose(instance)
+
+    @property
+    def idle(self)->bool:
+        with self._condition:
+            return len(self._free)==len(self.instances)
+
+    @property
+    def threads_per_instance(self):
+        """
+        Share of the threads of each instance, None when the model decides.
+        """
+        if self.n_threads is None or self.n_threads<=0:
+            return None
+        return max(self.n_threads//self.max_size, 1)
+
+    def acquire(self, primary:bool=False, timeout:float=None):
+        """
+        Waits for a free instance. Secondary instances are preferred so that the main model stays
+        available for the generations that need it.
+
+        Args:
+            primary (bool): Only the main instance can be used.
+            timeout (float, optional): Maximum time to wait in seconds.
+
+        Returns:
+            The leased instance or None on timeout or if the pool is retired
+        """
+        def available():
+            if self.retired:
+                return True
+            if primary:
+                return self.primary in self._free
+            return len(self._free)>0
+        with self._condition:
+            if not self._condition.wait_for(available, timeout) or self.retired:
+                return None
+            if primary:
+                instance = self.primary
+            else:
+                secondary = [m for m in self._free if m is not self.primary]
+                instance = secondary[0] if secondary else self.primary
+            self._free.remove(instance)
+            return instance
+
+    def release(self, instance):
+        with self._condition:
+            if instance not in self.instances or instance in self._free:
+                return
+            if not self.retired:
+                self._free.append(instance)
+                self._condition.notify_all()
+                return
+        if instance is not self.primary:
+            self._dispose(instance)
+
+    @contextmanager
+    def lease(self, primary:bool=False):
+        instance = self.acquire(primary)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
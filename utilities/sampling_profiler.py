@@ -0,0 +1,131 @@
+"""
+project: lollms_webui
+file: sampling_profiler.py
+author: ParisNeo
+description:
+    On demand sampling profiler of the generation requests.
+    An admin arms the profiler for the next N generations (optionally of one client only). A profiled
+    generation gets a sampler thread reading the stack of the generation thread at a fixed interval
+    (sys._current_frames), so everything running on it is seen (personality workflows, binding
+    callbacks) without restarting the server under cProfile. The samples are written as collapsed
+    stacks (one "frame;frame;frame count" line per stack), the format read by flamegraph.pl and
+    speedscope. When the profiler is not armed, a generation only reads one attribute.
+
+"""
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+
+def frame_name(frame)->str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread.
+
+    Args:
+        thread_id (int): Identifier of the sampled thread (threading.get_ident()).
+        interval (float): Time between two samples in seconds.
+    """
+    def __init__(self, thread_id:int, interval:float=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.nb_samples = 0
+        self.started_at = None
+        self.duration = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling_profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+            self.nb_samples += 1
+
+    def stop(self)->Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at if self.started_at is not None else 0
+        return self.samples
+
+    def collapsed(self)->str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def write(self, path:Path)->Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.collapsed(), encoding="utf-8")
+        return path
+
+
+class ProfilingSwitch:
+    """
+    Admin switch deciding which generations are profiled.
+    """
+    def __init__(self):
+        self._armed = False
+        self._lock = threading.Lock()
+        self.remaining = 0
+        self.client_id = None
+        self.interval = 0.005
+        self.profiled = 0
+
+    def arm(self, count:int=1, client_id=None, interval_ms:float=5):
+        """
+        Profiles the next count generations (of client_id only if it is not None).
+        """
+        with self._lock:
+            self.remaining = max(count, 0)
+            self.client_id = client_id
+            self.interval = max(interval_ms, 1)/1000
+            self._armed = self.remaining>0
+
+    def disarm(self):
+        self.arm(0)
+
+    def take(self, client_id)->SamplingProfiler:
+        """
+        Starts profiling the current thread if the generation of client_id must be profiled.
+
+        Returns:
+            SamplingProfiler: The running profiler, or None
+        """
+        if not self._armed:
+            return None
+        with self._lock:
+            if self.remaining<=0 or (self.client_id is not None and self.client_id!=client_id):
+                return None
+            self.remaining -= 1
+            self._armed = self.remaining>0
+            self.profiled += 1
+            interval = self.interval
+        return SamplingProfiler(threading.get_ident(), interval).start()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "armed":        self._armed,
+                "remaining":    self.remaining,
+                "client_id":    self.client_id,
+                "interval_ms":  self.interval*1000,
+                "profiled":     self.profiled
+            }
@@ -0,0 +1,152 @@
+"""
+project: lollms_webui
+file: stream_coalescer.py
+author: ParisNeo
+description:
+    Time/size windowed coalescing of streamed text chunks.
+    Instead of sending one socket frame per generated token, the chunks of a message are
+    buffered and sent as a single frame every N ms or every M bytes, whichever comes first.
+
+"""
+import threading
+import time
+
+
+class StreamingStats:
+    """
+    Server wide counters used to tune the coalescing window.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.chunks_received = 0
+            self.frames_emitted = 0
+            self.total_flush_latency = 0.0
+            self.max_flush_latency = 0.0
+            self.streaming_time = 0.0
+            self.nb_messages = 0
+
+    def record_chunk(self):
+        with self._lock:
+            self.chunks_received += 1
+
+    def record_flush(self, latency:float):
+        with self._lock:
+            self.frames_emitted += 1
+            self.total_flush_latency += latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def record_message(self, duration:float):
+        with self._lock:
+            self.streaming_time += duration
+            self.nb_messages += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "chunks_received":          self.chunks_received,
+                "frames_emitted":           self.frames_emitted,
+                "chunks_per_frame":         self.chunks_received/self.frames_emitted if self.frames_emitted>0 else 0,
+                "emit_rate":                self.frames_emitted/self.streaming_time if self.streaming_time>0 else 0,
+                "avg_flush_latency_ms":     1000*self.total_flush_latency/self.frames_emitted if self.frames_emitted>0 else 0,
+                "max_flush_latency_ms":     1000*self.max_flush_latency,
+                "nb_messages":              self.nb_messages
+            }
+
+
+class StreamCoalescer:
+    """
+    Buffers the chunks of one streamed message and emits them in batches.
+
+    The first chunk of a window is held at most `interval_ms` milliseconds. The buffer is flushed
+    as soon as it reaches `max_bytes`, when `flush` is called explicitly (full rewrite, antiprompt,
+    message closing) or when the periodic ticker finds it due.
+
+    Args:
+        emit (Callable[[str], None]): Called with the coalesced text each time the buffer is flushed.
+        interval_ms (int): Maximum time a chunk may wait in the buffer.
+        max_bytes (int): Buffered size (utf-8 bytes) that triggers an immediate flush.
+        stats (StreamingStats, optional): Counters to update.
+    """
+    def __init__(self, emit, interval_ms:int=50, max_bytes:int=1024, stats:StreamingStats=None):
+        self.emit = emit
+        self.interval = max(interval_ms, 0)/1000
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+        self._chunks = []
+        self._size = 0
+        self._oldest_chunk_time = None
+        self._last_flush_time = None
+        self._created_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+        self.nb_chunks = 0
+        self.nb_frames = 0
+
+    @property
+    def pending(self)->bool:
+        return len(self._chunks)>0
+
+    def push(self, chunk:str):
+        """
+        Adds a chunk to the buffer and flushes it if the window is full.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            self._chunks.append(chunk)
+            self._size += len(chunk.encode("utf-8", errors="ignore"))
+            self.nb_chunks += 1
+            if self.stats:
+                self.stats.record_chunk()
+            if self._oldest_chunk_time is None:
+                self._oldest_chunk_time = now
+            if (self._size >= self.max_bytes
+                or self._last_flush_time is None
+                or now - self._last_flush_time >= self.interval):
+                self._flush(now)
+
+    def flush(self):
+        """
+        Immediately emits the buffered chunks if any.
+        """
+        with self._lock:
+            self._flush(time.perf_counter())
+
+    def flush_if_due(self):
+        """
+        Emits the buffered chunks if the oldest one has been waiting for a full window.
+        Called by the periodic ticker so that a stalled generation does not hold text back.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            if self._oldest_chunk_time is not None and now - self._oldest_chunk_time >= self.interval:
+                self._flush(now)
+
+    def close(self):
+        """
+        Flushes the remaining chunks and records the message statistics.
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self._flush(now)
+            if self.stats and self.nb_chunks>0:
+                self.stats.record_message(now - self._created_at)
+
+    def _flush(self, now:float):
+        # Must be called with the lock held so that frames leave in the order they were built
+        if not self._chunks:
+            return
+        text = "".join(self._chunks)
+        latency = now - self._oldest_chunk_time
+        self._chunks = []
+        self._size = 0
+        self._oldest_chunk_time = None
+        self._last_flush_time = now
+        self.nb_frames += 1
+        if self.stats:
+            self.stats.record_flush(latency)
+        self.emit(text)
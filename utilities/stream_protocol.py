@@ -0,0 +1,338 @@
+"""
+project: lollms_webui
+file: stream_protocol.py
+author: ParisNeo
+description:
+    Compact streaming protocol for the messages being generated.
+    When a message opens, a header frame carries all its static fields. Then each frame only carries
+    the message id, a sequence number and what actually changed (text, parameters, metadata).
+    Full rewrites of the text are sent as splice operations (common prefix/suffix diff) against the
+    content the client has built from the previous frames.
+    Frames can be sent as plain dictionaries (json) or packed with msgpack when it is installed.
+    Frontends that do not negotiate this protocol keep receiving the legacy update_message events.
+
+"""
+import copy
+import threading
+from collections import deque
+
+from utilities.text_buffer import GeneratedTextBuffer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_DELTA  = "delta"
+
+ENCODING_JSON    = "json"
+ENCODING_MSGPACK = "msgpack"
+
+# Frame types
+FRAME_HEADER = "h"
+FRAME_CHUNK  = "c"
+FRAME_UPDATE = "u"
+FRAME_CLOSE  = "e"
+FRAME_DIFF   = "d"
+FRAME_RESYNC = "r"
+
+_UNSET = object()
+
+
+def negotiate_protocol(protocol:str=None, encoding:str=None):
+    """
+    Chooses the protocol and encoding to use for a client from what it asked for.
+    Unknown protocols fall back to the legacy format and msgpack falls back to json when it is not installed.
+
+    Returns:
+        tuple: (protocol, encoding)
+    """
+    if protocol!=PROTOCOL_DELTA:
+        return PROTOCOL_LEGACY, ENCODING_JSON
+    if encoding==ENCODING_MSGPACK and msgpack is not None:
+        return PROTOCOL_DELTA, ENCODING_MSGPACK
+    return PROTOCOL_DELTA, ENCODING_JSON
+
+
+def common_prefix_length(a:str, b:str)->int:
+    # Binary search on slice comparisons, which run in C
+    low, high = 0, min(len(a), len(b))
+    while low<high:
+        middle = (low+high+1)//2
+        if a[low:middle]==b[low:middle]:
+            low = middle
+        else:
+            high = middle-1
+    return low
+
+
+def text_splice(old:str, new:str):
+    """
+    Computes the operation turning old into new by replacing the part between their common prefix and suffix.
+
+    Returns:
+        tuple: (offset, deleted, inserted) meaning new == old[:offset] + inserted + old[offset+deleted:]
+    """
+    prefix = common_prefix_length(old, new)
+    old_rest = old[prefix:]
+    new_rest = new[prefix:]
+    suffix = common_prefix_length(old_rest[::-1], new_rest[::-1])
+    return prefix, len(old_rest)-suffix, new_rest[:len(new_rest)-suffix]
+
+
+def apply_splice(text:str, offset:int, deleted:int, inserted:str)->str:
+    """
+    Applies a splice operation computed by text_splice (what a frontend does with a diff frame).
+    """
+    return text[:offset] + inserted + text[offset+deleted:]
+
+
+def merge_chunk_frames(queued:dict, frame:dict):
+    """
+    Merges a chunk frame into the previous one when it was not sent yet (slow client).
+    The merged frame takes the sequence number of the last one. Frames carrying anything else than
+    text can't be merged.
+
+    Returns:
+        dict: The merged frame or None
+    """
+    if queued["t"]!=FRAME_CHUNK or frame["t"]!=FRAME_CHUNK or queued["id"]!=frame["id"] or len(frame)!=4:
+        return None
+    merged = dict(queued)
+    merged["s"] = frame["s"]
+    merged["c"] = queued["c"] + frame["c"]
+    return merged
+
+
+class MessageStreamEncoder:
+    """
+    Builds the frames of one message. Sequence numbers start at 0 with the header frame.
+
+    The encoder keeps the content the client builds from the frames. Diff and close frames carry the
+    sequence number of the last frame that changed it ("b"): a client whose content is not at that
+    sequence number must ask for a resync instead of applying the diff. Since the resync frame carries
+    everything built before it, frames with a lower sequence number arriving after it are ignored.
+
+    The last frames are kept in a ring buffer so that a client reconnecting during the generation can
+    get what it missed.
+
+    Args:
+        message_id (int): Id of the streamed message.
+        encoding (str): ENCODING_JSON or ENCODING_MSGPACK.
+        history_size (int): Number of frames kept for replay.
+    """
+    def __init__(self, message_id, encoding:str=ENCODING_JSON, history_size:int=512):
+        self.message_id = message_id
+        self.encoding = encoding
+        self.seq = -1
+        self._parameters = _UNSET
+        self._metadata = _UNSET
+        # Content as seen by the client and the sequence number of the frame that last changed it
+        self.view = GeneratedTextBuffer(marker="")
+        self.content_seq = None
+        self.history = deque(maxlen=max(history_size, 0))
+        # Frames are built from the generation thread and from resync requests
+        self._lock = threading.RLock()
+
+    def _frame(self, frame_type:str, fields:dict):
+        # Must be called with the lock held so that sequence numbers follow the emission order
+        self.seq += 1
+        frame = {"t": frame_type, "id": self.message_id, "s": self.seq}
+        frame.update(fields)
+        if self.history.maxlen:
+            self.history.append(frame)
+        return frame
+
+    def _changes(self, parameters, metadata):
+        # Parameters and metadata are only sent when they differ from the last sent ones
+        fields = {}
+        if parameters is not self._parameters and parameters!=self._parameters:
+            self._parameters = copy.deepcopy(parameters)
+            fields["p"] = parameters
+        if metadata is not self._metadata and metadata!=self._metadata:
+            self._metadata = copy.deepcopy(metadata)
+            fields["m"] = metadata
+        return fields
+
+    def header(self, **fields):
+        """
+        Opening frame with the static fields of the message (sender, discussion, timestamps...).
+        """
+        with self._lock:
+            if "parameters" in fields:
+                self._parameters = copy.deepcopy(fields["parameters"])
+            if "metadata" in fields:
+                self._metadata = copy.deepcopy(fields["metadata"])
+            frame = self._frame(FRAME_HEADER, fields)
+            self.view.set(fields.get("content") or "")
+            self.content_seq = frame["s"]
+            return frame
+
+    def chunk(self, text:str, parameters=None, metadata=None):
+        """
+        Text to append to the message.
+        """
+        with self._lock:
+            fields = {"c": text}
+            fields.update(self._changes(parameters, metadata))
+            frame = self._frame(FRAME_CHUNK, fields)
+            self.view.append(text)
+            self.content_seq = frame["s"]
+            return frame
+
+    def _splice(self, content:str):
+        offset, deleted, inserted = text_splice(self.view.text, content)
+        return {"b": self.content_seq, "o": offset, "x": deleted, "c": inserted}
+
+    def full(self, content:str, parameters=None, metadata=None):
+        """
+        Full rewrite of the message content, sent as a diff against the content of the client.
+        """
+        with self._lock:
+            fields = self._splice(content)
+            fields.update(self._changes(parameters, metadata))
+            frame = self._frame(FRAME_DIFF, fields)
+            self.view.set(content)
+            self.content_seq = frame["s"]
+            return frame
+
+    def resync(self):
+        """
+        Whole content, for a client that lost track of it.
+        """
+        with self._lock:
+            frame = self._frame(FRAME_RESYNC, {"c": self.view.text})
+            self.content_seq = frame["s"]
+            return frame
+
+    def replay(self, last_seq:int):
+        """
+        Frames following last_seq (the last sequence number received by a reconnecting client).
+        When some of them are not in the ring buffer anymore, a resync frame is returned instead.
+
+        Returns:
+            list: The frames to send
+        """
+        with self._lock:
+            if last_seq is None or last_seq<0:
+                return [self.resync()]
+            missed = [frame for frame in self.history if frame["s"]>last_seq]
+            if last_seq<self.seq and (not missed or missed[0]["s"]!=last_seq+1):
+                return [self.resync()]
+            return missed
+
+    def update(self, content:str, message_type:int, parameters=None, metadata=None, ui=None):
+        """
+        Any other update (steps, ui...).
+        """
+        with self._lock:
+            fields = {"c": content, "mt": message_type}
+            if ui is not None:
+                fields["ui"] = ui
+            fields.update(self._changes(parameters, metadata))
+            return self._frame(FRAME_UPDATE, fields)
+
+    def close(self, content:str=None, **fields):
+        """
+        Closing frame with the final fields of the message.
+        The final content is only sent (as a diff) if it differs from the content of the client.
+        """
+        with self._lock:
+            if content is not None and content!=self.view.text:
+                fields.update(self._splice(content))
+                self.view.set(content)
+            frame = self._frame(FRAME_CLOSE, fields)
+            if "c" in frame:
+                self.content_seq = frame["s"]
+            return frame
+
+    def encode(self, frame:dict):
+        """
+        Returns the payload to emit for a frame.
+        """
+        if self.encoding==ENCODING_MSGPACK:
+            return msgpack.packb(frame, use_bin_type=True)
+        return frame
+
+
+class StreamRoutes:
+    """
+    Socket ids to which the generations in progress are streamed.
+
+    A frontend that reconnects gets a new socket id and can resume the generation started by its
+    previous connection. The stream only moves to the new socket once the socket receiving it has
+    disconnected, so a connected client can not have its stream taken over by another socket.
+    """
+    def __init__(self):
+        # Client id that started the generation -> socket id receiving it
+        self._routes = {}
+        # Sockets that disconnected while a generation was streamed to them -> client id that started it
+        self._disconnected = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def route(self, client_id):
+        """
+        Socket id receiving the generation of a client (the client id itself unless it was resumed).
+        """
+        return self._routes.get(client_id, client_id)
+
+    def origin(self, sid):
+        """
+        Client id whose generation is streamed to sid (sid itself if it did not resume any).
+        """
+        with self._lock:
+            return self._origin(sid)
+
+    def _origin(self, sid):
+        for origin, route in self._routes.items():
+            if route==sid:
+                return origin
+        return sid
+
+    def disconnect(self, sid):
+        """
+        Records that a socket receiving a generation disconnected.
+        """
+        with self._lock:
+            self._disconnected[sid] = self._origin(sid)
+
+    def resume(self, sid, client_id):
+        """
+        Moves to sid the generation streamed to client_id. A client that reconnects several times
+        only knows the socket id of its last connection, which is accepted too.
+
+        Returns:
+            The client id that started the generation, or None if the socket receiving it is still connected
+        """
+        with self._lock:
+            origin = self._origin(client_id)
+            if self._routes.get(origin, origin) not in self._disconnected:
+                return None
+            self._routes[origin] = sid
+            return origin
+
+    def release(self, client_id)->list:
+        """
+        Forgets the route of a finished generation.
+
+        Returns:
+            list: The disconnected socket ids that received it, their streaming state can be dropped
+        """
+        with self._lock:
+            self._routes.pop(client_id, None)
+            gone = [sid for sid, origin in self._disconnected.items() if origin==client_id]
+            for sid in gone:
+                del self._disconnected[sid]
+            return gone
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "resumed":      len(self._routes),
+                "disconnected": len(self._disconnected)
+            }
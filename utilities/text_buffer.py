@@ -0,0 +1,116 @@
+"""
+project: lollms_webui
+file: text_buffer.py
+author: ParisNeo
+description:
+    Append optimized accumulator for the text generated for a client.
+    Chunks are stored in a list and only joined when the full text is actually needed, the joined
+    text is cached until the next append. The position of the first hallucination marker is tracked
+    while appending so that the visible part of the answer never requires a full scan.
+    When the binding reports how many tokens each chunk carries, they are counted along the way so that
+    the answer does not have to be tokenized again once it is finished.
+
+"""
+import threading
+
+
+class GeneratedTextBuffer:
+    """
+    Accumulates the generated text chunk by chunk.
+
+    Args:
+        text (str): Initial text (for example the content of a message being continued).
+        marker (str): Hallucination marker. Everything after its first occurrence is not shown to the user.
+        nb_tokens (int, optional): Number of tokens of the initial text if known.
+    """
+    def __init__(self, text:str="", marker:str="!@>", nb_tokens:int=None):
+        self.marker = marker
+        # The text can be materialized by the checkpoint ticker while the generation thread appends
+        self._lock = threading.RLock()
+        self.set(text)
+        if text and nb_tokens is not None:
+            self._nb_tokens = nb_tokens
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def nb_tokens(self):
+        """
+        Exact number of tokens of the visible text, or None if it can not be known without tokenizing
+        (chunk without a reported count, full rewrite, cut at an antiprompt or at a hallucination marker).
+        """
+        with self._lock:
+            return self._nb_tokens if self.marker_index is None else None
+
+    def set(self, text:str):
+        """
+        Replaces the whole content (full rewrite).
+        """
+        with self._lock:
+            self._set(text)
+
+    def _set(self, text:str):
+        self._nb_tokens = 0 if not text else None
+        self._chunks = [text] if text else []
+        self._length = len(text)
+        self._text = text
+        index = text.find(self.marker) if self.marker else -1
+        self.marker_index = index if index!=-1 else None
+        self._tail = text[-(len(self.marker)-1):] if len(self.marker)>1 else ""
+
+    def append(self, chunk:str, nb_tokens:int=None):
+        """
+        Adds a chunk. The cost only depends on the size of the chunk.
+
+        Args:
+            chunk (str): The received text.
+            nb_tokens (int, optional): Number of tokens carried by the chunk as reported by the binding.
+                                       None makes the count unknown (a chunk is not always a single token).
+        """
+        if not chunk:
+            return
+        with self._lock:
+            if self._nb_tokens is not None:
+                self._nb_tokens = self._nb_tokens + nb_tokens if nb_tokens is not None else None
+            if self.marker_index is None and self.marker:
+                window = self._tail + chunk
+                index = window.find(self.marker)
+                if index!=-1:
+                    self.marker_index = self._length - len(self._tail) + index
+            if len(self.marker)>1:
+                self._tail = (self._tail + chunk)[-(len(self.marker)-1):]
+            self._chunks.append(chunk)
+            self._length += len(chunk)
+            self._text = None
+
+    def truncate(self, position:int):
+        """
+        Cuts the text at position (used when an antiprompt is detected).
+        """
+        with self._lock:
+            text = self.text[:position]
+            marker_index = self.marker_index
+            self._set(text)
+            if marker_index is not None and marker_index + len(self.marker) <= position:
+                self.marker_index = marker_index
+
+    @property
+    def text(self)->str:
+        """
+        The full generated text. Joined on demand and cached until the next append.
+        """
+        with self._lock:
+            if self._text is None:
+                self._text = "".join(self._chunks)
+                self._chunks = [self._text]
+            return self._text
+
+    def visible_text(self)->str:
+        """
+        The generated text up to the first hallucination marker.
+        """
+        with self._lock:
+            if self.marker_index is None:
+                return self.text
+            return self.text[:self.marker_index]
@@ -0,0 +1,166 @@
+"""
+project: lollms_webui
+file: token_cache.py
+author: ParisNeo
+description:
+    Caches of the tokenization work done when building prompts.
+    The same texts (conditionning, prefixes, old messages) are tokenized again at every turn of a
+    discussion. TokenizationCache keeps the tokens of the last texts in memory (LRU) per model, and
+    MessageTokenCounts persists the number of tokens of each message, as it appears in the prompt,
+    in a side table of the discussion database so that only new or edited messages are tokenized.
+
+"""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def text_hash(text:str)->str:
+    return hashlib.blake2b(text.encode("utf-8", errors="replace"), digest_size=16).hexdigest()
+
+
+class TokenizationCache:
+    """
+    LRU cache of tokenized texts, keyed by (model, text hash).
+
+    Args:
+        max_entries (int): Maximum number of cached texts. 0 disables the cache.
+    """
+    def __init__(self, max_entries:int=4096):
+        self.max_entries = max(max_entries, 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def tokenize(self, model_key:str, text:str, tokenize)->list:
+        """
+        Returns the tokens of text, calling tokenize(text) only if they are not cached.
+
+        Args:
+            model_key (str): Identifies the tokenizer (binding and model).
+            text (str): The text.
+            tokenize (Callable): The tokenizer of the model.
+        """
+        key = (model_key, text_hash(text))
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(tokens)
+            self.misses += 1
+        tokens = tokenize(text)
+        if self.max_entries>0:
+            with self._lock:
+                self._entries[key] = tuple(tokens)
+                self._entries.move_to_end(key)
+                while len(self._entries)>self.max_entries:
+                    self._entries.popitem(last=False)
+        return tokens
+
+    def count(self, model_key:str, text:str, tokenize)->int:
+        return len(self.tokenize(model_key, text, tokenize))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "tokenization_cache_entries":   len(self._entries),
+                "tokenization_cache_hits":      self.hits,
+                "tokenization_cache_misses":    self.misses
+            }
+
+
+class MessageTokenCounts:
+    """
+    Number of tokens of the messages of a discussion database, per model.
+    A count is only valid for the text it was computed from (its hash is stored with it), so an
+    edited message is counted again even if its entry was not invalidated.
+
+    Args:
+        db_path (Path): The discussion database file.
+    """
+    def __init__(self, db_path:Path):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS message_token_counts (
+                    message_id INTEGER NOT NULL,
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    nb_tokens INTEGER NOT NULL,
+                    PRIMARY KEY (message_id, model)
+                )
+            """)
+
+    def get_many(self, message_ids:list, model_key:str)->dict:
+        """
+        Returns:
+            dict: message_id -> (text_hash, nb_tokens) for the messages that have a count
+        """
+        counts = {}
+        message_ids = list(message_ids)
+        with sqlite3.connect(self.db_path) as conn:
+            # Stay below the maximum number of sql variables
+            for i in range(0, len(message_ids), 500):
+                batch = message_ids[i:i+500]
+                rows = conn.execute(
+                    f"SELECT message_id, text_hash, nb_tokens FROM message_token_counts WHERE model=? AND message_id IN ({','.join('?'*len(batch))})",
+                    [model_key] + batch
+                ).fetchall()
+                for message_id, hash_, nb_tokens in rows:
+                    counts[message_id] = (hash_, nb_tokens)
+        return counts
+
+    def set_many(self, counts:list, model_key:str):
+        """
+        Args:
+            counts (list): (message_id, text_hash, nb_tokens) tuples.
+        """
+        if not counts:
+            return
+        with sqlite3.connect(self.db_path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO message_token_counts (message_id, model, text_hash, nb_tokens) VALUES (?, ?, ?, ?)",
+                [(message_id, model_key, hash_, nb_tokens) for message_id, hash_, nb_tokens in counts]
+            )
+
+    def invalidate(self, message_id:int):
+        """
+        Forgets the counts of a message (edited or deleted).
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM message_token_counts WHERE message_id=?", (message_id,))
+
+    def count_messages(self, messages:list, model_key:str, count)->list:
+        """
+        Number of tokens of each message, only counting the ones that are new or changed.
+
+        Args:
+            messages (list): (message_id, text) tuples, text being the message as it appears in the prompt.
+            model_key (str): Identifies the tokenizer.
+            count (Callable): Returns the number of tokens of a text.
+
+        Returns:
+            list: The number of tokens of each message, in the same order
+        """
+        known = self.get_many([message_id for message_id, _ in messages], model_key)
+        result = []
+        new_counts = []
+        for message_id, text in messages:
+            hash_ = text_hash(text)
+            entry = known.get(message_id)
+            if entry is not None and entry[0]==hash_:
+                result.append(entry[1])
+            else:
+                nb_tokens = count(text)
+                result.append(nb_tokens)
+                new_counts.append((message_id, hash_, nb_tokens))
+        self.set_many(new_counts, model_key)
+        return result
@@ -0,0 +1,218 @@
+"""
+project: lollms_webui
+file: tracing.py
+author: ParisNeo
+description:
+    Lightweight tracing of the generation requests, without any collector service.
+    Each request gets a trace made of nested spans (query preparation, model, workflow, tts...).
+    The current trace is kept per thread, so the code of a stage only opens a span and nothing has
+    to be passed around. Frequent operations (socket emits) are summed in the trace instead of
+    getting one span each. Finished traces are appended to a rotating JSONL file and the last ones
+    are kept in memory to be returned by an endpoint.
+
+"""
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Span:
+    def __init__(self, name:str, parent_id:str=None, attributes:dict=None):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+
+    def end(self):
+        self.duration_ms = (time.perf_counter()-self._start)*1000
+
+    def to_dict(self):
+        return {
+            "span_id":      self.span_id,
+            "parent_id":    self.parent_id,
+            "name":         self.name,
+            "start_time":   self.start_time,
+            "duration_ms":  self.duration_ms,
+            "attributes":   self.attributes,
+            "error":        self.error
+        }
+
+
+class Trace:
+    def __init__(self, name:str, attributes:dict=None):
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(name, attributes=attributes)
+        self.spans = [self.root]
+        # Spans opened and not ended yet, the innermost last
+        self.stack = [self.root]
+        # name -> [total ms, count] of the summed operations
+        self.totals = {}
+
+    def to_dict(self):
+        return {
+            "trace_id":     self.trace_id,
+            "name":         self.root.name,
+            "start_time":   self.root.start_time,
+            "duration_ms":  self.root.duration_ms,
+            "attributes":   self.root.attributes,
+            "spans":        [span.to_dict() for span in self.spans[1:]],
+            "totals":       {name: {"total_ms": total, "count": count} for name, (total, count) in self.totals.items()}
+        }
+
+
+class JSONLTraceExporter:
+    """
+    Appends the traces to a JSONL file, rotated when it gets too big (file.1, file.2...).
+
+    Args:
+        path (Path): The traces file.
+        max_bytes (int): Size above which the file is rotated.
+        backup_count (int): Number of rotated files kept.
+        keep_last (int): Number of traces kept in memory for last().
+    """
+    def __init__(self, path:Path, max_bytes:int=10*1024*1024, backup_count:int=3, keep_last:int=100):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._last = deque(maxlen=max(keep_last, 1))
+        self._lock = threading.Lock()
+        self._load_last()
+
+    def _load_last(self):
+        # The last traces of the previous run
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in deque(f, maxlen=self._last.maxlen):
+                    self._last.append(json.loads(line))
+        except Exception as ex:
+            traceback.print_exc()
+
+    def _rotate(self):
+        for index in range(self.backup_count-1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                source.replace(self.path.with_name(f"{self.path.name}.{index+1}"))
+        if self.backup_count>0:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def export(self, trace:dict):
+        line = json.dumps(trace, default=str) + "\n"
+        with self._lock:
+            self._last.append(trace)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if self.path.exists() and self.path.stat().st_size + len(line)>self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except Exception as ex:
+                traceback.print_exc()
+
+    def last(self, n:int=20)->list:
+        """
+        The n last traces, the most recent first.
+        """
+        with self._lock:
+            traces = list(self._last)
+        return traces[::-1][:max(n, 0)]
+
+
+class Tracer:
+    """
+    Args:
+        exporter (JSONLTraceExporter): Receives the finished traces.
+        enabled (bool): When False, traces and spans do nothing.
+    """
+    def __init__(self, exporter:JSONLTraceExporter=None, enabled:bool=True):
+        self.exporter = exporter
+        self.enabled = enabled and exporter is not None
+        self._local = threading.local()
+
+    @property
+    def current(self)->Trace:
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def trace(self, name:str, **attributes):
+        """
+        Traces a request run on the current thread. A trace already running on the thread is continued.
+        """
+        if not self.enabled or self.current is not None:
+            yield self.current
+            return
+        trace = Trace(name, attributes)
+        self._local.trace = trace
+        try:
+            yield trace
+        except BaseException as ex:
+            trace.root.error = repr(ex)
+            raise
+        finally:
+            self._local.trace = None
+            trace.root.end()
+            self.exporter.export(trace.to_dict())
+
+    @contextmanager
+    def span(self, name:str, **attributes):
+        """
+        A stage of the traced request running on the current thread (nothing if there is none).
+        """
+        trace = self.current
+        if trace is None:
+            yield None
+            return
+        span = Span(name, trace.stack[-1].span_id, attributes)
+        trace.spans.append(span)
+        trace.stack.append(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span.error = repr(ex)
+            raise
+        finally:
+            span.end()
+            if trace.stack and trace.stack[-1] is span:
+                trace.stack.pop()
+
+    def set_attribute(self, name:str, value):
+        """
+        Sets an attribute of the innermost open span.
+        """
+        trace = self.current
+        if trace is not None:
+            trace.stack[-1].attributes[name] = value
+
+    def mark(self, name:str):
+        """
+        Records in the innermost open span the time elapsed since it started (first token for example).
+        """
+        trace = self.current
+        if trace is not None:
+            span = trace.stack[-1]
+            span.attributes[name] = (time.perf_counter()-span._start)*1000
+
+    def add_time(self, name:str, duration_ms:float):
+        """
+        Sums the duration of a frequent operation in the current trace.
+        """
+        trace = self.current
+        if trace is not None:
+            total = trace.totals.get(name)
+            if total is None:
+                trace.totals[name] = [duration_ms, 1]
+            else:
+                total[0] += duration_ms
+                total[1] += 1
@@ -0,0 +1,187 @@
+"""
+project: lollms_webui
+file: worker_lanes.py
+author: ParisNeo
+description:
+    Bounded pools of worker threads, one per kind of background work (generation, ingestion,
+    scraping...). Each lane has a maximum number of workers and of waiting tasks: a burst of requests
+    is queued then refused instead of spawning one thread per request. Workers are started on demand
+    and reused. Each lane keeps its occupancy and wait time counters.
+
+"""
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class LaneStats:
+    """
+    Counters of a lane.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_run_ms = 0.0
+
+    def record(self, counter:str, value:int=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def record_task(self, wait_ms:float, run_ms:float, failed:bool):
+        with self._lock:
+            self.completed += 1
+            if failed:
+                self.failed += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.total_run_ms += run_ms
+
+    def to_dict(self):
+        with self._lock:
+            count = max(self.completed, 1)
+            return {
+                "submitted":        self.submitted,
+                "rejected":         self.rejected,
+                "completed":        self.completed,
+                "failed":           self.failed,
+                "mean_wait_ms":     self.total_wait_ms/count,
+                "max_wait_ms":      self.max_wait_ms,
+                "mean_run_ms":      self.total_run_ms/count
+            }
+
+
+class WorkerLane:
+    """
+    A bounded pool of worker threads.
+
+    Args:
+        name (str): Name of the lane (used to name its threads).
+        max_workers (int): Maximum number of tasks running at the same time.
+        max_queued (int): Maximum number of tasks waiting for a worker, None for no limit (when the
+                          callers already bound their requests).
+    """
+    def __init__(self, name:str, max_workers:int=1, max_queued:int=16):
+        self.name = name
+        self._max_workers = max(max_workers, 1)
+        self.max_queued = max(max_queued, 0) if max_queued is not None else None
+        self.stats = LaneStats()
+
+        self._tasks = deque()
+        self._workers = 0
+        self._idle = 0
+        self._busy = 0
+        self._condition = threading.Condition()
+
+    @property
+    def max_workers(self)->int:
+        return self._max_workers
+
+    @max_workers.setter
+    def max_workers(self, value:int):
+        with self._condition:
+            self._max_workers = max(value, 1)
+            # Idle workers above the new limit leave
+            self._condition.notify_all()
+            self._spawn()
+
+    @property
+    def queued(self)->int:
+        return len(self._tasks)
+
+    @property
+    def busy(self)->int:
+        return self._busy
+
+    def submit(self, target, *args, **kwargs)->bool:
+        """
+        Queues a task. Can be called from any thread.
+
+        Returns:
+            bool: False if the lane is full and the task was refused
+        """
+        with self._condition:
+            free_workers = max(self._max_workers - self._busy, 0)
+            if self.max_queued is not None and len(self._tasks) - free_workers >= self.max_queued:
+                self.stats.record("rejected")
+                return False
+            self._tasks.append((target, args, kwargs, time.perf_counter()))
+            self.stats.record("submitted")
+            self._spawn()
+            self._condition.notify()
+        return True
+
+    def _spawn(self):
+        # Must be called with the condition held
+        while self._idle<len(self._tasks) and self._workers<self._max_workers:
+            self._workers += 1
+            self._idle += 1
+            threading.Thread(target=self._work, daemon=True, name=f"{self.name}_{self._workers}").start()
+
+    def _work(self):
+        with self._condition:
+            # The new worker was counted as idle when spawned
+            self._idle -= 1
+        while True:
+            with self._condition:
+                self._idle += 1
+                self._condition.wait_for(lambda: self._tasks or self._workers>self._max_workers)
+                self._idle -= 1
+                if self._workers>self._max_workers:
+                    self._workers -= 1
+                    return
+                target, args, kwargs, queued_at = self._tasks.popleft()
+                self._busy += 1
+            start = time.perf_counter()
+            failed = False
+            try:
+                target(*args, **kwargs)
+            except Exception as ex:
+                # The worker must survive a failing task
+                failed = True
+                traceback.print_exc()
+            finally:
+                end = time.perf_counter()
+                with self._condition:
+                    self._busy -= 1
+                self.stats.record_task((start-queued_at)*1000, (end-start)*1000, failed)
+
+    def to_dict(self):
+        stats = self.stats.to_dict()
+        with self._condition:
+            stats.update({
+                "max_workers":  self._max_workers,
+                "workers":      self._workers,
+                "busy":         self._busy,
+                "occupancy":    self._busy/self._max_workers,
+                "queued":       len(self._tasks),
+                "max_queued":   self.max_queued
+            })
+        return stats
+
+
+class WorkerLanes:
+    """
+    The lanes of a server, by name.
+    """
+    def __init__(self):
+        self.lanes = {}
+
+    def add(self, name:str, max_workers:int=1, max_queued:int=16)->WorkerLane:
+        lane = WorkerLane(name, max_workers, max_queued)
+        self.lanes[name] = lane
+        return lane
+
+    def __getitem__(self, name:str)->WorkerLane:
+        return self.lanes[name]
+
+    def submit(self, name:str, target, *args, **kwargs)->bool:
+        return self.lanes[name].submit(target, *args, **kwargs)
+
+    def to_dict(self):
+        return {name: lane.to_dict() for name, lane in self.lanes.items()}